@@ -0,0 +1,116 @@
+import hashlib
+import os
+import re
+import sys
+import threading
+from functools import lru_cache
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-in for the source server: serves a directory over HTTP with HEAD,
+# single-range GETs, MD5 ETags and If-Range, which is what `download_data`
+# relies on.
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+COPY_BUFFER = 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def _etag(path, mtime_ns, size):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER), b""):
+            digest.update(chunk)
+    return f'"{digest.hexdigest()}"'
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves files with Accept-Ranges, ETag and 206 partial responses."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _file(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None, None
+        stat = os.stat(path)
+        return path, stat
+
+    def _headers(self, status, length, etag, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        path, stat = self._file()
+        if path is not None:
+            self._headers(200, stat.st_size, _etag(path, stat.st_mtime_ns, stat.st_size))
+
+    def do_GET(self):
+        path, stat = self._file()
+        if path is None:
+            return
+        size = stat.st_size
+        etag = _etag(path, stat.st_mtime_ns, size)
+        start, end = 0, size - 1
+        status = 200
+
+        match = RANGE.match(self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if match and (if_range is None or if_range == etag):
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                start, end = max(0, size - int(last)), size - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self._headers(status, end - start + 1, etag, f"bytes {start}-{end}/{size}" if status == 206 else None)
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = f.read(min(COPY_BUFFER, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+def serve(root, port=0):
+    """
+    Starts serving `root` in a background thread.
+
+    Returns:
+        tuple: (server, base URL); call `server.shutdown()` to stop it.
+    """
+    handler = lambda *args, **kwargs: RangeRequestHandler(*args, directory=root, **kwargs)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python3 -m bench.http_server <ROOT> [PORT]")
+        sys.exit(1)
+    server, url = serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 8000)
+    print(f"Serving {sys.argv[1]} at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
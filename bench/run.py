@@ -0,0 +1,284 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from bench.http_server import serve
+from bench.synthetic import generate
+
+# Benchmark of every pipeline stage on synthetic data, against a LocalStore
+# and a local HTTP stand-in for the source server:
+#
+#   python3 -m bench.run --profile small                 # run and compare with the baseline
+#   python3 -m bench.run --profile small --save-baseline # record a new baseline
+#
+# Each stage runs in a fresh process, so its peak RSS is its own. Baselines
+# are machine-specific: record them on the machine that checks them. They
+# stay local (bench/baselines.json is not committed).
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+GEOJSON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "geojson", "ne_110m_admin_0_countries.geojson")
+
+# Profiles: days generated and share of the real scanlines per orbit
+PROFILES = {
+    "small": {"days": 8, "scale": 0.02},
+    "medium": {"days": 8, "scale": 0.1},
+    "full": {"days": 8, "scale": 1.0},
+}
+START_DATE = datetime(2024, 1, 1)
+
+STAGES = ("download", "extract", "make_parquet", "make_countries", "compute_7day_rolling", "ra_range", "upload")
+
+# A stage regresses when its time or peak memory exceeds the baseline by more than this
+TOLERANCE = 0.25
+# Timing differences below this many seconds are noise, whatever the ratio
+NOISE_SECONDS = 0.2
+
+
+def _size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def _files(root):
+    return [os.path.join(dirpath, name) for dirpath, _, names in os.walk(root) for name in names]
+
+
+def _dates(context):
+    return [START_DATE + timedelta(days=offset) for offset in range(context["days"])]
+
+
+# ──── Stages ────
+# Each returns (bytes read, bytes written, items processed): files, days or rows.
+
+def stage_download(context):
+    from sub.download_data import download_file
+    target = os.path.join(context["work"], "downloads")
+    os.makedirs(target, exist_ok=True)
+    paths = [
+        download_file(f"{context['base_url']}/{date:%Y}/{date:%m}/tropomi_no2_{date:%Y%m%d}.tar", target)
+        for date in _dates(context)
+    ]
+    return _size(paths), _size(paths), len(paths)
+
+
+def stage_extract(context):
+    from sub.extract_data import extract_tar_file
+    read = written = 0
+    for date in _dates(context):
+        tar_path = os.path.join(context["work"], "downloads", f"tropomi_no2_{date:%Y%m%d}.tar")
+        target = os.path.join(context["work"], "extracted", f"{date:%Y%m%d}")
+        extract_tar_file(tar_path, target)
+        read += os.path.getsize(tar_path)
+        written += _size(_files(target))
+    return read, written, context["days"]
+
+
+def stage_make_parquet(context):
+    from sub.blob_store import LocalStore
+    from sub.catalog import describe_day, record_days
+    from sub.make_parquet import process_nc_files_to_parquet
+    store = LocalStore(os.path.join(context["work"], "store"))
+    read = rows = 0
+    for date in _dates(context):
+        folder = os.path.join(context["work"], "extracted", f"{date:%Y%m%d}")
+        day_key, grid_key = f"data/days/d{date:%Y%m%d}.parquet", f"data/grid/g{date:%Y%m%d}.parquet"
+        rows += process_nc_files_to_parquet(folder, store, day_key, workers=context["workers"], grid_key=grid_key)
+        record_days(store, [describe_day(store, day_key, date, grid_key=grid_key)])
+        read += _size(_files(folder))
+    return read, _size(_files(store.uri("data"))), rows
+
+
+def stage_make_countries(context):
+    from sub.blob_store import LocalStore
+    from sub.make_countries import load_raster, make_countries
+    store = LocalStore(os.path.join(context["work"], "store"))
+    dates = _dates(context)
+    make_countries(store, "data/days", "data/countries", load_raster(GEOJSON_PATH), dates[0], dates[-1],
+                   workers=context["workers"])
+    return _size(_files(store.uri("data/days"))), _size(_files(store.uri("data/countries"))), len(dates)
+
+
+def stage_compute_7day_rolling(context):
+    from sub.blob_store import LocalStore
+    from sub.ra.compute_ra_single_day import compute_7day_rolling, load_daily_parquet
+    import polars as pl
+    store = LocalStore(os.path.join(context["work"], "store"))
+    keys = [f"data/days/d{date:%Y%m%d}.parquet" for date in _dates(context)[-7:]]
+    frame = compute_7day_rolling(pl.concat([load_daily_parquet(store, key) for key in keys]))
+    return _size(store.uri(key) for key in keys), frame.estimated_size(), frame.height
+
+
+def stage_ra_range(context):
+    from sub.blob_store import LocalStore
+    from sub.ra.incremental import iter_range
+    store = LocalStore(os.path.join(context["work"], "store"))
+    dates = _dates(context)
+    written = rows = 0
+    for _, daily in iter_range(store, dates[6], dates[-1]):
+        written += daily.estimated_size()
+        rows += daily.height
+    return _size(_files(store.uri("data/grid"))), written, rows
+
+
+def stage_upload(context):
+    from sub.blob_store import LocalStore
+    source = LocalStore(os.path.join(context["work"], "store"))
+    remote = LocalStore(os.path.join(context["work"], "remote"))
+    keys = [f"data/days/d{date:%Y%m%d}.parquet" for date in _dates(context)]
+    remote.put_many({key: open(source.uri(key), "rb").read() for key in keys})
+    size = _size(source.uri(key) for key in keys)
+    return size, size, len(keys)
+
+
+def _run_stage(name, context, results):
+    """Runs one stage in this (fresh) process and reports its measurements."""
+    # Silence the stage and its worker processes, which inherit the descriptor
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    # A local cache of the run's own, so stages never hit data cached by earlier runs
+    os.environ["NO2_BLOB_CACHE_DIR"] = os.path.join(context["work"], "cache")
+    start = time.perf_counter()
+    bytes_read, bytes_written, items = globals()[f"stage_{name}"](context)
+    seconds = time.perf_counter() - start
+    results.put({
+        "seconds": round(seconds, 3),
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+        "items": items,
+        "mb_per_s": round(bytes_read / 1e6 / seconds, 2) if seconds else None,
+        "items_per_s": round(items / seconds, 1) if seconds else None,
+        # ru_maxrss is in KiB on Linux; workers report through RUSAGE_CHILDREN
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    })
+
+
+def run_stage(name, context):
+    spawn = multiprocessing.get_context("spawn")
+    results = spawn.Queue()
+    process = spawn.Process(target=_run_stage, args=(name, context, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {"error": f"exit code {process.exitcode}"}
+    return results.get()
+
+
+def run_benchmark(profile, stages=STAGES, work=None, workers=4, seed=0):
+    """
+    Generates synthetic data and runs the stages in order.
+
+    Args:
+        profile (str): Key of PROFILES.
+        stages (tuple): Stages to run; later stages read what earlier ones wrote.
+        work (str): Working directory, a temporary one (removed afterwards) if None.
+        workers (int): Worker processes for the decode and country stages.
+        seed (int): Seed of the synthetic data.
+
+    Returns:
+        dict: Stage -> measurements.
+    """
+    settings = PROFILES[profile]
+    own_work = work is None
+    work = work or tempfile.mkdtemp(prefix="no2-bench-")
+    data_dir = os.path.join(work, "synthetic")
+    try:
+        print(f"Generating {settings['days']} days at scale {settings['scale']} in {data_dir}")
+        generate(data_dir, START_DATE, settings["days"], settings["scale"], seed, store=False)
+        server, base_url = serve(os.path.join(data_dir, "tars"))
+        context = {"work": work, "base_url": base_url, "days": settings["days"], "workers": workers}
+        results = {}
+        try:
+            for name in stages:
+                results[name] = run_stage(name, context)
+                print(f"{name}: {results[name].get('seconds', results[name].get('error'))}")
+        finally:
+            server.shutdown()
+        return results
+    finally:
+        if own_work:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+def load_baselines(path=BASELINES_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compares measurements with a baseline.
+
+    Returns:
+        list: (stage, metric, baseline, current) for every regression.
+    """
+    regressions = []
+    for stage, current in results.items():
+        base = baseline.get(stage)
+        if base is None or "error" in base:
+            continue
+        if "error" in current:
+            regressions.append((stage, "error", None, current["error"]))
+            continue
+        if current["seconds"] > base["seconds"] * (1 + tolerance) + NOISE_SECONDS:
+            regressions.append((stage, "seconds", base["seconds"], current["seconds"]))
+        if current["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append((stage, "peak_rss_mb", base["peak_rss_mb"], current["peak_rss_mb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="small")
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated stages, run in pipeline order")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes for decode and countries")
+    parser.add_argument("--work", help="Working directory to keep, instead of a temporary one")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="Record the results as the profile's baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    stages = tuple(stage for stage in STAGES if stage in args.stages.split(","))
+    results = run_benchmark(args.profile, stages, args.work, args.workers)
+    report = {
+        "profile": args.profile,
+        "recorded": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "machine": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+        "stages": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"\n{'stage':<22}{'seconds':>9}{'MB/s':>9}{'items/s':>11}{'RSS MB':>9}{'worker MB':>11}")
+    for stage, result in results.items():
+        if "error" in result:
+            print(f"{stage:<22}{result['error']:>49}")
+            continue
+        print(f"{stage:<22}{result['seconds']:>9.2f}{result['mb_per_s'] or 0:>9.1f}{result['items_per_s'] or 0:>11.0f}"
+              f"{result['peak_rss_mb']:>9.0f}{result['peak_worker_rss_mb']:>11.0f}")
+
+    baselines = load_baselines()
+    if args.save_baseline:
+        baselines[args.profile] = report
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"\nSaved the {args.profile} baseline to {BASELINES_PATH}")
+    elif args.profile in baselines:
+        regressions = compare(results, baselines[args.profile]["stages"], args.tolerance)
+        for stage, metric, base, current in regressions:
+            print(f"❌ {stage} {metric}: {current} vs baseline {base}")
+        if regressions:
+            sys.exit(1)
+        print(f"\n✅ No regressions against the {args.profile} baseline "
+              f"({baselines[args.profile]['recorded']}, {baselines[args.profile]['machine']['cpus']} CPUs)")
+    else:
+        print(f"\nNo {args.profile} baseline yet; record one with --save-baseline")
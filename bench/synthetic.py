@@ -0,0 +1,181 @@
+import argparse
+import io
+import os
+import tarfile
+from datetime import datetime, timedelta
+import h5py
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sub.blob_store import LocalStore
+from sub.catalog import DAYS_PREFIX, describe_day, record_days
+from sub.grid import GRID_PREFIX, GridStats, write_grid
+
+# Synthetic TROPOMI-like NO2 data, shaped like the real product:
+#   - orbit files with PRODUCT/latitude, longitude, nitrogendioxide_tropospheric_column
+#     and qa_value as (1, scanline, ground_pixel) datasets, zlib-compressed
+#   - day tars laid out like the source server, <root>/YYYY/MM/tropomi_no2_YYYYMMDD.tar
+#   - day Parquet files and gridded day products in a store, as ingest writes them
+# A real day has 14-15 orbits of about 4173 x 450 pixels; `scale` shrinks the
+# number of scanlines per orbit.
+ORBITS_PER_DAY = 14
+SCANLINES = 4173
+GROUND_PIXELS = 450
+FILL_VALUE = np.float32(9.96921e36)
+
+# Share of pixels passing the qa_value > 75 filter, about as in the real product
+VALID_SHARE = 0.45
+
+# Emission hot spots: (latitude, longitude, peak in mol/m2, radius in degrees)
+HOT_SPOTS = [
+    (40.7, -74.0, 1.5e-4, 1.5), (34.0, -118.2, 1.8e-4, 1.5), (51.5, -0.1, 1.2e-4, 1.5),
+    (50.9, 6.9, 1.4e-4, 2.0), (39.9, 116.4, 2.5e-4, 3.0), (31.2, 121.5, 2.2e-4, 2.5),
+    (28.6, 77.2, 1.6e-4, 2.5), (35.7, 139.7, 1.5e-4, 1.5), (-26.2, 28.0, 1.3e-4, 2.0),
+    (30.0, 31.2, 1.0e-4, 1.5), (19.4, -99.1, 1.2e-4, 1.5), (-23.5, -46.6, 1.0e-4, 1.5),
+]
+
+
+def orbit_pixels(date, orbit, scale=1.0, seed=0):
+    """
+    Generates the pixels of one orbit.
+
+    The swath runs from south to north along a track shifted west by about
+    25° per orbit, about 26° wide at the equator and widening with latitude.
+    NO2 is a background with hot spots and lognormal noise; pixels failing the
+    QA filter get the fill value, as in the real files.
+
+    Returns:
+        dict: Dataset name -> (1, scanlines, ground pixels) array.
+    """
+    rng = np.random.default_rng([seed, date.toordinal(), orbit])
+    scanlines = max(2, int(SCANLINES * scale))
+    along = np.linspace(-1, 1, scanlines)[:, None]
+    across = np.linspace(-1, 1, GROUND_PIXELS)[None, :]
+
+    latitude = np.broadcast_to(88.0 * np.sin(along * np.pi / 2), (scanlines, GROUND_PIXELS))
+    track = 180.0 - 25.7 * (orbit + 0.5) - 8.0 * along
+    width = 13.0 / np.clip(np.cos(np.radians(latitude)), 0.1, None)
+    longitude = (track + across * width + 180.0) % 360.0 - 180.0
+    latitude = latitude + rng.normal(0, 0.02, latitude.shape)
+
+    no2 = 1.5e-5 + 1.0e-5 * np.cos(np.radians(latitude))
+    for lat0, lon0, peak, radius in HOT_SPOTS:
+        distance2 = (latitude - lat0) ** 2 + ((longitude - lon0) * np.cos(np.radians(lat0))) ** 2
+        no2 = no2 + peak * np.exp(-distance2 / (2 * radius ** 2))
+    no2 = no2 * rng.lognormal(0, 0.3, no2.shape)
+
+    qa_value = np.where(rng.random(no2.shape) < VALID_SHARE, rng.integers(76, 101, no2.shape),
+                        rng.integers(0, 76, no2.shape)).astype(np.uint8)
+    no2 = np.where(qa_value > 0, no2, FILL_VALUE)
+    return {
+        "PRODUCT/latitude": latitude.astype(np.float32)[None],
+        "PRODUCT/longitude": longitude.astype(np.float32)[None],
+        "PRODUCT/nitrogendioxide_tropospheric_column": no2.astype(np.float32)[None],
+        "PRODUCT/qa_value": qa_value[None],
+    }
+
+
+def orbit_name(date, orbit):
+    return f"S5P_SYN_L2__NO2____{date:%Y%m%d}T{orbit:02d}0000_{date.toordinal() % 100000:05d}{orbit:02d}.nc"
+
+
+def orbit_bytes(datasets):
+    """Writes an orbit as an HDF5 (netCDF-4) file in memory."""
+    buffer = io.BytesIO()
+    with h5py.File(buffer, "w") as f:
+        for name, values in datasets.items():
+            f.create_dataset(name, data=values, compression="gzip", compression_opts=4,
+                             chunks=(1, min(values.shape[1], 512), values.shape[2]))
+    return buffer.getvalue()
+
+
+def write_day_tar(root, date, scale=1.0, seed=0):
+    """
+    Writes one day's tar of orbit files under the source server layout.
+
+    Returns:
+        str: Path of the tar.
+    """
+    path = os.path.join(root, f"{date:%Y}", f"{date:%m}", f"tropomi_no2_{date:%Y%m%d}.tar")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tarfile.open(path, "w") as tar:
+        for orbit in range(ORBITS_PER_DAY):
+            data = orbit_bytes(orbit_pixels(date, orbit, scale, seed))
+            info = tarfile.TarInfo(orbit_name(date, orbit))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def day_table(date, scale=1.0, seed=0):
+    """Returns the pixels of a day kept by ingest (qa_value > 75), in the day Parquet schema."""
+    parts = []
+    for orbit in range(ORBITS_PER_DAY):
+        data = {name.split("/")[-1]: values.ravel() for name, values in orbit_pixels(date, orbit, scale, seed).items()}
+        mask = data["qa_value"] > 75
+        parts.append(pa.table({column: values[mask] for column, values in data.items()}))
+    return pa.concat_tables(parts)
+
+
+def write_day_store(store, date, scale=1.0, seed=0):
+    """
+    Writes a day's Parquet file and gridded product straight to a store, and catalogs the day.
+
+    Much faster than going through tars when a stage only needs day files.
+
+    Returns:
+        int: Rows written.
+    """
+    table = day_table(date, scale, seed)
+    day_key = f"{DAYS_PREFIX}d{date:%Y%m%d}.parquet"
+    grid_key = f"{GRID_PREFIX}g{date:%Y%m%d}.parquet"
+    with store.open_write(day_key) as sink:
+        pq.write_table(table, sink)
+    stats = GridStats.from_pixels(
+        table.column("latitude").to_numpy(),
+        table.column("longitude").to_numpy(),
+        table.column("nitrogendioxide_tropospheric_column").to_numpy(),
+    )
+    with store.open_write(grid_key) as sink:
+        write_grid(stats, sink)
+    record_days(store, [describe_day(store, day_key, date, grid_key=grid_key)])
+    return table.num_rows
+
+
+def generate(output_dir, start_date, days, scale=1.0, seed=0, tars=True, store=True):
+    """
+    Generates `days` days of synthetic data from `start_date`.
+
+    Args:
+        output_dir (str): Receives tars/ (the source server tree) and store/ (a LocalStore).
+        start_date (datetime): First day.
+        days (int): Number of days.
+        scale (float): Share of the real number of scanlines per orbit.
+        seed (int): Seed of the generator; the same seed gives the same data.
+        tars (bool): Write the day tars.
+        store (bool): Write the day Parquet files, grid products and catalog.
+    """
+    local_store = LocalStore(os.path.join(output_dir, "store"))
+    for offset in range(days):
+        date = start_date + timedelta(days=offset)
+        if tars:
+            path = write_day_tar(os.path.join(output_dir, "tars"), date, scale, seed)
+            print(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+        if store:
+            rows = write_day_store(local_store, date, scale, seed)
+            print(f"Wrote day {date:%Y-%m-%d} to {local_store.uri(DAYS_PREFIX)} ({rows} rows)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic TROPOMI-like NO2 tars and day files.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--start", default="2024-01-01", help="First date, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=8)
+    parser.add_argument("--scale", type=float, default=1.0, help="Share of the real scanlines per orbit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tars", action="store_true", help="Only write the store")
+    parser.add_argument("--no-store", action="store_true", help="Only write the tars")
+    args = parser.parse_args()
+
+    generate(args.output_dir, datetime.strptime(args.start, "%Y-%m-%d"), args.days, args.scale, args.seed,
+             tars=not args.no_tars, store=not args.no_store)
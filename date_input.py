@@ -1,22 +1,21 @@
-import subprocess
+import os
 from datetime import datetime, timedelta
 import pytz
 
+from sub.blob_store import open_store
+from sub.planner import LOOKBACK_DAYS, Planner
+
 # Set timezone to EST
 est = pytz.timezone("US/Eastern")
 
-# Calculate dates
+# Check the last LOOKBACK_DAYS days, up to yesterday, for new days and for
+# NRT days replaced by the final product
 now_est = datetime.now(est)
-yesterday = (now_est - timedelta(days=1)).strftime("%Y-%m-%d")
-day_before_yesterday = (now_est - timedelta(days=2)).strftime("%Y-%m-%d")
-ten_days_ago = (now_est - timedelta(days=10)).strftime("%Y-%m-%d")
-
-# List of date ranges
-date_ranges = [
-    (day_before_yesterday, yesterday),
-    (ten_days_ago, ten_days_ago),
-]
+yesterday = (now_est - timedelta(days=1)).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+start = yesterday - timedelta(days=LOOKBACK_DAYS)
 
-# Run main.py for each date range
-for start_date, end_date in date_ranges:
-    subprocess.run(["python3", "main.py", start_date, end_date])
+# Ingest only the days whose source changed and rebuild their country rows
+# and tiled copies;
+# the rolling averages and anomalies are planned by the workflow afterwards
+store = open_store(os.getenv("STORE_LOCATION", os.getenv("BUCKET_NAME", "no2-app-data")))
+Planner(store, start, yesterday).execute(stages=("ingest", "countries", "tiled"))
@@ -1,153 +1,102 @@
+import argparse
 import os
-import shutil
-import subprocess
-import pytz
-from datetime import datetime, timedelta
-from google.cloud import storage
 import sys
-
-# Configure timezone to EST
-est = pytz.timezone('US/Eastern')
-now_est = datetime.now(est)
+from datetime import datetime
+
+from sub.blob_store import open_store
+from sub import metrics, pipeline
+from sub.download_data import SourceUnavailable
+from sub.pipeline import (
+    est,
+    process_countries,
+    process_dates,
+    process_dates_pipelined,
+    process_day_pyramids,
+    process_tiled_days,
+)
+from sub.scheduler import parse_shard, shard_range
 
 # Environment variable for GCS bucket
 BUCKET_NAME = os.getenv("BUCKET_NAME", "no2-app-data")
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
-
-# Temporary local directories
-download_directory = "./downloads"  # Local folder within the container
-extracted_directory = os.path.join(download_directory, "extracted")  # Local folder for extracted files
-
-# GCS directory for processed data
-gcs_data_directory = "data"  # Path in the bucket
-
-# Ensure the local downloads directory exists
-os.makedirs(download_directory, exist_ok=True)
-
-# Parse input dates
-try:
-    start_date = est.localize(datetime.strptime(sys.argv[1], "%Y-%m-%d"))
-    end_date = est.localize(datetime.strptime(sys.argv[2], "%Y-%m-%d"))
-except IndexError:
-    print("Error: Please provide start_date and end_date in 'YYYY-MM-DD' format.")
-    sys.exit(1)
-except ValueError:
-    print("Error: Invalid date format. Use 'YYYY-MM-DD'.")
-    sys.exit(1)
-
-
-def upload_to_gcs(local_path, gcs_path):
-    """Uploads a file to GCS."""
-    blob = bucket.blob(gcs_path)
-    blob.upload_from_filename(local_path)
-    print(f"Uploaded {local_path} to gs://{BUCKET_NAME}/{gcs_path}")
-
-
-def process_dates():
-    """Process data for the given date range."""
-    current_date = start_date
-    while current_date <= end_date:
-        while True:
-            year = current_date.strftime("%Y")
-            month = current_date.strftime("%m")
-            day = current_date.strftime("%d")
-            formatted_date = f"{year}{month}{day}"
-            
-            is_nrt = (now_est - current_date).days < 10
-            extension = "_nrt" if is_nrt else ""
-            file_url = f"https://d1qb6yzwaaq4he.cloudfront.net/tropomi/no2/{year}/{month}/tropomi_no2_{year}{month}{day}{extension}.tar"
-            tar_file_name = f"tropomi_no2_{formatted_date}{extension}.tar"
-            tar_file_path = os.path.join(download_directory, tar_file_name)
+# Data store: the GCS bucket by default, or a local directory for benchmarking
+STORE_LOCATION = os.getenv("STORE_LOCATION", BUCKET_NAME)
 
-            # Step 1: Attempt to download the file
-            download_command = [
-                "python3",
-                "sub/download_data.py",
-                file_url,
-                download_directory,
-            ]
-            try:
-                subprocess.run(download_command, check=True)
-                print(f"Successfully downloaded data for {current_date.strftime('%Y-%m-%d')}.")
-                break  # Exit the loop after a successful download
-            except subprocess.CalledProcessError as e:
-                print(f"Error downloading {file_url}: {e}")
-                current_date += timedelta(days=1)
-                if current_date > end_date:
-                    print("Reached the end of the date range while trying to find a valid file.")
-                    return
-                print(f"Moving to the next date: {current_date.strftime('%Y-%m-%d')}")
-
-        # Step 2: Extract the .tar file
-        extract_command = [
-            "python3",
-            "sub/extract_data.py",
-            tar_file_path,
-            extracted_directory,
-        ]
-        try:
-            subprocess.run(extract_command, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error extracting files: {e}")
-            break
-
-        # Step 3: Convert .nc files to Parquet
-        parquet_file_name = f"d{formatted_date}.parquet"
-        make_parquet_command = [
-            "python3",
-            "sub/make_parquet.py",
-            BUCKET_NAME,
-            extracted_directory,
-            f"{gcs_data_directory}/days",
-            parquet_file_name
-        ]
-        try:
-            subprocess.run(make_parquet_command, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error creating Parquet file: {e}")
-            break
-
-        # Cleanup after processing the day's data
-        print(f"Cleaning up after {current_date.strftime('%Y-%m-%d')}...")
-        try:
-            shutil.rmtree(extracted_directory)
-            shutil.rmtree(download_directory)
-            print(f"Temporary files for {current_date.strftime('%Y-%m-%d')} deleted successfully.")
-        except Exception as e:
-            print(f"Error cleaning up temporary files for {current_date.strftime('%Y-%m-%d')}: {e}")
-
-        current_date += timedelta(days=1)
-
-
-def process_countries():
-    """Run make_countries.py to process country-level parquets."""
-    geojson_path = os.path.abspath("geojson/ne_110m_admin_0_countries.geojson")  # Resolve absolute path to GeoJSON
-
-    """Run make_countries.py to process country-level parquets."""
-    make_countries_command = [
-        "python3",
-        "sub/make_countries.py",
-        BUCKET_NAME,
-        f"{gcs_data_directory}/days",  # GCS folder with day Parquets
-        f"{gcs_data_directory}/countries",  # GCS folder for country Parquets
-        geojson_path,
-        start_date.strftime("%Y-%m-%d"),
-        end_date.strftime("%Y-%m-%d"),
-    ]
 
+def parse_date(value):
+    """Parses a 'YYYY-MM-DD' argument as an EST-localized datetime."""
     try:
-        subprocess.run(make_countries_command, check=True)
-        print("make_countries.py executed successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error running make_countries.py: {e}")
-        print(f"Command output:\n{e.stderr}")
+        return est.localize(datetime.strptime(value, "%Y-%m-%d"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid date format. Use 'YYYY-MM-DD'.")
+
+
+def parse_args(argv):
+    """Parses the command line: start and end dates plus optional pipelined-ingest settings."""
+    parser = argparse.ArgumentParser(description="Ingest daily TROPOMI NO2 data for a date range.")
+    parser.add_argument("start_date", type=parse_date, help="First date, YYYY-MM-DD")
+    parser.add_argument("end_date", type=parse_date, help="Last date, YYYY-MM-DD")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Overlap download, decode and upload across days (for backfills)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read .nc members straight from the tar stream instead of extracting to disk")
+    parser.add_argument("--compact", action="store_true",
+                        help="Write day files in the compact schema (integer coordinates, zstd, sorted)")
+    parser.add_argument("--download-workers", type=int, default=pipeline.DOWNLOAD_WORKERS)
+    parser.add_argument("--decode-days", type=int, default=pipeline.DECODE_DAYS,
+                        help="Days being decoded at the same time")
+    parser.add_argument("--decode-workers", type=int, default=pipeline.DECODE_WORKERS,
+                        help="Worker processes decoding orbits")
+    parser.add_argument("--upload-workers", type=int, default=pipeline.UPLOAD_WORKERS)
+    parser.add_argument("--queue-depth", type=int, default=pipeline.QUEUE_DEPTH,
+                        help="Days allowed to wait between two stages")
+    parser.add_argument("--shard", default="0/1",
+                        help="INDEX/COUNT: ingest only this share of the range; "
+                             "'batch' takes it from the Cloud Batch task index (see sub.scheduler)")
+    parser.add_argument("--country-workers", type=int, default=pipeline.COUNTRY_WORKERS,
+                        help="Days aggregated to countries in parallel")
+    parser.add_argument("--tiled", action="store_true",
+                        help="Also write the date/tile-partitioned copy of the days for regional reads")
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
+
 
 def main():
     """Main entry point for the script."""
-    process_dates()
-    process_countries()
+    args = parse_args(sys.argv[1:])
+    metrics.configure(args.metrics, args.profile)
+    shard_index, shards = parse_shard(args.shard)
+    shard = shard_range(args.start_date, args.end_date, shards, shard_index)
+    if shard is None:
+        print(f"Shard {shard_index} of {shards} has no dates")
+        return
+    args.start_date, args.end_date = shard
+    store = open_store(STORE_LOCATION)
+    unavailable = None
+    try:
+        if args.pipelined:
+            process_dates_pipelined(
+                store, args.start_date, args.end_date,
+                download_workers=args.download_workers,
+                decode_days=args.decode_days,
+                decode_workers=args.decode_workers,
+                upload_workers=args.upload_workers,
+                queue_depth=args.queue_depth,
+                stream=args.stream,
+                compact=args.compact,
+            )
+        else:
+            process_dates(store, args.start_date, args.end_date, stream=args.stream, compact=args.compact)
+    except SourceUnavailable as e:
+        # Finish the days that were ingested, then fail so the task is retried
+        unavailable = e
+    # Shards run at the same time, so only an unsharded run (e.g. the daily planner) compacts the country parts
+    process_countries(store, args.start_date, args.end_date, workers=args.country_workers, compact=shards == 1)
+    process_day_pyramids(store, args.start_date, args.end_date)
+    if args.tiled:
+        process_tiled_days(store, args.start_date, args.end_date)
+    if unavailable is not None:
+        raise unavailable
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
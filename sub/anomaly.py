@@ -0,0 +1,249 @@
+import argparse
+import io
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sub.blob_store import open_store
+from sub.grid import NCELLS, cell_ids
+
+# Inputs written by the rolling-average job, outputs and baseline state
+RA_PREFIX = "data/rolling_avgs/"
+ANOMALY_PREFIX = "data/anomalies/"
+STATE_PREFIX = "data/anomaly_state/"
+
+# A cell is scored once its baseline has this many days
+MIN_COUNT = 30
+# |z| at or above this flags an anomaly
+Z_THRESHOLD = 3.0
+
+# Anomaly files uploaded together in range mode
+OUTPUT_BATCH = 16
+
+ANOMALY_SCHEMA = pa.schema(
+    [
+        ("lat_bin", pa.float32()),
+        ("lon_bin", pa.float32()),
+        ("date", pa.timestamp("us")),
+        ("no2", pa.float32()),
+        ("no2_ra", pa.float32()),
+        ("deviation", pa.float32()),
+        ("z", pa.float32()),
+        ("z_season", pa.float32()),
+        ("anomaly", pa.bool_()),
+    ]
+)
+
+
+class Baseline:
+    """
+    Per-cell running mean and variance (Welford), as dense arrays.
+
+    Saved sparsely in float32, holding only the cells seen so far.
+    `last_date` is the latest day folded in, so a day is never counted twice.
+    """
+
+    def __init__(self, count, mean, m2, last_date=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.last_date = last_date
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(NCELLS, np.uint16), np.zeros(NCELLS), np.zeros(NCELLS))
+
+    def zscore(self, cells, values):
+        """Returns the z-scores of `values`, NaN where the baseline has fewer than MIN_COUNT days."""
+        count = self.count[cells].astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(self.m2[cells] / (count - 1))
+            z = (values - self.mean[cells]) / std
+        z[(count < MIN_COUNT) | ~(std > 0)] = np.nan
+        return z
+
+    def update(self, cells, values, date):
+        """Folds one day in; `cells` must be unique."""
+        count = self.count[cells] + 1
+        delta = values - self.mean[cells]
+        mean = self.mean[cells] + delta / count
+        self.m2[cells] += delta * (values - mean)
+        self.mean[cells] = mean
+        self.count[cells] = count
+        self.last_date = date
+
+    def to_bytes(self):
+        cells = np.flatnonzero(self.count).astype(np.int32)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            last_date=np.array(self.last_date or ""),
+            cells=cells,
+            count=self.count[cells],
+            mean=self.mean[cells].astype(np.float32),
+            m2=self.m2[cells].astype(np.float32),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        saved = np.load(io.BytesIO(data), allow_pickle=False)
+        baseline = cls.empty()
+        baseline.last_date = str(saved["last_date"]) or None
+        cells = saved["cells"]
+        baseline.count[cells] = saved["count"]
+        baseline.mean[cells] = saved["mean"]
+        baseline.m2[cells] = saved["m2"]
+        return baseline
+
+
+class AnomalyState:
+    """
+    Baselines of one store: the deviation from the rolling average, and a
+    monthly climatology of the rolling average itself.
+
+    Only the climatology months in use are loaded; changed baselines are
+    written back by `save`.
+    """
+
+    def __init__(self, store, prefix=STATE_PREFIX):
+        self.store = store
+        self.prefix = prefix
+        self.loaded = {}
+        self.dirty = set()
+
+    def _key(self, name):
+        return f"{self.prefix}{name}.npz"
+
+    def get(self, name):
+        if name not in self.loaded:
+            key = self._key(name)
+            self.loaded[name] = Baseline.from_bytes(self.store.get(key)) if self.store.exists(key) else Baseline.empty()
+        return self.loaded[name]
+
+    def deviation(self):
+        return self.get("deviation")
+
+    def season(self, date):
+        return self.get(f"clim_{date.month:02d}")
+
+    def mark(self, name):
+        self.dirty.add(name)
+
+    def save(self):
+        self.store.put_many({self._key(name): self.loaded[name].to_bytes() for name in sorted(self.dirty)})
+        for name in sorted(self.dirty):
+            print(f"💾 Baseline {name} saved at {self.loaded[name].last_date}")
+        self.dirty.clear()
+
+
+def read_ra(store, date):
+    """Reads one day of rolling averages, or returns None if it was not computed."""
+    key = f"{RA_PREFIX}ra_{date.strftime('%Y%m%d')}.parquet"
+    if not store.exists(key):
+        return None
+    with store.open(key) as source:
+        return pq.read_table(source, columns=["lat_bin", "lon_bin", "no2", "no2_ra"])
+
+
+def score_day(state, date, table, update=True):
+    """
+    Scores one day against the baselines, then folds it into them.
+
+    Scores use the baselines as they were before the day, so an anomaly does
+    not dampen itself. A baseline already at or past `date` is left
+    untouched, so reruns and backfills never count a day twice (a rerun is
+    scored against the baseline that already includes the day).
+
+    Args:
+        state (AnomalyState): Baselines to score against.
+        date (datetime): Day being scored.
+        table (pyarrow.Table): The day's rolling averages (see `read_ra`).
+        update (bool): Fold the day into the baselines.
+
+    Returns:
+        pyarrow.Table: One row per cell, in ANOMALY_SCHEMA.
+    """
+    lat_bin = table.column("lat_bin").to_numpy()
+    lon_bin = table.column("lon_bin").to_numpy()
+    no2 = table.column("no2").to_numpy().astype(np.float64)
+    no2_ra = table.column("no2_ra").to_numpy().astype(np.float64)
+    cells = cell_ids(lat_bin, lon_bin)
+    deviation = no2 - no2_ra
+
+    day = date.strftime("%Y-%m-%d")
+    baselines = (("deviation", state.deviation(), deviation), (f"clim_{date.month:02d}", state.season(date), no2_ra))
+    z, z_season = (baseline.zscore(cells, values) for _, baseline, values in baselines)
+    if update:
+        for name, baseline, values in baselines:
+            if baseline.last_date is None or baseline.last_date < day:
+                baseline.update(cells, values, day)
+                state.mark(name)
+
+    return pa.table(
+        {
+            "lat_bin": lat_bin.astype(np.float32),
+            "lon_bin": lon_bin.astype(np.float32),
+            "date": np.full(len(cells), np.datetime64(date, "us")),
+            "no2": no2.astype(np.float32),
+            "no2_ra": no2_ra.astype(np.float32),
+            "deviation": deviation.astype(np.float32),
+            "z": z.astype(np.float32),
+            "z_season": z_season.astype(np.float32),
+            "anomaly": np.abs(np.nan_to_num(z)) >= Z_THRESHOLD,
+        },
+        schema=ANOMALY_SCHEMA,
+    )
+
+
+def process_anomalies(store, start_date, end_date, update=True):
+    """
+    Scores every day in a range and writes data/anomalies/an_YYYYMMDD.parquet.
+
+    The baselines are loaded once, carried through the range in memory and
+    saved at the end, so a backfill reads each rolling-average file once.
+
+    Args:
+        store (BlobStore): Store holding the rolling averages; receives the
+            anomalies and the baselines.
+        start_date (datetime): First date.
+        end_date (datetime): Last date.
+        update (bool): Fold the days into the baselines; False only scores.
+    """
+    state = AnomalyState(store)
+    pending = {}
+    date = start_date
+    while date <= end_date:
+        table = read_ra(store, date)
+        if table is None:
+            print(f"⏭️ No rolling averages for {date.strftime('%Y-%m-%d')}")
+        else:
+            scored = score_day(state, date, table, update)
+            flagged = int(np.count_nonzero(scored.column("anomaly").to_numpy()))
+            print(f"🚩 {date.strftime('%Y-%m-%d')}: {flagged} of {scored.num_rows} cells flagged")
+            buffer = io.BytesIO()
+            pq.write_table(scored, buffer, compression="zstd")
+            pending[f"{ANOMALY_PREFIX}an_{date.strftime('%Y%m%d')}.parquet"] = buffer.getvalue()
+        if len(pending) >= OUTPUT_BATCH:
+            store.put_many(pending)
+            pending = {}
+        date += timedelta(days=1)
+    if pending:
+        store.put_many(pending)
+    if update:
+        state.save()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score daily rolling averages against per-cell baselines.")
+    parser.add_argument("start_date", help="YYYY-MM-DD")
+    parser.add_argument("end_date", nargs="?", help="YYYY-MM-DD, defaults to the start date")
+    parser.add_argument("--store", default=os.getenv("STORE_LOCATION", os.getenv("BUCKET_NAME", "no2-app-data")),
+                        help="GCS bucket name, gs:// URI or local directory")
+    parser.add_argument("--score-only", action="store_true", help="Do not update the baselines")
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start_date, "%Y-%m-%d")
+    end = datetime.strptime(args.end_date, "%Y-%m-%d") if args.end_date else start
+    process_anomalies(open_store(args.store), start, end, update=not args.score_only)
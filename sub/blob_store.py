@@ -0,0 +1,527 @@
+import base64
+import fcntl
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Default number of concurrent requests for the batched get/put helpers.
+DEFAULT_MAX_WORKERS = 16
+
+# How long a cached listing stays valid before the prefix is listed again.
+LISTING_TTL_SECONDS = 300
+
+
+class PreconditionFailed(Exception):
+    """Raised when a conditional write finds the object changed since it was read."""
+
+
+class ObjectInfo:
+    """Metadata of a stored object."""
+
+    def __init__(self, key, size, generation, md5):
+        self.key = key
+        self.size = size
+        self.generation = generation  # Changes on every write of the object
+        self.md5 = md5  # Hex digest of the contents
+
+    def __repr__(self):
+        return f"ObjectInfo({self.key!r}, size={self.size}, generation={self.generation})"
+
+
+class BlobStore:
+    """
+    Minimal object-store interface shared by every pipeline stage.
+
+    Keys are "/"-separated paths relative to the root of the store, e.g.
+    "data/days/d20241110.parquet". Subclasses implement the single-object
+    primitives; the batched helpers and the listing cache live here.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, listing_ttl=LISTING_TTL_SECONDS):
+        self.max_workers = max_workers
+        self.listing_ttl = listing_ttl
+        self._listing_cache = {}
+        self._listing_lock = threading.Lock()
+
+    def __getstate__(self):
+        # Stores are sent to worker processes; the listing cache stays behind
+        state = self.__dict__.copy()
+        state["_listing_cache"] = {}
+        del state["_listing_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._listing_lock = threading.Lock()
+
+    # ── Primitives implemented by backends ──
+
+    def get(self, key):
+        """Returns the full contents of `key` as bytes."""
+        raise NotImplementedError
+
+    def put(self, key, data, content_type="application/octet-stream"):
+        """Writes `data` (bytes or a binary file object) to `key`."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        """Returns True if `key` exists."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Deletes `key` if it exists."""
+        raise NotImplementedError
+
+    def size(self, key):
+        """Returns the size of `key` in bytes."""
+        raise NotImplementedError
+
+    def open(self, key):
+        """
+        Opens `key` for reading as a seekable binary file object.
+
+        Reads are served with ranged requests, so pyarrow/polars can fetch the
+        Parquet footer and only the column chunks they need.
+        """
+        raise NotImplementedError
+
+    def open_write(self, key, content_type="application/octet-stream"):
+        """
+        Opens `key` for writing as a binary file object.
+
+        Data is uploaded while it is written; the object appears once the file
+        is closed. Use as a context manager.
+        """
+        raise NotImplementedError
+
+    def uri(self, key):
+        """Returns a human-readable URI for `key`, used in log messages."""
+        raise NotImplementedError
+
+    def stat(self, key):
+        """Returns the ObjectInfo of `key`, or None if it does not exist."""
+        raise NotImplementedError
+
+    def get_versioned(self, key):
+        """
+        Returns the contents of `key` with the generation they belong to.
+
+        Returns:
+            tuple: (bytes, generation), or (None, None) if `key` does not exist.
+        """
+        raise NotImplementedError
+
+    def put_if_generation(self, key, data, generation, content_type="application/octet-stream"):
+        """
+        Writes `key` only if it is still at `generation` (None: only if it does not exist).
+
+        Raises:
+            PreconditionFailed: If another writer got there first.
+        """
+        raise NotImplementedError
+
+    def _list_keys(self, prefix):
+        raise NotImplementedError
+
+    # ── Listing cache ──
+
+    def list(self, prefix, refresh=False):
+        """
+        Returns the sorted keys under `prefix`.
+
+        Listings are cached for `listing_ttl` seconds and kept up to date with
+        writes and deletes made through this store.
+        """
+        now = time.monotonic()
+        with self._listing_lock:
+            cached = self._listing_cache.get(prefix)
+            if cached is not None and not refresh and now - cached[0] < self.listing_ttl:
+                return list(cached[1])
+
+        keys = sorted(self._list_keys(prefix))
+        with self._listing_lock:
+            self._listing_cache[prefix] = (now, keys)
+        return list(keys)
+
+    def _record_put(self, key):
+        # Keep cached listings current instead of dropping them, so a writer
+        # that checks existence through `list` does not trigger a re-list.
+        with self._listing_lock:
+            for prefix, (_, keys) in self._listing_cache.items():
+                if key.startswith(prefix) and key not in keys:
+                    keys.append(key)
+                    keys.sort()
+
+    def _record_delete(self, key):
+        with self._listing_lock:
+            for _, keys in self._listing_cache.values():
+                if key in keys:
+                    keys.remove(key)
+
+    # ── Batched helpers ──
+
+    def get_many(self, keys, max_workers=None):
+        """
+        Downloads several objects concurrently.
+
+        Args:
+            keys (list): Keys to fetch.
+            max_workers (int): Concurrency limit, defaults to the store's.
+
+        Returns:
+            dict: Mapping of key -> bytes, in the order of `keys`.
+        """
+        keys = list(keys)
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            contents = list(executor.map(self.get, keys))
+        return dict(zip(keys, contents))
+
+    def put_many(self, items, max_workers=None, content_type="application/octet-stream"):
+        """
+        Uploads several objects concurrently.
+
+        Args:
+            items (dict or list): Mapping or (key, data) pairs to upload.
+            max_workers (int): Concurrency limit, defaults to the store's.
+            content_type (str): Content type set on every object.
+        """
+        pairs = list(items.items()) if isinstance(items, dict) else list(items)
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            futures = [executor.submit(self.put, key, data, content_type) for key, data in pairs]
+            for future in futures:
+                future.result()
+
+    def exists_many(self, keys, max_workers=None):
+        """Returns a mapping of key -> bool, checked concurrently."""
+        keys = list(keys)
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            flags = list(executor.map(self.exists, keys))
+        return dict(zip(keys, flags))
+
+    def stat_many(self, keys, max_workers=None):
+        """Returns a mapping of key -> ObjectInfo (None if missing), fetched concurrently."""
+        keys = list(keys)
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            infos = list(executor.map(self.stat, keys))
+        return dict(zip(keys, infos))
+
+
+class _LocalWriter(io.FileIO):
+    """Writes to a temporary file that replaces the destination on a clean close."""
+
+    def __init__(self, path, on_commit):
+        self._final_path = path
+        self._tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        self._on_commit = on_commit
+        super().__init__(self._tmp_path, "wb")
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        os.replace(self._tmp_path, self._final_path)
+        self._on_commit()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Drop the partial file and leave any existing object untouched
+            super().close()
+            os.remove(self._tmp_path)
+            return False
+        self.close()
+        return False
+
+
+class _GCSWriter:
+    """Wraps a BlobWriter so the put is recorded only once the upload has completed."""
+
+    def __init__(self, writer, on_commit):
+        self._writer = writer
+        self._on_commit = on_commit
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+    def close(self):
+        if self._writer.closed:
+            return
+        self._writer.close()
+        self._on_commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Leave the resumable upload unfinished, so the object is never created or replaced
+            return False
+        self.close()
+        return False
+
+
+# Digests of local files, keyed by (path, inode, size, mtime_ns): writes replace
+# files, so any change gives a new inode and the digest is computed again
+_DIGEST_CACHE_SIZE = 4096
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+class LocalStore(BlobStore):
+    """Stores objects as files under a local directory."""
+
+    def __init__(self, root, **kwargs):
+        super().__init__(**kwargs)
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def get(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def put(self, key, data, content_type="application/octet-stream"):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename so readers never see partial objects.
+        tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                while True:
+                    chunk = data.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+        self._record_put(key)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        self._record_delete(key)
+
+    def size(self, key):
+        return os.path.getsize(self._path(key))
+
+    def open(self, key):
+        return open(self._path(key), "rb")
+
+    def open_write(self, key, content_type="application/octet-stream"):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return _LocalWriter(path, lambda: self._record_put(key))
+
+    def uri(self, key):
+        return self._path(key)
+
+    # Local generations are content digests: file timestamps are too coarse
+    # to tell two quick writes apart, and an unchanged digest means unchanged data.
+    # Each file is hashed once per process, until it is replaced.
+
+    def _digest(self, path):
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cache_key = (path, info.st_ino, info.st_size, info.st_mtime_ns)
+        with _digests_lock:
+            if cache_key in _digests:
+                return _digests[cache_key]
+        digest = hashlib.md5()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            return None
+        with _digests_lock:
+            if len(_digests) >= _DIGEST_CACHE_SIZE:
+                _digests.clear()
+            _digests[cache_key] = digest.hexdigest()
+        return digest.hexdigest()
+
+    def stat(self, key):
+        path = self._path(key)
+        md5 = self._digest(path)
+        if md5 is None:
+            return None
+        return ObjectInfo(key, os.path.getsize(path), md5, md5)
+
+    def get_versioned(self, key):
+        try:
+            data = self.get(key)
+        except FileNotFoundError:
+            return None, None
+        return data, hashlib.md5(data).hexdigest()
+
+    def put_if_generation(self, key, data, generation, content_type="application/octet-stream"):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Writers of one key serialize on a lock file (skipped by listings, like temporaries)
+        with open(f"{path}.tmp.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._digest(path) != generation:
+                raise PreconditionFailed(self.uri(key))
+            self.put(key, data, content_type)
+
+    def _list_keys(self, prefix):
+        # Walk only the deepest directory implied by the prefix.
+        base_dir = os.path.dirname(self._path(prefix)) if not prefix.endswith("/") else self._path(prefix)
+        if not os.path.isdir(base_dir):
+            return []
+        keys = []
+        for dirpath, _, filenames in os.walk(base_dir):
+            for filename in filenames:
+                if ".tmp." in filename:
+                    continue
+                rel = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                key = rel.replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return keys
+
+
+@lru_cache(maxsize=None)
+def get_gcs_client(pool_size=DEFAULT_MAX_WORKERS * 2):
+    """
+    Returns a process-wide Google Cloud Storage client.
+
+    Authentication happens once per process, and the underlying HTTP session is
+    given a connection pool large enough for the batched helpers.
+    """
+    from google.cloud import storage
+    from requests.adapters import HTTPAdapter
+
+    client = storage.Client()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    client._http.mount("https://", adapter)
+    return client
+
+
+class GCSStore(BlobStore):
+    """Stores objects in a Google Cloud Storage bucket."""
+
+    # Read chunk size for ranged reads through `open`.
+    READ_CHUNK_SIZE = 8 * 1024 * 1024
+    # Upload chunk size for resumable uploads through `open_write`.
+    WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, bucket_name, client=None, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client or get_gcs_client()
+        self.bucket_name = bucket_name
+        self.bucket = self.client.bucket(bucket_name)
+
+    def __getstate__(self):
+        # Clients cannot be pickled; each process uses its own
+        state = super().__getstate__()
+        del state["client"], state["bucket"]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.client = get_gcs_client()
+        self.bucket = self.client.bucket(self.bucket_name)
+
+    def get(self, key):
+        return self.bucket.blob(key).download_as_bytes()
+
+    def put(self, key, data, content_type="application/octet-stream"):
+        blob = self.bucket.blob(key)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            blob.upload_from_string(bytes(data), content_type=content_type)
+        else:
+            blob.upload_from_file(data, content_type=content_type)
+        self._record_put(key)
+
+    def exists(self, key):
+        return self.bucket.blob(key).exists()
+
+    def delete(self, key):
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self.bucket.blob(key).delete()
+        except NotFound:
+            pass
+        self._record_delete(key)
+
+    def size(self, key):
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            raise FileNotFoundError(self.uri(key))
+        return blob.size
+
+    def open(self, key):
+        return self.bucket.blob(key).open("rb", chunk_size=self.READ_CHUNK_SIZE)
+
+    def open_write(self, key, content_type="application/octet-stream"):
+        # ignore_flush lets pyarrow flush without forcing a chunk upload
+        writer = self.bucket.blob(key).open(
+            "wb", chunk_size=self.WRITE_CHUNK_SIZE, content_type=content_type, ignore_flush=True
+        )
+        return _GCSWriter(writer, lambda: self._record_put(key))
+
+    def uri(self, key):
+        return f"gs://{self.bucket_name}/{key}"
+
+    def stat(self, key):
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None
+        md5 = base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+        return ObjectInfo(key, blob.size, blob.generation, md5)
+
+    def get_versioned(self, key):
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None, None
+        # Pin the download to the generation just looked up
+        return blob.download_as_bytes(if_generation_match=blob.generation), blob.generation
+
+    def put_if_generation(self, key, data, generation, content_type="application/octet-stream"):
+        from google.api_core import exceptions
+
+        # A generation of 0 means the object must not exist yet
+        try:
+            self.bucket.blob(key).upload_from_string(
+                bytes(data), content_type=content_type, if_generation_match=generation or 0
+            )
+        except exceptions.PreconditionFailed:
+            raise PreconditionFailed(self.uri(key))
+        self._record_put(key)
+
+    def _list_keys(self, prefix):
+        return [blob.name for blob in self.client.list_blobs(self.bucket_name, prefix=prefix)]
+
+
+def open_store(location):
+    """
+    Opens a store from a location string.
+
+    Args:
+        location (str): "gs://<bucket>", "file://<dir>", a local directory path,
+            or a bare bucket name.
+
+    Returns:
+        BlobStore: The matching backend.
+    """
+    if location.startswith("gs://"):
+        return GCSStore(location[len("gs://"):].rstrip("/"))
+    if location.startswith("file://"):
+        return LocalStore(location[len("file://"):])
+    if os.sep in location or location.startswith("."):
+        return LocalStore(location)
+    return GCSStore(location)
@@ -0,0 +1,190 @@
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import pyarrow.parquet as pq
+from sub.blob_store import PreconditionFailed, open_store
+from sub.day_format import schema_version
+
+# One JSON document listing every ingested day, keyed by "YYYY-MM-DD"
+CATALOG_KEY = "data/catalog/days.json"
+DAYS_PREFIX = "data/days/"
+
+# Conditional writes retried this many times when another writer wins the race
+MAX_ATTEMPTS = 10
+
+
+def _date_str(value):
+    """Normalizes a datetime, "YYYY-MM-DD" or "YYYYMMDD" to "YYYY-MM-DD"."""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    if len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d").strftime("%Y-%m-%d")
+    return value
+
+
+class DayCatalog:
+    """
+    In-memory view of the day catalog.
+
+    Each entry is a dict with date, key, nrt, rows, bytes, schema_version and
+    md5 (content hash reported by the store), plus grid_key when the gridded
+    product was written and source ({"url", "etag"} of the tar it was built
+    from) when ingest recorded it.
+    """
+
+    def __init__(self, entries, generation=None):
+        self.entries = entries
+        self.generation = generation
+
+    @classmethod
+    def load(cls, store, key=CATALOG_KEY):
+        """Reads the catalog; an empty one (with `exists` False) if none was written yet."""
+        data, generation = store.get_versioned(key)
+        if data is None:
+            return cls({})
+        return cls(json.loads(data)["days"], generation)
+
+    @property
+    def exists(self):
+        return self.generation is not None
+
+    def get(self, date):
+        """Returns the entry of a date, or None if the day is not available."""
+        return self.entries.get(_date_str(date))
+
+    def range(self, start_date, end_date):
+        """
+        Returns the entries between two dates (inclusive), in date order.
+
+        Looks up each date in the range, so the cost does not depend on the
+        size of the archive.
+        """
+        start = datetime.strptime(_date_str(start_date), "%Y-%m-%d")
+        end = datetime.strptime(_date_str(end_date), "%Y-%m-%d")
+        entries = []
+        while start <= end:
+            entry = self.entries.get(start.strftime("%Y-%m-%d"))
+            if entry is not None:
+                entries.append(entry)
+            start += timedelta(days=1)
+        return entries
+
+    def to_bytes(self):
+        days = dict(sorted(self.entries.items()))
+        return json.dumps({"days": days}, indent=1).encode()
+
+
+def describe_day(store, key, date, nrt=False, grid_key=None, source=None):
+    """
+    Builds the catalog entry of a day file already in the store.
+
+    Only the Parquet footer is read; size and hash come from the store's metadata.
+
+    Args:
+        store (BlobStore): Store holding the day file.
+        key (str): Key of the day file.
+        date: Date of the day (datetime or string).
+        nrt (bool): Whether the file was built from the near-real-time product.
+        grid_key (str): Key of the gridded day product, if one was written.
+        source (dict): URL and ETag of the tar the file was built from.
+
+    Returns:
+        dict: The catalog entry.
+    """
+    info = store.stat(key)
+    if info is None:
+        raise FileNotFoundError(store.uri(key))
+    with store.open(key) as day_file:
+        parquet_file = pq.ParquetFile(day_file)
+        rows = parquet_file.metadata.num_rows
+        version = schema_version(parquet_file.schema_arrow)
+    entry = {
+        "date": _date_str(date),
+        "key": key,
+        "nrt": nrt,
+        "rows": rows,
+        "bytes": info.size,
+        "schema_version": version,
+        "md5": info.md5,
+    }
+    if grid_key is not None:
+        entry["grid_key"] = grid_key
+    if source is not None:
+        entry["source"] = source
+    return entry
+
+
+def update_catalog(store, update, key=CATALOG_KEY):
+    """
+    Applies `update` to the catalog and writes it back atomically.
+
+    The write only succeeds if nobody changed the catalog since it was read;
+    otherwise the catalog is re-read and `update` applied again.
+
+    Args:
+        store (BlobStore): Store holding the catalog.
+        update (callable): Modifies the `entries` dict of a DayCatalog in place.
+        key (str): Key of the catalog.
+
+    Returns:
+        DayCatalog: The catalog as written.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        catalog = DayCatalog.load(store, key)
+        update(catalog.entries)
+        try:
+            store.put_if_generation(key, catalog.to_bytes(), catalog.generation, "application/json")
+            return catalog
+        except PreconditionFailed:
+            print(f"Catalog changed while updating (attempt {attempt + 1}), retrying")
+            # Jittered backoff so concurrent ingest tasks do not collide again
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise PreconditionFailed(f"Could not update {store.uri(key)} after {MAX_ATTEMPTS} attempts")
+
+
+def record_days(store, entries, key=CATALOG_KEY):
+    """Adds or replaces catalog entries (see `describe_day`)."""
+    return update_catalog(store, lambda days: days.update({entry["date"]: entry for entry in entries}), key)
+
+
+def rebuild_catalog(store, days_prefix=DAYS_PREFIX, key=CATALOG_KEY, max_workers=16):
+    """
+    Rebuilds the catalog from one listing of the day files.
+
+    Used once to seed the catalog for an existing archive, or to repair it.
+    The NRT flag and the source cannot be recovered from a day file and are
+    kept from the previous catalog where present.
+
+    Returns:
+        DayCatalog: The catalog as written.
+    """
+    keys = [k for k in store.list(days_prefix, refresh=True) if k.endswith(".parquet")]
+    previous = DayCatalog.load(store, key)
+
+    def describe(day_key):
+        date = _date_str(day_key.split("/")[-1][1:9])
+        old = previous.get(date) or {}
+        return describe_day(store, day_key, date, old.get("nrt", False), old.get("grid_key"), old.get("source"))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        entries = list(executor.map(describe, keys))
+    print(f"Described {len(entries)} day files under {days_prefix}")
+    return update_catalog(store, lambda days: (days.clear(), days.update({e["date"]: e for e in entries})), key)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[2] not in ("rebuild", "show"):
+        print("Usage: python3 -m sub.catalog <BUCKET_NAME|STORE_DIR> <rebuild|show>")
+        sys.exit(1)
+
+    store = open_store(sys.argv[1])
+    if sys.argv[2] == "rebuild":
+        catalog = rebuild_catalog(store)
+    else:
+        catalog = DayCatalog.load(store)
+    for date, entry in sorted(catalog.entries.items()):
+        print(f"{date}: {entry['rows']} rows, {entry['bytes']} bytes, v{entry['schema_version']}"
+              f"{' (nrt)' if entry['nrt'] else ''}")
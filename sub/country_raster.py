@@ -0,0 +1,149 @@
+import hashlib
+import os
+import numpy as np
+import shapely
+from sub.disk_cache import CACHE_DIR
+
+# Raster cells are [lat, lat + RESOLUTION) x [lon, lon + RESOLUTION), starting at -90/-180
+DEFAULT_RESOLUTION = 0.1
+
+# Cell codes besides country indices
+OUTSIDE = -1  # No country touches the cell
+BORDER = -2  # A country boundary crosses the cell; points need an exact test
+
+# Bumped when the raster layout changes, so stale caches are not reused
+RASTER_VERSION = 1
+
+
+class CountryRaster:
+    """
+    Cell -> country lookup built from a polygon set.
+
+    Cells entirely inside one country hold its index into `names`; only points
+    in cells crossed by a boundary are tested against the polygons.
+    """
+
+    def __init__(self, codes, names, polygons, polygon_codes, resolution):
+        self.codes = codes
+        self.names = names
+        self.polygons = polygons
+        self.polygon_codes = polygon_codes
+        self.resolution = resolution
+        self._tree = None
+
+    def _indices(self, latitude, longitude):
+        nlat, nlon = self.codes.shape
+        rows = np.clip(np.floor((np.asarray(latitude, dtype=np.float64) + 90) / self.resolution), 0, nlat - 1)
+        cols = np.clip(np.floor((np.asarray(longitude, dtype=np.float64) + 180) / self.resolution), 0, nlon - 1)
+        return rows.astype(np.intp), cols.astype(np.intp)
+
+    def assign(self, latitude, longitude):
+        """
+        Returns the country index of each point, or OUTSIDE.
+
+        Matches a "within" spatial join: points on a boundary belong to no
+        country.
+
+        Args:
+            latitude (ndarray): Latitudes in degrees.
+            longitude (ndarray): Longitudes in degrees.
+
+        Returns:
+            ndarray: int32 indices into `names`, OUTSIDE (-1) for no country.
+        """
+        rows, cols = self._indices(latitude, longitude)
+        ids = self.codes[rows, cols].astype(np.int32)
+
+        border = np.flatnonzero(ids == BORDER)
+        ids[border] = OUTSIDE
+        if len(border):
+            if self._tree is None:
+                self._tree = shapely.STRtree(self.polygons)
+            points = shapely.points(np.asarray(longitude)[border], np.asarray(latitude)[border])
+            point_index, polygon_index = self._tree.query(points, predicate="within")
+            ids[border[point_index]] = self.polygon_codes[polygon_index]
+        return ids
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_codes(polygons, polygon_codes, resolution=DEFAULT_RESOLUTION):
+    """
+    Classifies every raster cell as inside one country, outside all, or on a border.
+
+    Works one latitude row at a time with vectorized shapely queries: cells
+    intersecting a boundary are BORDER, the rest take the country containing
+    their center.
+
+    Args:
+        polygons (ndarray): Country geometries.
+        polygon_codes (ndarray): Country index of each geometry.
+        resolution (float): Cell size in degrees.
+
+    Returns:
+        ndarray: int16 codes of shape (180 / resolution, 360 / resolution).
+    """
+    nlat = int(round(180 / resolution))
+    nlon = int(round(360 / resolution))
+    codes = np.full((nlat, nlon), OUTSIDE, dtype=np.int16)
+
+    boundary_tree = shapely.STRtree(shapely.boundary(polygons))
+    polygon_tree = shapely.STRtree(polygons)
+    west = -180 + np.arange(nlon) * resolution
+    east = west + resolution
+    center_lon = west + resolution / 2
+
+    for row in range(nlat):
+        south = -90 + row * resolution
+        boxes = shapely.box(west, south, east, south + resolution)
+        border_cells = np.unique(boundary_tree.query(boxes, predicate="intersects")[0])
+
+        centers = shapely.points(center_lon, np.full(nlon, south + resolution / 2))
+        cell_index, polygon_index = polygon_tree.query(centers, predicate="within")
+        codes[row, cell_index] = polygon_codes[polygon_index]
+        codes[row, border_cells] = BORDER
+    return codes
+
+
+def load_country_raster(world, geojson_path, name_field="NAME", resolution=DEFAULT_RESOLUTION, cache_dir=CACHE_DIR):
+    """
+    Returns the country raster for a GeoJSON file, building it on first use.
+
+    The raster is cached on disk under a key made of the file's SHA-256, the
+    name field and the resolution, so editing the GeoJSON invalidates it.
+
+    Args:
+        world (GeoDataFrame): Country geometries loaded from `geojson_path`.
+        geojson_path (str): Path of the GeoJSON file, used for the cache key.
+        name_field (str): Column holding the country name.
+        resolution (float): Cell size in degrees.
+        cache_dir (str): Directory for cached rasters.
+
+    Returns:
+        CountryRaster: The lookup, with one entry per distinct country name.
+    """
+    names, polygon_codes = np.unique(world[name_field].astype(str).to_numpy(), return_inverse=True)
+    polygon_codes = polygon_codes.astype(np.int32)
+    polygons = world.geometry.to_numpy()
+
+    key = f"{_file_digest(geojson_path)[:16]}_{name_field}_{resolution}_v{RASTER_VERSION}"
+    cache_path = os.path.join(cache_dir, f"country_raster_{key}.npz")
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path, allow_pickle=False)
+        codes = cached["codes"]
+    else:
+        print(f"Building country raster for {geojson_path} at {resolution}°...")
+        codes = build_codes(polygons, polygon_codes, resolution)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp.{os.getpid()}.npz"
+        np.savez_compressed(tmp_path, codes=codes)
+        os.replace(tmp_path, cache_path)
+        print(f"Country raster cached at {cache_path}")
+
+    return CountryRaster(codes, names, polygons, polygon_codes, resolution)
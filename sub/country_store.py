@@ -0,0 +1,214 @@
+import random
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+import pandas as pd
+from sub.blob_store import PreconditionFailed
+
+# Country rows are appended as one Parquet part per run and year:
+#   <countries_folder>/year=YYYY/part-<run_id>.parquet
+# Run ids sort by creation time, so when a (Country, Date) pair appears in
+# several parts the row from the greatest run id wins.
+PART_PATTERN = re.compile(r"year=(\d{4})/part-([^/]+)\.parquet$")
+
+# Compact a year once it holds more parts than this
+COMPACT_THRESHOLD = 32
+
+COLUMNS = ["Country", "Date", "NO2", "Count"]
+
+# Conditional writes of a per-country file before giving up, and files written at a time
+MAX_ATTEMPTS = 10
+EXPORT_WORKERS = 16
+
+
+def new_run_id():
+    """Returns a unique run id that sorts by creation time."""
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def part_key(countries_folder, year, run_id):
+    return f"{countries_folder}/year={year}/part-{run_id}.parquet"
+
+
+def list_parts(store, countries_folder, years=None):
+    """
+    Lists the country parts in the store.
+
+    Args:
+        store (BlobStore): Store holding the country parts.
+        countries_folder (str): Prefix of the country store.
+        years (iterable): Only list these years, defaults to all.
+
+    Returns:
+        dict: year (int) -> list of (run_id, key), sorted by run id.
+    """
+    parts = {}
+    for key in store.list(f"{countries_folder}/year="):
+        match = PART_PATTERN.search(key)
+        if match is None:
+            continue
+        year = int(match.group(1))
+        if years is None or year in years:
+            parts.setdefault(year, []).append((match.group(2), key))
+    return {year: sorted(entries) for year, entries in parts.items()}
+
+
+def _to_bytes(frame):
+    buffer = BytesIO()
+    frame.to_parquet(buffer, index=False, compression="zstd")
+    return buffer.getvalue()
+
+
+def _latest(frames):
+    """Concatenates parts in run order and keeps the last row of each (Country, Date)."""
+    if not frames:
+        return pd.DataFrame(columns=COLUMNS)
+    combined = pd.concat(frames, ignore_index=True)
+    combined = combined.drop_duplicates(subset=["Country", "Date"], keep="last")
+    return combined.sort_values(["Country", "Date"]).reset_index(drop=True)
+
+
+def write_run(store, countries_folder, rows, run_id=None):
+    """
+    Appends the rows of one run to the store, one new part per year.
+
+    Existing parts are never rewritten, so concurrent runs cannot lose each
+    other's rows.
+
+    Args:
+        store (BlobStore): Destination store.
+        countries_folder (str): Prefix of the country store.
+        rows (DataFrame): Country, Date ("YYYY-MM-DD"), NO2 and Count columns.
+        run_id (str): Id of the run, defaults to a new one.
+
+    Returns:
+        list: Keys of the parts written.
+    """
+    if rows.empty:
+        return []
+    run_id = run_id or new_run_id()
+    rows = rows[COLUMNS].sort_values(["Country", "Date"])
+    years = rows["Date"].str[:4].astype(int)
+    parts = {
+        part_key(countries_folder, year, run_id): _to_bytes(frame)
+        for year, frame in rows.groupby(years)
+    }
+    store.put_many(parts)
+    return sorted(parts)
+
+
+def read_countries(store, countries_folder, countries=None, years=None):
+    """
+    Reads the current country time series.
+
+    Args:
+        store (BlobStore): Store holding the country parts.
+        countries_folder (str): Prefix of the country store.
+        countries (iterable): Only return these countries, defaults to all.
+        years (iterable): Only read these years, defaults to all.
+
+    Returns:
+        DataFrame: One row per (Country, Date), sorted by country then date.
+    """
+    parts = list_parts(store, countries_folder, set(years) if years is not None else None)
+    keys = [key for year in sorted(parts) for _, key in parts[year]]
+    contents = store.get_many(keys)
+    filters = [("Country", "in", list(countries))] if countries is not None else None
+    frames = [pd.read_parquet(BytesIO(contents[key]), filters=filters) for key in keys]
+    return _latest(frames)
+
+
+def compact_year(store, countries_folder, year, parts=None):
+    """
+    Merges the parts of one year into a single part.
+
+    The merged part reuses the greatest run id of its inputs, so it is
+    ordered exactly as they were against parts written later. It replaces
+    that input in place before the others are deleted; a crash in between
+    only leaves superseded rows behind.
+
+    Args:
+        store (BlobStore): Store holding the country parts.
+        countries_folder (str): Prefix of the country store.
+        year (int): Year to compact.
+        parts (list): (run_id, key) pairs from `list_parts`, listed if None.
+
+    Returns:
+        str or None: Key of the merged part, or None if there was nothing to merge.
+    """
+    if parts is None:
+        parts = list_parts(store, countries_folder, {year}).get(year, [])
+    if len(parts) < 2:
+        return None
+
+    keys = [key for _, key in parts]
+    contents = store.get_many(keys)
+    merged = _latest([pd.read_parquet(BytesIO(contents[key])) for key in keys])
+    target = keys[-1]
+    store.put(target, _to_bytes(merged[COLUMNS]))
+    for key in keys[:-1]:
+        store.delete(key)
+    print(f"Compacted {len(keys)} country parts for {year} into {store.uri(target)}")
+    return target
+
+
+def compact(store, countries_folder, threshold=COMPACT_THRESHOLD):
+    """Compacts every year holding more than `threshold` parts."""
+    for year, parts in list_parts(store, countries_folder).items():
+        if len(parts) > threshold:
+            compact_year(store, countries_folder, year, parts)
+
+
+def legacy_key(countries_folder, country):
+    return f"{countries_folder}/{country.lower().replace(' ', '_')}.parquet"
+
+
+def _merge_legacy(old, new):
+    """Returns a per-country file's rows with the dates of `new` replaced."""
+    if old is not None:
+        old = pd.read_parquet(BytesIO(old))
+        new = pd.concat([old[~old["Date"].isin(new["Date"])], new], ignore_index=True)
+    new = new.sort_values(by="Date", key=lambda x: pd.to_datetime(x))
+    buffer = BytesIO()
+    new.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def _update_legacy(store, key, new):
+    """Merges rows into one per-country file with a conditional write, re-reading it if another run got there first."""
+    for attempt in range(MAX_ATTEMPTS):
+        data, generation = store.get_versioned(key)
+        if data is None and attempt == 0:
+            print(f"Country file does not exist in store: {key}")
+        try:
+            store.put_if_generation(key, _merge_legacy(data, new), generation)
+            return
+        except PreconditionFailed:
+            print(f"{store.uri(key)} changed while updating (attempt {attempt + 1}), retrying")
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+    raise PreconditionFailed(f"Could not update {store.uri(key)} after {MAX_ATTEMPTS} attempts")
+
+
+def export_legacy(store, countries_folder, rows):
+    """
+    Merges run results into the per-country files (NO2, Date) read by consumers.
+
+    Each touched country file is read and written back conditionally, so
+    runs exporting at the same time (e.g. the shards of a backfill) do not
+    lose each other's dates.
+
+    Args:
+        store (BlobStore): Store holding the country files.
+        countries_folder (str): Prefix of the country files.
+        rows (DataFrame): Country, Date and NO2 columns of the run.
+    """
+    if rows.empty:
+        return
+    updates = {legacy_key(countries_folder, country): frame[["NO2", "Date"]]
+               for country, frame in rows.groupby("Country")}
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        for future in [executor.submit(_update_legacy, store, key, new) for key, new in updates.items()]:
+            future.result()
@@ -0,0 +1,182 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Schema versions, recorded in the Parquet key-value metadata
+SCHEMA_VERSION_KEY = b"no2.schema_version"
+LEGACY_VERSION = 1  # float latitude/longitude/NO2 columns as written by pandas (no metadata)
+COMPACT_VERSION = 2  # integer coordinates, float32 NO2, zstd, sorted by latitude then longitude
+
+# Coordinates are stored as integers in units of 1e-4 degrees (~11 m)
+COORD_SCALE = 10000
+
+# Rows per row group in the compact format; small enough for useful min/max pruning
+ROW_GROUP_SIZE = 1_000_000
+
+# Column names seen by every reader, whatever the on-disk format
+LEGACY_COLUMNS = ["latitude", "longitude", "nitrogendioxide_tropospheric_column", "qa_value"]
+COMPACT_NAMES = {
+    "latitude": "lat",
+    "longitude": "lon",
+    "nitrogendioxide_tropospheric_column": "no2",
+    "qa_value": "qa_value",
+}
+
+COMPACT_SCHEMA = pa.schema(
+    [
+        ("lat", pa.int32()),
+        ("lon", pa.int32()),
+        ("no2", pa.float32()),
+        ("qa_value", pa.uint8()),
+    ],
+    metadata={SCHEMA_VERSION_KEY: str(COMPACT_VERSION).encode()},
+)
+
+
+def compact_columns(data):
+    """
+    Converts decoded pixel arrays to the compact column layout.
+
+    Args:
+        data (dict): Legacy column name -> numpy array, as returned by
+            `make_parquet.decode_orbit`.
+
+    Returns:
+        dict: Compact column name -> numpy array.
+    """
+    return {
+        "lat": np.round(data["latitude"] * COORD_SCALE).astype(np.int32),
+        "lon": np.round(data["longitude"] * COORD_SCALE).astype(np.int32),
+        "no2": data["nitrogendioxide_tropospheric_column"].astype(np.float32),
+        "qa_value": data["qa_value"].astype(np.uint8),
+    }
+
+
+def write_compact(parts, sink):
+    """
+    Writes compact columns as one sorted, zstd-compressed Parquet file.
+
+    Rows are sorted by latitude then longitude, so each row group covers a
+    narrow latitude band and its min/max statistics let readers skip it.
+
+    Args:
+        parts (list): Dicts from `compact_columns`, e.g. one per orbit.
+        sink: Path or writable binary file object.
+
+    Returns:
+        int: Number of rows written.
+    """
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in COMPACT_SCHEMA.names}
+    order = np.lexsort((columns["lon"], columns["lat"]))
+    table = pa.table({name: values[order] for name, values in columns.items()}, schema=COMPACT_SCHEMA)
+    pq.write_table(
+        table,
+        sink,
+        row_group_size=ROW_GROUP_SIZE,
+        compression="zstd",
+        use_dictionary=["qa_value"],
+        use_byte_stream_split=["no2"],
+        write_statistics=True,
+    )
+    return table.num_rows
+
+
+def schema_version(schema):
+    """Returns the schema version recorded in a Parquet/Arrow schema."""
+    metadata = schema.metadata or {}
+    return int(metadata.get(SCHEMA_VERSION_KEY, LEGACY_VERSION))
+
+
+def _physical_columns(version, columns):
+    if version == LEGACY_VERSION:
+        return list(columns)
+    return [COMPACT_NAMES[column] for column in columns]
+
+
+def normalize(table, version):
+    """
+    Converts a table in any schema version to the legacy column names and types.
+
+    Args:
+        table (pyarrow.Table or RecordBatch): Data as stored on disk.
+        version (int): Schema version of the data.
+
+    Returns:
+        pyarrow.Table: Columns named as in LEGACY_COLUMNS.
+    """
+    if isinstance(table, pa.RecordBatch):
+        table = pa.Table.from_batches([table])
+    if version == LEGACY_VERSION:
+        return table
+
+    reverse = {compact: legacy for legacy, compact in COMPACT_NAMES.items()}
+    arrays = []
+    names = []
+    for name in table.column_names:
+        column = table.column(name)
+        if name in ("lat", "lon"):
+            column = pc.divide(column.cast(pa.float32()), pa.scalar(COORD_SCALE, pa.float32()))
+        arrays.append(column)
+        names.append(reverse[name])
+    return pa.table(arrays, names=names)
+
+
+def bbox_filter(version, bbox):
+    """
+    Builds a pyarrow filter expression for a (min_lat, min_lon, max_lat, max_lon) box.
+
+    The expression is on the physical columns, so pyarrow can use row-group
+    statistics to skip data outside the box.
+    """
+    min_lat, min_lon, max_lat, max_lon = bbox
+    if version == LEGACY_VERSION:
+        lat, lon, scale = pc.field("latitude"), pc.field("longitude"), 1
+    else:
+        lat, lon, scale = pc.field("lat"), pc.field("lon"), COORD_SCALE
+    return (
+        (lat >= round(min_lat * scale)) & (lat <= round(max_lat * scale))
+        & (lon >= round(min_lon * scale)) & (lon <= round(max_lon * scale))
+    )
+
+
+def read_day(source, columns=None, bbox=None):
+    """
+    Reads a day Parquet file in either schema version.
+
+    Args:
+        source: Path or seekable binary file object (e.g. `BlobStore.open`).
+        columns (list): Legacy column names to read, defaults to all.
+        bbox (tuple): Optional (min_lat, min_lon, max_lat, max_lon) filter.
+
+    Returns:
+        pyarrow.Table: Columns named as in LEGACY_COLUMNS.
+    """
+    parquet_file = pq.ParquetFile(source)
+    version = schema_version(parquet_file.schema_arrow)
+    columns = list(columns or LEGACY_COLUMNS)
+    physical = _physical_columns(version, columns)
+    if bbox is None:
+        table = parquet_file.read(columns=physical)
+    else:
+        table = pq.read_table(source, columns=physical, filters=bbox_filter(version, bbox))
+    return normalize(table, version)
+
+
+def iter_day_batches(source, columns=None, batch_size=100000):
+    """
+    Iterates over a day Parquet file in either schema version, batch by batch.
+
+    Args:
+        source: Path or seekable binary file object (e.g. `BlobStore.open`).
+        columns (list): Legacy column names to read, defaults to all.
+        batch_size (int): Rows per batch.
+
+    Yields:
+        pyarrow.Table: Columns named as in LEGACY_COLUMNS.
+    """
+    parquet_file = pq.ParquetFile(source)
+    version = schema_version(parquet_file.schema_arrow)
+    physical = _physical_columns(version, list(columns or LEGACY_COLUMNS))
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=physical):
+        yield normalize(batch, version)
@@ -0,0 +1,375 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Local cache directory of derived data (country rasters, zonal weights, blobs).
+# Defined here, with no third-party imports, so the RA image can use the cache
+CACHE_DIR = os.getenv("NO2_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "no2"))
+
+# Content-addressed local cache of downloaded and derived bytes: raw tars,
+# day Parquet files and binned day frames. Entries are keyed by what
+# identifies the content upstream (URL and ETag, store URI and generation,
+# or the inputs of a derived frame) and point at a blob named by its SHA-256,
+# so identical content is stored once. A SQLite index (WAL mode) keeps the
+# entries, their last use and the hit/miss counters, so worker processes on
+# one machine share the cache safely. Least recently used entries are evicted
+# once the blobs exceed the byte budget.
+CACHE_ROOT = os.getenv("NO2_BLOB_CACHE_DIR", os.path.join(CACHE_DIR, "blobs"))
+
+# Byte budget; 0 (the default) disables the cache. Opt-in, as batch tasks
+# and Cloud Run keep their disk in memory: set it on machines with local disk
+CACHE_BUDGET = int(os.getenv("NO2_CACHE_BYTES", 0))
+
+COPY_BUFFER = 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, digest TEXT NOT NULL, last_used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+
+
+def _link_or_copy(source, destination):
+    """Hard-links a file where possible (same file system), copies it otherwise."""
+    tmp_path = f"{destination}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+class DiskCache:
+    """
+    LRU cache of immutable blobs on local disk, shared by the processes of one machine.
+
+    Callers must never modify files they get from the cache: `get_file` may
+    hand out a hard link to the cached blob.
+
+    Args:
+        root (str): Cache directory, holding index.sqlite and objects/.
+        budget (int): Bytes of blobs kept; 0 disables the cache.
+    """
+
+    def __init__(self, root=CACHE_ROOT, budget=CACHE_BUDGET):
+        self.root = root
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def __getstate__(self):
+        # Sent to worker processes: they open their own index connection
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        del state["_lock"], state["_thread"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+
+    def _db(self):
+        # One connection per process; a connection inherited through fork is not reused
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+            self._connection = sqlite3.connect(os.path.join(self.root, "index.sqlite"), timeout=60,
+                                               isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(_SCHEMA)
+            self._pid = os.getpid()
+        return self._connection
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _count(self, db, **counts):
+        for name, value in counts.items():
+            db.execute("INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                       (name, value, value))
+
+    def _lookup(self, key):
+        """Returns the blob path of a key and marks it used, or None on a miss."""
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT digest FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            return self._object_path(row[0]) if row else None
+
+    def _record(self, hit, size=0):
+        counts = self.thread_counts()
+        self._thread.counts = {"cache_hits": counts["cache_hits"] + hit, "cache_misses": counts["cache_misses"] + (not hit),
+                               "cache_hit_bytes": counts["cache_hit_bytes"] + size}
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.hit_bytes += size
+                self._count(self._db(), hits=1, hit_bytes=size)
+            else:
+                self.misses += 1
+                self._count(self._db(), misses=1)
+
+    def thread_counts(self):
+        """Returns the hits, misses and bytes served of the calling thread, e.g. to add to a span."""
+        return getattr(self._thread, "counts", {"cache_hits": 0, "cache_misses": 0, "cache_hit_bytes": 0})
+
+    def counts_since(self, before):
+        """Returns the calling thread's counts since an earlier `thread_counts`."""
+        return {name: value - before[name] for name, value in self.thread_counts().items()}
+
+    # ── Reads ──
+
+    def open(self, key):
+        """
+        Opens a cached blob for reading.
+
+        The open file stays readable even if another process evicts the blob.
+
+        Returns:
+            file or None: Binary file object, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        path = self._lookup(key)
+        if path is not None:
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                # Evicted between the lookup and the open
+                self._forget(key)
+            else:
+                self._record(True, os.fstat(f.fileno()).st_size)
+                return f
+        self._record(False)
+        return None
+
+    def get(self, key):
+        """Returns the cached bytes of a key, or None on a miss."""
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def get_file(self, key, destination):
+        """
+        Places a cached blob at `destination`, by hard link when possible.
+
+        Returns:
+            bool: True on a hit.
+        """
+        if not self.enabled:
+            return False
+        path = self._lookup(key)
+        if path is not None:
+            try:
+                _link_or_copy(path, destination)
+            except FileNotFoundError:
+                self._forget(key)
+            else:
+                self._record(True, os.path.getsize(destination))
+                return True
+        self._record(False)
+        return False
+
+    def _forget(self, key):
+        """Drops a key whose blob is gone, and the blob's size once no entry references it."""
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT digest FROM entries WHERE key = ?", (key,)).fetchone()
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if row is not None and not self._referenced(db, row[0]):
+                    db.execute("DELETE FROM objects WHERE digest = ?", (row[0],))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def _referenced(self, db, digest):
+        return db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+    # ── Writes ──
+
+    def _write_blob(self, digest, write):
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write(path)
+
+    def _add(self, key, digest, size, write):
+        """
+        Indexes a blob written by `write(path)`.
+
+        The blob is written before taking the index lock, then checked again
+        under it: another process may have evicted the same digest in between.
+        Evicted blobs are deleted before the lock is released, so a blob seen
+        under the lock stays until this entry is evicted in turn.
+        """
+        self._write_blob(digest, write)
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._write_blob(digest, write)
+                db.execute("INSERT OR IGNORE INTO objects VALUES (?, ?)", (digest, size))
+                db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, digest, time.time()))
+                self._count(db, puts=1, put_bytes=size)
+                self._unlink(self._evict(db, self.budget))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def put(self, key, data):
+        """Stores bytes under a key."""
+        if not self.enabled or len(data) > self.budget:
+            return
+
+        def write(path):
+            tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        self._add(key, hashlib.sha256(data).hexdigest(), len(data), write)
+
+    def put_file(self, key, source):
+        """Stores a file under a key, by hard link when possible; the file must not change afterwards."""
+        size = os.path.getsize(source)
+        if not self.enabled or size > self.budget:
+            return
+        digest = hashlib.sha256()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER), b""):
+                digest.update(chunk)
+        self._add(key, digest.hexdigest(), size, lambda path: _link_or_copy(source, path))
+
+    # ── Eviction ──
+
+    def _evict(self, db, budget):
+        """Drops least recently used entries until the blobs fit the budget; returns the blobs to delete."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        evicted = []
+        while total > budget:
+            row = db.execute("SELECT key, digest FROM entries ORDER BY last_used LIMIT 1").fetchone()
+            if row is None:
+                break
+            key, digest = row
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._count(db, evictions=1)
+            if not self._referenced(db, digest):
+                total -= db.execute("SELECT size FROM objects WHERE digest = ?", (digest,)).fetchone()[0]
+                db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+                evicted.append(digest)
+        return evicted
+
+    def _unlink(self, digests):
+        for digest in digests:
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, budget=None):
+        """Evicts down to a budget, the cache's own by default; 0 empties the cache."""
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                evicted = self._evict(db, self.budget if budget is None else budget)
+                self._unlink(evicted)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return len(evicted)
+
+    def stats(self):
+        """Returns this process's hits and misses and the cache's totals and counters."""
+        with self._lock:
+            db = self._db()
+            entries = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            size = db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        return {"hits": self.hits, "misses": self.misses, "hit_bytes": self.hit_bytes,
+                "entries": entries, "bytes": size, "budget": self.budget, "totals": counters}
+
+
+_default = None
+
+
+def default_cache():
+    """Returns the process-wide cache configured by NO2_BLOB_CACHE_DIR and NO2_CACHE_BYTES."""
+    global _default
+    if _default is None:
+        _default = DiskCache()
+    return _default
+
+
+def store_key(store, key, version):
+    """Cache key of a store object at a given generation or content hash."""
+    return f"store:{store.uri(key)}@{version}"
+
+
+def cached_store_bytes(store, key, version=None, cache=None):
+    """
+    Returns the contents of a store object, from the cache when it holds this version.
+
+    Args:
+        store (BlobStore): Store holding the object.
+        key (str): Object key.
+        version (str): Generation or MD5 identifying the content, e.g. from
+            the day catalog; looked up with `stat` if None.
+        cache (DiskCache): Cache to use, the default one if None.
+
+    Returns:
+        bytes: The object's contents.
+    """
+    cache = cache or default_cache()
+    if not cache.enabled:
+        return store.get(key)
+    version = version or store.stat(key).generation
+    data = cache.get(store_key(store, key, version))
+    if data is None:
+        data = store.get(key)
+        cache.put(store_key(store, key, version), data)
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or trim the local blob cache.")
+    parser.add_argument("command", choices=["stats", "evict", "clear"])
+    parser.add_argument("--budget", type=int, help="Bytes to evict down to (evict)")
+    args = parser.parse_args()
+
+    cache = default_cache()
+    if args.command == "stats":
+        stats = cache.stats()
+        totals = stats["totals"]
+        lookups = totals.get("hits", 0) + totals.get("misses", 0)
+        print(f"{cache.root}: {stats['entries']} entries, {stats['bytes'] / 1e9:.2f} of {stats['budget'] / 1e9:.2f} GB")
+        print(f"Hits: {totals.get('hits', 0)} of {lookups} lookups "
+              f"({100 * totals.get('hits', 0) / lookups if lookups else 0:.0f}%), "
+              f"{totals.get('hit_bytes', 0) / 1e9:.2f} GB not fetched again; "
+              f"{totals.get('evictions', 0)} evictions")
+    else:
+        removed = cache.evict(0 if args.command == "clear" else args.budget)
+        print(f"Removed {removed} blobs")
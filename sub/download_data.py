@@ -1,41 +1,374 @@
+import hashlib
+import json
 import os
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def download_file(url, save_directory):
+# Number of concurrent range requests per file
+DEFAULT_PARTS = 8
+# Size of each range request; files smaller than this are fetched in one request
+PART_SIZE = 64 * 1024 * 1024
+# Bytes buffered in memory before each write to disk
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+# Attempts per range (or per single-stream download) before giving up
+MAX_ATTEMPTS = 5
+# Base of the exponential backoff between attempts, in seconds
+BACKOFF_SECONDS = 2
+# Connect and read timeouts for every request, in seconds
+TIMEOUT = (10, 120)
+
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(Exception):
+    """Raised when a file cannot be downloaded."""
+
+
+class SourceUnavailable(DownloadError):
+    """Raised when the server keeps failing (5xx, 429, no connection): the file may exist, so retry later."""
+
+
+class RemoteFile:
+    """Metadata of a remote file, as returned by a HEAD request."""
+
+    def __init__(self, url, size, etag, accept_ranges):
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.accept_ranges = accept_ranges
+
+    @property
+    def md5(self):
+        """The MD5 digest if the ETag is a plain (single-part upload) MD5, else None."""
+        match = MD5_ETAG.match(self.etag or "")
+        return match.group(1) if match else None
+
+
+class _HeadRetry(Retry):
+    """Transport-level retries for HEAD requests only."""
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        if method != "HEAD":
+            # GETs are retried, and resumed, by the download loops
+            return Retry(0, read=False).increment(method, url, *args, **kwargs)
+        return super().increment(method, url, *args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_session(pool_size=DEFAULT_PARTS * 2):
+    """
+    Returns a process-wide HTTP session with connection pooling.
+
+    Connection errors and transient 429/5xx responses on HEAD are retried
+    with exponential backoff at the transport level. GETs are not: the
+    download loops retry them, resuming from the bytes already written.
+    """
+    retry = _HeadRetry(
+        total=MAX_ATTEMPTS,
+        backoff_factor=BACKOFF_SECONDS / 2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["HEAD"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def probe(url, session=None):
+    """
+    Checks whether a URL exists with a HEAD request.
+
+    Only a 404 or 410 means the file is not published; other failures, after
+    the session's retries, raise instead of passing for a missing file.
+
+    Args:
+        url (str): The URL to check.
+        session (requests.Session): Session to use, defaults to the shared one.
+
+    Returns:
+        RemoteFile or None: The file's metadata, or None if it does not exist.
+
+    Raises:
+        SourceUnavailable: If the server could not answer.
+    """
+    session = session or get_session()
+    try:
+        response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        raise SourceUnavailable(f"{url}: {e}") from e
+    if response.status_code in (404, 410):
+        return None
+    if response.status_code != 200:
+        raise SourceUnavailable(f"{url} returned status {response.status_code}")
+    size = response.headers.get("Content-Length")
+    return RemoteFile(
+        url=url,
+        size=int(size) if size is not None else None,
+        etag=response.headers.get("ETag"),
+        accept_ranges=response.headers.get("Accept-Ranges", "").lower() == "bytes",
+    )
+
+
+def resolve_url(candidates, session=None):
+    """
+    Returns the first candidate URL that exists, probing each with HEAD.
+
+    Args:
+        candidates (list): URLs in order of preference.
+        session (requests.Session): Session to use, defaults to the shared one.
+
+    Returns:
+        RemoteFile or None: Metadata of the first available URL, or None.
+
+    Raises:
+        SourceUnavailable: If the server could not answer for a candidate.
+    """
+    for url in candidates:
+        remote = probe(url, session)
+        if remote is not None:
+            return remote
+    return None
+
+
+def _fetch_range(session, url, file_path, start, end, expected_etag):
+    """Downloads bytes [start, end] of `url` into the same offsets of `file_path`."""
+    for attempt in range(MAX_ATTEMPTS):
+        position = start
+        try:
+            headers = {"Range": f"bytes={position}-{end}"}
+            if expected_etag:
+                headers["If-Range"] = expected_etag
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                if response.status_code != 206:
+                    raise DownloadError(f"{url} returned status {response.status_code} for a range request")
+                fd = os.open(file_path, os.O_WRONLY)
+                try:
+                    buffer = bytearray()
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        buffer += chunk
+                        if len(buffer) >= WRITE_BUFFER_SIZE:
+                            os.pwrite(fd, buffer, position)
+                            position += len(buffer)
+                            buffer.clear()
+                    if buffer:
+                        os.pwrite(fd, buffer, position)
+                        position += len(buffer)
+                finally:
+                    os.close(fd)
+            if position != end + 1:
+                raise DownloadError(f"Range {start}-{end} of {url} ended early at {position}")
+            return
+        except (requests.RequestException, DownloadError) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise DownloadError(f"Giving up on range {start}-{end} of {url}: {e}")
+            print(f"Retrying range {start}-{end} of {url} after error: {e}")
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+
+def _download_ranges(session, remote, part_path, state_path, parts):
+    """Downloads `remote` as parallel range requests, skipping ranges finished by an earlier attempt."""
+    ranges = [(start, min(start + PART_SIZE, remote.size) - 1) for start in range(0, remote.size, PART_SIZE)]
+
+    done = set()
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        # Finished ranges are only reusable if the remote file has not changed
+        if state.get("etag") == remote.etag and state.get("size") == remote.size:
+            done = {tuple(r) for r in state["done"]}
+    if not done:
+        with open(part_path, "wb") as f:
+            f.truncate(remote.size)
+
+    pending = [r for r in ranges if r not in done]
+    if done:
+        print(f"Resuming {remote.url}: {len(done)} of {len(ranges)} ranges already downloaded")
+    state_lock = threading.Lock()
+
+    def fetch(byte_range):
+        _fetch_range(session, remote.url, part_path, byte_range[0], byte_range[1], remote.etag)
+        with state_lock:
+            done.add(byte_range)
+            with open(state_path, "w") as f:
+                json.dump({"etag": remote.etag, "size": remote.size, "done": sorted(done)}, f)
+
+    with ThreadPoolExecutor(max_workers=parts) as executor:
+        for future in [executor.submit(fetch, r) for r in pending]:
+            future.result()
+
+
+def _download_stream(session, remote, part_path, state_path):
+    """
+    Downloads `remote` in one request, appending to an existing partial file when possible.
+
+    The ETag of the partial file is saved next to it; a partial file of
+    another version of the remote file is started over.
+    """
+    if os.path.exists(part_path):
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+        if not remote.etag or state.get("etag") != remote.etag:
+            os.remove(part_path)
+    with open(state_path, "w") as f:
+        json.dump({"etag": remote.etag, "size": remote.size}, f)
+
+    for attempt in range(MAX_ATTEMPTS):
+        position = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {}
+        if position and remote.accept_ranges:
+            # The server answers 200 with the whole file if it changed since
+            headers["Range"] = f"bytes={position}-"
+            headers["If-Range"] = remote.etag
+        else:
+            position = 0
+        try:
+            with session.get(remote.url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                if response.status_code == 200:
+                    position = 0
+                elif response.status_code != 206:
+                    raise DownloadError(f"{remote.url} returned status {response.status_code}")
+                with open(part_path, "r+b" if position else "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                    f.seek(position)
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+            return
+        except (requests.RequestException, DownloadError) as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise DownloadError(f"Giving up on {remote.url}: {e}")
+            print(f"Retrying {remote.url} after error: {e}")
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+
+def _verify(remote, part_path):
+    """Checks the downloaded size, and the MD5 when the ETag carries one."""
+    size = os.path.getsize(part_path)
+    if remote.size is not None and size != remote.size:
+        raise DownloadError(f"{remote.url}: expected {remote.size} bytes, got {size}")
+    if remote.md5:
+        digest = hashlib.md5()
+        with open(part_path, "rb") as f:
+            for chunk in iter(lambda: f.read(WRITE_BUFFER_SIZE), b""):
+                digest.update(chunk)
+        if digest.hexdigest() != remote.md5:
+            raise DownloadError(f"{remote.url}: checksum mismatch")
+
+
+def download_file(url, save_directory, session=None, parts=DEFAULT_PARTS, remote=None, cache=None):
     """
     Downloads a file from the given URL and saves it to the specified directory.
 
+    Large files are fetched as parallel range requests. Data is written to a
+    ".part" file next to the destination; if the download is interrupted, the
+    next call resumes from it. The result is checked against the size (and
+    MD5 ETag, when present) reported by the server before being moved into
+    place.
+
     Args:
         url (str): The URL of the file to download.
         save_directory (str): The directory to save the downloaded file.
+        session (requests.Session): Session to use, defaults to the shared one.
+        parts (int): Maximum number of concurrent range requests.
+        remote (RemoteFile): Result of an earlier `probe`, to skip the HEAD request.
+        cache (DiskCache): Local cache consulted before downloading and filled
+            afterwards, keyed by URL and ETag; files without an ETag bypass it.
 
     Returns:
         str: The path of the downloaded file.
+
+    Raises:
+        DownloadError: If the server does not return the file.
     """
+    session = session or get_session()
+
     # Extract the filename from the URL
     filename = os.path.basename(url)
     file_path = os.path.join(save_directory, filename)
+    part_path = f"{file_path}.part"
+    state_path = f"{part_path}.json"
+
+    remote = remote or probe(url, session)
+    if remote is None:
+        print(f"Failed to download file. URL not available: {url}")
+        raise DownloadError(f"{url} is not available")
+
+    if remote.size is not None and os.path.exists(file_path) and os.path.getsize(file_path) == remote.size:
+        print(f"File already downloaded: {file_path}")
+        return file_path
+
+    cache_key = f"url:{url}@{remote.etag}" if cache is not None and remote.etag else None
+    if cache_key and cache.get_file(cache_key, file_path):
+        print(f"File found in the local cache: {file_path}")
+        return file_path
 
     # Download the file
     print(f"Downloading file from {url}...")
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
-        print(f"Download complete! File saved at: {file_path}")
-        return file_path
+    if remote.accept_ranges and remote.size is not None and remote.size > PART_SIZE and parts > 1:
+        _download_ranges(session, remote, part_path, state_path, parts)
     else:
-        print(f"Failed to download file. Status code: {response.status_code}")
-        print(f"URL attempted: {url}")
-        sys.exit(1)  # Exit with an error if the download fails
+        _download_stream(session, remote, part_path, state_path)
+
+    try:
+        _verify(remote, part_path)
+    except DownloadError:
+        # A corrupt partial file cannot be resumed; start over next time
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    os.replace(part_path, file_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    if cache_key:
+        cache.put_file(cache_key, file_path)
+    print(f"Download complete! File saved at: {file_path}")
+    return file_path
+
+@contextmanager
+def open_url_stream(url, session=None):
+    """
+    Opens the body of a URL as a sequential binary stream, without saving it.
+
+    Args:
+        url (str): The URL of the file to stream.
+        session (requests.Session): Session to use, defaults to the shared one.
+
+    Yields:
+        file object: The raw response body.
+
+    Raises:
+        DownloadError: If the server does not return the file.
+    """
+    session = session or get_session()
+    print(f"Streaming file from {url}...")
+    response = session.get(url, stream=True, timeout=TIMEOUT)
+    try:
+        if response.status_code != 200:
+            print(f"Failed to stream file. Status code: {response.status_code}")
+            print(f"URL attempted: {url}")
+            raise DownloadError(f"{url} returned status {response.status_code}")
+        response.raw.decode_content = True
+        yield response.raw
+    finally:
+        response.close()
 
 if __name__ == "__main__":
     # Ensure the URL and local save directory are provided as command-line arguments
     if len(sys.argv) != 3:
-        print("Usage: python3 download_data.py <URL> <LOCAL_SAVE_DIRECTORY>")
+        print("Usage: python3 -m sub.download_data <URL> <LOCAL_SAVE_DIRECTORY>")
         sys.exit(1)
 
     # Read the arguments
@@ -19,12 +19,35 @@ def extract_tar_file(local_tar_path, local_extracted_path):
         print(f"Extraction complete!")
     except Exception as e:
         print(f"Failed to extract {local_tar_path}. Error: {e}")
-        sys.exit(1)
+        raise
+
+def iter_nc_members(source):
+    """
+    Streams the .nc members of a tar without writing them to disk.
+
+    The tar is read sequentially, so `source` may be a non-seekable stream
+    such as an HTTP response body.
+
+    Args:
+        source: Local path of the .tar file, or a binary file object.
+
+    Yields:
+        tuple: (member name, member contents as bytes) for each .nc member.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        tar = tarfile.open(source, "r|*")
+    else:
+        tar = tarfile.open(fileobj=source, mode="r|*")
+
+    with tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(".nc"):
+                yield os.path.basename(member.name), tar.extractfile(member).read()
 
 if __name__ == "__main__":
     # Ensure proper arguments are provided
     if len(sys.argv) != 3:
-        print("Usage: python3 extract_data.py <TAR_FILE_LOCAL_PATH> <EXTRACTED_LOCAL_PATH>")
+        print("Usage: python3 -m sub.extract_data <TAR_FILE_LOCAL_PATH> <EXTRACTED_LOCAL_PATH>")
         sys.exit(1)
 
     local_tar_path = sys.argv[1]
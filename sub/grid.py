@@ -0,0 +1,228 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sub.day_format import read_day
+
+# Grid nodes sit at multiples of RESOLUTION: a pixel belongs to the node its
+# coordinates round to. Every job bins through `cell_ids`, so the gridded day
+# products and the rolling-average job put each pixel in the same cell.
+RESOLUTION = 0.1
+NLAT = 1801  # -90.0 .. 90.0
+NLON = 3601  # -180.0 .. 180.0
+NCELLS = NLAT * NLON
+
+# Store prefixes of the gridded day products and of the day files they summarize
+GRID_PREFIX = "data/grid/"
+DAYS_PREFIX = "data/days/"
+
+GRID_VERSION_KEY = b"no2.grid_version"
+GRID_VERSION = 1
+
+GRID_SCHEMA = pa.schema(
+    [
+        ("cell", pa.int32()),
+        ("count", pa.uint32()),
+        ("no2_sum", pa.float64()),
+        ("no2_mean", pa.float32()),
+        ("no2_sumsq", pa.float64()),
+    ],
+    metadata={GRID_VERSION_KEY: str(GRID_VERSION).encode()},
+)
+
+
+def cell_ids(latitude, longitude):
+    """
+    Returns the grid cell id of each coordinate pair.
+
+    Args:
+        latitude (ndarray): Latitudes in degrees.
+        longitude (ndarray): Longitudes in degrees.
+
+    Returns:
+        ndarray: int32 cell ids, `lat_index * NLON + lon_index`.
+    """
+    lat_index = np.clip(np.round(np.asarray(latitude, dtype=np.float64) / RESOLUTION) + (NLAT - 1) // 2, 0, NLAT - 1)
+    lon_index = np.clip(np.round(np.asarray(longitude, dtype=np.float64) / RESOLUTION) + (NLON - 1) // 2, 0, NLON - 1)
+    return (lat_index.astype(np.int32) * NLON + lon_index.astype(np.int32)).astype(np.int32)
+
+
+def cell_bins(cells):
+    """
+    Returns the float32 lat_bin and lon_bin of grid cell ids, as in the rolling-average files.
+
+    Every rolling-average mode derives its bins here, so bins compare equal across modes.
+    """
+    lat_index, lon_index = np.divmod(np.asarray(cells), NLON)
+    step = np.float32(RESOLUTION)
+    lat_bin = (lat_index - (NLAT - 1) // 2).astype(np.float32) * step
+    lon_bin = (lon_index - (NLON - 1) // 2).astype(np.float32) * step
+    return lat_bin, lon_bin
+
+
+def cell_centers(cells):
+    """
+    Returns the latitude and longitude of grid cell ids.
+
+    Values are rounded to one decimal, so they are the float64 grid
+    coordinates rather than the float32 `cell_bins`.
+
+    Returns:
+        tuple: (latitude, longitude) float64 arrays.
+    """
+    cells = np.asarray(cells)
+    lat_index, lon_index = np.divmod(cells, NLON)
+    latitude = np.round((lat_index - (NLAT - 1) // 2) * RESOLUTION, 1)
+    longitude = np.round((lon_index - (NLON - 1) // 2) * RESOLUTION, 1)
+    return latitude, longitude
+
+
+class GridStats:
+    """
+    Mergeable per-cell NO2 statistics, stored sparsely.
+
+    Only cells with at least one pixel are kept. `cells` is sorted and unique;
+    the other arrays are aligned with it.
+    """
+
+    def __init__(self, cells, count, no2_sum, no2_sumsq):
+        self.cells = cells
+        self.count = count
+        self.no2_sum = no2_sum
+        self.no2_sumsq = no2_sumsq
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.empty(0, np.int32), np.empty(0, np.uint32), np.empty(0, np.float64), np.empty(0, np.float64)
+        )
+
+    @classmethod
+    def from_pixels(cls, latitude, longitude, no2):
+        """Aggregates pixels into per-cell statistics in one vectorized pass."""
+        return cls._reduce(
+            cell_ids(latitude, longitude),
+            np.ones(len(no2), np.uint32),
+            np.asarray(no2, dtype=np.float64),
+            np.square(np.asarray(no2, dtype=np.float64)),
+        )
+
+    @classmethod
+    def merge_all(cls, parts):
+        """Merges statistics from several orbits or days."""
+        parts = [part for part in parts if len(part.cells)]
+        if not parts:
+            return cls.empty()
+        return cls._reduce(
+            np.concatenate([part.cells for part in parts]),
+            np.concatenate([part.count for part in parts]),
+            np.concatenate([part.no2_sum for part in parts]),
+            np.concatenate([part.no2_sumsq for part in parts]),
+        )
+
+    @classmethod
+    def _reduce(cls, cells, count, no2_sum, no2_sumsq):
+        unique_cells, inverse = np.unique(cells, return_inverse=True)
+        size = len(unique_cells)
+        return cls(
+            unique_cells.astype(np.int32),
+            np.bincount(inverse, weights=count, minlength=size).astype(np.uint32),
+            np.bincount(inverse, weights=no2_sum, minlength=size),
+            np.bincount(inverse, weights=no2_sumsq, minlength=size),
+        )
+
+    def merge(self, other):
+        return GridStats.merge_all([self, other])
+
+    @property
+    def mean(self):
+        return (self.no2_sum / self.count).astype(np.float32)
+
+    def dense(self, field="mean", fill=np.nan):
+        """Returns one statistic as a dense (NLAT, NLON) array."""
+        values = self.mean if field == "mean" else getattr(self, field)
+        grid = np.full(NCELLS, fill, dtype=np.float64)
+        grid[self.cells] = values
+        return grid.reshape(NLAT, NLON)
+
+    def to_table(self):
+        return pa.table(
+            {
+                "cell": self.cells,
+                "count": self.count,
+                "no2_sum": self.no2_sum,
+                "no2_mean": self.mean,
+                "no2_sumsq": self.no2_sumsq,
+            },
+            schema=GRID_SCHEMA,
+        )
+
+    @classmethod
+    def from_table(cls, table):
+        return cls(
+            table.column("cell").to_numpy(),
+            table.column("count").to_numpy(),
+            table.column("no2_sum").to_numpy(),
+            table.column("no2_sumsq").to_numpy(),
+        )
+
+
+def write_grid(stats, sink):
+    """
+    Writes grid statistics as a zstd-compressed Parquet file sorted by cell.
+
+    Args:
+        stats (GridStats): Statistics to write.
+        sink: Path or writable binary file object.
+    """
+    pq.write_table(stats.to_table(), sink, compression="zstd", row_group_size=1_000_000)
+
+
+def read_grid(source):
+    """
+    Reads a grid Parquet file.
+
+    The stored mean column is skipped; it is derived from the sums.
+
+    Args:
+        source: Path or seekable binary file object (e.g. `BlobStore.open`).
+
+    Returns:
+        GridStats: The per-cell statistics.
+    """
+    return GridStats.from_table(pq.read_table(source, columns=["cell", "count", "no2_sum", "no2_sumsq"]))
+
+
+def load_day_grid(store, date, catalog=None):
+    """
+    Returns the per-cell statistics of one day, or None if the day has no data.
+
+    Reads the small gridded day product when it exists; days ingested before
+    it was introduced are binned from the day file instead.
+
+    Args:
+        store (BlobStore): Store holding the day and grid files.
+        date (datetime): Day to load.
+        catalog (DayCatalog): Day catalog giving the keys, if available.
+
+    Returns:
+        GridStats or None: The day's statistics.
+    """
+    entry = catalog.get(date) if catalog is not None and catalog.exists else None
+    grid_key = (entry or {}).get("grid_key", f"{GRID_PREFIX}g{date.strftime('%Y%m%d')}.parquet")
+    day_key = (entry or {}).get("key", f"{DAYS_PREFIX}d{date.strftime('%Y%m%d')}.parquet")
+
+    if store.exists(grid_key):
+        print(f"Reading {grid_key}")
+        with store.open(grid_key) as source:
+            return read_grid(source)
+    if store.exists(day_key):
+        print(f"Reading {day_key} (no grid product)")
+        columns = ["latitude", "longitude", "nitrogendioxide_tropospheric_column"]
+        with store.open(day_key) as source:
+            table = read_day(source, columns=columns)
+        return GridStats.from_pixels(
+            table.column("latitude").to_numpy(),
+            table.column("longitude").to_numpy(),
+            table.column("nitrogendioxide_tropospheric_column").to_numpy(),
+        )
+    return None
@@ -0,0 +1,102 @@
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+# Request mix sent by each simulated user: (weight, path template)
+DEFAULT_MIX = [
+    (50, "/point?lat={lat}&lon={lon}"),
+    (15, "/bbox?min_lat={lat}&min_lon={lon}&max_lat={lat2}&max_lon={lon2}"),
+    (15, "/ra/{date}?min_lat={lat}&min_lon={lon}&max_lat={lat2}&max_lon={lon2}"),
+    (10, "/country/{country}"),
+    (10, "/anomaly/latest?min_lat={lat}&min_lon={lon}&max_lat={lat2}&max_lon={lon2}"),
+]
+
+
+def make_path(rng, date, countries, box_size):
+    """Draws one request path from the mix, at a random location."""
+    weights, templates = zip(*DEFAULT_MIX)
+    template = rng.choices(templates, weights=weights)[0]
+    lat = round(rng.uniform(-60, 70 - box_size), 1)
+    lon = round(rng.uniform(-180, 180 - box_size), 1)
+    return template.format(
+        lat=lat, lon=lon, lat2=round(lat + box_size, 1), lon2=round(lon + box_size, 1),
+        date=date, country=rng.choice(countries),
+    )
+
+
+def run_load_test(base_url, users, requests_per_user, date, countries, box_size=2.0, seed=0):
+    """
+    Sends the request mix from concurrent users and reports latency percentiles.
+
+    Each user keeps one HTTP session and accepts gzip, like a browser.
+
+    Args:
+        base_url (str): Root URL of the query service.
+        users (int): Concurrent simulated users.
+        requests_per_user (int): Requests sent by each user, back to back.
+        date (str): Date used for /ra requests, YYYY-MM-DD.
+        countries (list): Country names used for /country requests.
+        box_size (float): Side of the boxes requested, in degrees.
+        seed (int): Seed of the request generator.
+
+    Returns:
+        dict: Latency percentiles in milliseconds, throughput and status counts.
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def user(index):
+        rng = random.Random(seed + index)
+        session = requests.Session()
+        session.headers["Accept-Encoding"] = "gzip"
+        for _ in range(requests_per_user):
+            path = make_path(rng, date, countries, box_size)
+            start = time.perf_counter()
+            try:
+                status = session.get(base_url + path, timeout=30).status_code
+            except requests.RequestException:
+                status = "error"
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(user, range(users)))
+    wall = time.perf_counter() - start
+
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / wall,
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p90_ms": float(np.percentile(milliseconds, 90)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "max_ms": float(milliseconds.max()),
+        "statuses": statuses,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the query service (see sub.serve).")
+    parser.add_argument("base_url", help="e.g. http://localhost:8080")
+    parser.add_argument("--users", type=int, default=16, help="Concurrent simulated users")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per user")
+    parser.add_argument("--date", required=True, help="Date of the rolling averages to request, YYYY-MM-DD")
+    parser.add_argument("--countries", default="United States of America,India,China,Germany,Brazil",
+                        help="Comma-separated country names")
+    parser.add_argument("--box-size", type=float, default=2.0, help="Side of requested boxes in degrees")
+    args = parser.parse_args()
+
+    result = run_load_test(args.base_url.rstrip("/"), args.users, args.requests, args.date,
+                           args.countries.split(","), args.box_size)
+    print(f"{result['requests']} requests, {result['throughput_rps']:.1f} req/s")
+    print(f"p50 {result['p50_ms']:.1f} ms, p90 {result['p90_ms']:.1f} ms, "
+          f"p99 {result['p99_ms']:.1f} ms, max {result['max_ms']:.1f} ms")
+    print(f"Statuses: {result['statuses']}")
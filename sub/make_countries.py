@@ -1,118 +1,218 @@
 import os
 import sys
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
-from google.cloud import storage
-from io import BytesIO
-from pyarrow import parquet
-
-def process_parquet_in_chunks(blob, bucket, countries_folder, world, chunk_size=100000):
+from functools import lru_cache
+from sub import country_store
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog
+from sub.country_raster import load_country_raster
+from sub.day_format import iter_day_batches
+from sub.metrics import span
+
+class CountryDaysFailed(Exception):
+    """Raised by `make_countries` after writing the days that succeeded, listing the day files that failed."""
+
+    def __init__(self, keys):
+        super().__init__(f"{len(keys)} day files failed: {keys}")
+        self.keys = keys
+
+    @property
+    def dates(self):
+        return [datetime.strptime(_key_date(key), "%Y-%m-%d") for key in self.keys]
+
+def _key_date(key):
+    """Returns the "YYYY-MM-DD" date of a day file from its name (dYYYYMMDD.parquet)."""
+    date_str = key.split("/")[-1].replace("d", "").replace(".parquet", "")
+    return datetime.strptime(date_str, "%Y%m%d").strftime("%Y-%m-%d")
+
+def process_parquet_in_chunks(key, store, raster, chunk_size=100000):
     """
-    Process a Parquet file in chunks and update country Parquet files.
+    Process a Parquet file in chunks and average NO2 per country.
+
+    Pixels are assigned to countries with the precomputed raster (see
+    `country_raster`), so only pixels near a border hit the polygons. Sums
+    and counts are accumulated across chunks, so every pixel of the day
+    contributes to the country mean.
+
+    Returns:
+        DataFrame: One row per country with data: Country, Date, NO2, Count.
     """
     try:
-        print(f"Processing Parquet file: {blob.name}")
+        print(f"Processing Parquet file: {key}")
         
         # Extract the date from the file name
-        date_str = blob.name.split("/")[-1].replace("d", "").replace(".parquet", "")
-        date = datetime.strptime(date_str, "%Y%m%d").strftime("%Y-%m-%d")
-        #print(f"Extracted date: {date}")
+        date = _key_date(key)
+
+        # Open the Parquet data with ranged reads, fetching only the columns we need;
+        # both the legacy and the compact day schema are read with legacy column names
+        columns = ["latitude", "longitude", "nitrogendioxide_tropospheric_column"]
 
-        # Download the Parquet data
-        #print(f"Downloading Parquet file: {blob.name}")
-        parquet_data = blob.download_as_bytes()
-        input_file = BytesIO(parquet_data)
-        parquet_file = parquet.ParquetFile(input_file)
-        #print(f"Parquet file downloaded successfully: {blob.name}")
+        sums = np.zeros(len(raster.names))
+        counts = np.zeros(len(raster.names), dtype=np.int64)
 
         # Process file in chunks
-        for i, batch in enumerate(parquet_file.iter_batches(batch_size=chunk_size)):
-            #print(f"Processing chunk {i + 1} of file {blob.name}")
-            df = batch.to_pandas()
-            #print(f"Chunk {i + 1} loaded into DataFrame with {len(df)} rows")
-
-            # Convert DataFrame to GeoDataFrame
-            gdf = gpd.GeoDataFrame(
-                df,
-                geometry=gpd.points_from_xy(df['longitude'], df['latitude']),
-                crs="EPSG:4326"
-            )
-            #print(f"Chunk {i + 1} converted to GeoDataFrame")
-
-            # Spatial join with countries
-            joined = gpd.sjoin(gdf, world, how="inner", predicate="within")
-            #print(f"Chunk {i + 1} spatially joined with countries")
-
-            # Group by country and calculate mean NO2
-            grouped = joined.groupby("NAME")["nitrogendioxide_tropospheric_column"].mean().reset_index()
-            grouped.rename(columns={"NAME": "Country", "nitrogendioxide_tropospheric_column": "NO2"}, inplace=True)
-            grouped["Date"] = date
-            #print(f"Chunk {i + 1} grouped by country and NO2 mean calculated")
-
-            # Save results to corresponding country Parquet files
-            for _, row in grouped.iterrows():
-                country_file = f"{countries_folder}/{row['Country'].lower().replace(' ', '_')}.parquet"
-                country_blob = bucket.blob(country_file)
-
-                # Check if the country's file already exists in GCS
-                if country_blob.exists():
-                    #print(f"Country file exists in GCS: {country_file}")
-                    existing_data = country_blob.download_as_bytes()
-                    existing_df = pd.read_parquet(BytesIO(existing_data))
-                    existing_df = existing_df[existing_df["Date"] != date]
-                    updated_df = pd.concat([existing_df, pd.DataFrame([row.drop("Country")])], ignore_index=True)
-                    updated_df = updated_df.sort_values(by="Date", key=lambda x: pd.to_datetime(x))
-                else:
-                    print(f"Country file does not exist in GCS: {country_file}")
-                    updated_df = pd.DataFrame([row.drop("Country")])
-
-                # Save the updated file back to GCS
-                parquet_buffer = BytesIO()
-                updated_df.to_parquet(parquet_buffer, index=False)
-                parquet_buffer.seek(0)
-                country_blob.upload_from_file(parquet_buffer, content_type="application/octet-stream")
-                #print(f"Country file updated in GCS: {country_file}")
-
-        print(f"Finished processing Parquet file: {blob.name}")
+        with span("countries_day", date=date) as s, store.open(key) as source:
+            for batch in iter_day_batches(source, columns=columns, batch_size=chunk_size):
+                latitude = batch.column("latitude").to_numpy()
+                longitude = batch.column("longitude").to_numpy()
+                no2 = batch.column("nitrogendioxide_tropospheric_column").to_numpy(zero_copy_only=False)
+
+                # Look up each pixel's country and accumulate NO2 per country
+                ids = raster.assign(latitude, longitude)
+                keep = (ids >= 0) & np.isfinite(no2)
+                sums += np.bincount(ids[keep], weights=no2[keep], minlength=len(raster.names))
+                counts += np.bincount(ids[keep], minlength=len(raster.names))
+                s.add(rows_in=batch.num_rows)
+            present = np.flatnonzero(counts)
+            s.add(rows_out=len(present))
+        print(f"Finished processing Parquet file: {key}")
+        return pd.DataFrame({
+            "Country": raster.names[present],
+            "Date": date,
+            "NO2": sums[present] / counts[present],
+            "Count": counts[present],
+        })
     except Exception as e:
-        print(f"Error in process_parquet_in_chunks for file {blob.name}: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
+        print(f"Error in process_parquet_in_chunks for file {key}: {e}")
+        raise
 
-def main(bucket_name, days_folder, countries_folder, geojson_path, start_date, end_date):
-    try:
-        print(f"Starting make_countries.py with bucket: {bucket_name}")
-        
-        # Initialize Google Cloud Storage client
-        #print("Initializing Google Cloud Storage client...")
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        #print("Google Cloud Storage client initialized")
-
-        # Load GeoJSON file
-        #print(f"Loading GeoJSON file from: {geojson_path}")
-        world = gpd.read_file(geojson_path)
-        #print(f"GeoJSON file loaded. Found {len(world)} geometries.")
-
-        # List all Parquet files in the days folder
-        #print(f"Listing blobs in folder: {days_folder}")
-        blobs = list(storage_client.list_blobs(bucket_name, prefix=days_folder))
-        #print(f"Found {len(blobs)} blobs in {days_folder}.")
-
-        for blob in blobs:
-            if blob.name.endswith(".parquet"):
-                date_str = blob.name.split("/")[-1].replace("d", "").replace(".parquet", "")
+# Default number of days aggregated in parallel
+COUNTRY_WORKERS = os.cpu_count() or 1
+
+# Raster shared by the worker processes of a parallel run
+_worker_raster = None
+
+def _init_worker(raster):
+    global _worker_raster
+    _worker_raster = raster
+
+def _process_in_worker(key, store):
+    return process_parquet_in_chunks(key, store, _worker_raster)
+
+@lru_cache(maxsize=None)
+def load_world(geojson_path):
+    """
+    Loads the country polygons once per process.
+
+    Args:
+        geojson_path (str): Path to the countries GeoJSON file.
+
+    Returns:
+        GeoDataFrame: Country geometries with their NAME column.
+    """
+    return gpd.read_file(geojson_path)
+
+@lru_cache(maxsize=None)
+def load_raster(geojson_path):
+    """
+    Loads the country raster for a GeoJSON file once per process.
+
+    The raster itself is cached on disk, so it is only built the first time
+    a given GeoJSON file is used.
+
+    Args:
+        geojson_path (str): Path to the countries GeoJSON file.
+
+    Returns:
+        CountryRaster: Pixel -> country lookup over the NAME column.
+    """
+    return load_country_raster(load_world(geojson_path), geojson_path)
+
+def make_countries(store, days_folder, countries_folder, raster, start_date, end_date, workers=1,
+                   export=True, compact=True):
+    """
+    Updates the country store for every day file in the date range.
+
+    Days are aggregated independently (in parallel with `workers` > 1) and
+    the results are appended to the store in one write at the end of the
+    run (see `country_store`).
+
+    Args:
+        store (BlobStore): Store holding the day and country Parquet files.
+        days_folder (str): Prefix of the day Parquet files.
+        countries_folder (str): Prefix of the country store.
+        raster (CountryRaster): Country lookup, see `load_raster`.
+        start_date (datetime): First date to process (inclusive).
+        end_date (datetime): Last date to process (inclusive).
+        workers (int): Number of days aggregated in parallel processes.
+        export (bool): Also update the per-country (NO2, Date) files.
+        compact (bool): Fold the country parts together once there are many.
+            Off in the shards of a sharded job, which run at the same time:
+            compaction deletes parts other shards may be reading.
+
+    Returns:
+        DataFrame: The rows written, one per country and day.
+
+    Raises:
+        CountryDaysFailed: If some days could not be aggregated; the other
+            days are written first.
+    """
+    # Look the days up in the catalog; list the days folder only if there is none yet
+    catalog = DayCatalog.load(store)
+    if catalog.exists:
+        keys = [entry["key"] for entry in catalog.range(start_date, end_date)]
+    else:
+        keys = []
+        for key in store.list(days_folder):
+            if key.endswith(".parquet"):
+                date_str = key.split("/")[-1].replace("d", "").replace(".parquet", "")
                 file_date = datetime.strptime(date_str, "%Y%m%d")
                 if start_date <= file_date <= end_date:
-                    try:
-                        #print(f"Processing blob: {blob.name}")
-                        process_parquet_in_chunks(blob, bucket, countries_folder, world)
-                    except Exception as e:
-                        print(f"Error processing Parquet file {blob.name}: {e}")
-                        import traceback
-                        traceback.print_exc()
+                    keys.append(key)
+
+    results = []
+    failed = []
+    if workers > 1 and len(keys) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(keys)), initializer=_init_worker,
+                                 initargs=(raster,)) as executor:
+            futures = {executor.submit(_process_in_worker, key, store): key for key in keys}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"Error processing Parquet file {futures[future]}: {e}")
+                    failed.append(futures[future])
+    else:
+        for key in keys:
+            try:
+                results.append(process_parquet_in_chunks(key, store, raster))
+            except Exception as e:
+                print(f"Error processing Parquet file {key}: {e}")
+                import traceback
+                traceback.print_exc()
+                failed.append(key)
+
+    rows = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=country_store.COLUMNS)
+    if rows.empty:
+        print("No country data to write.")
+    else:
+        # One append per run, then fold small parts together once there are many
+        for part in country_store.write_run(store, countries_folder, rows):
+            print(f"Country rows written to {store.uri(part)}")
+        if compact:
+            country_store.compact(store, countries_folder)
+        if export:
+            country_store.export_legacy(store, countries_folder, rows)
+    if failed:
+        raise CountryDaysFailed(sorted(failed))
+    return rows
+
+def main(store_location, days_folder, countries_folder, geojson_path, start_date, end_date,
+         workers=COUNTRY_WORKERS):
+    try:
+        print(f"Starting make_countries.py with store: {store_location}")
+        
+        # Open the data store (GCS bucket name, gs:// URI or local directory)
+        store = open_store(store_location)
+
+        raster = load_raster(geojson_path)
+        with span("make_countries", start=f"{start_date:%Y-%m-%d}", end=f"{end_date:%Y-%m-%d}") as s:
+            s.add(rows_out=len(make_countries(store, days_folder, countries_folder, raster, start_date, end_date,
+                                              workers)))
     except Exception as e:
         print(f"Error in main function: {e}")
         import traceback
@@ -121,7 +221,7 @@ def main(bucket_name, days_folder, countries_folder, geojson_path, start_date, e
 
 if __name__ == "__main__":
     if len(sys.argv) != 7:
-        print("Usage: python3 make_countries.py <BUCKET_NAME> <DAYS_FOLDER> <COUNTRIES_FOLDER> <GEOJSON_PATH> <START_DATE: YYYY-MM-DD> <END_DATE: YYYY-MM-DD>")
+        print("Usage: python3 -m sub.make_countries <BUCKET_NAME|STORE_DIR> <DAYS_FOLDER> <COUNTRIES_FOLDER> <GEOJSON_PATH> <START_DATE: YYYY-MM-DD> <END_DATE: YYYY-MM-DD>")
         sys.exit(1)
 
     bucket_name = sys.argv[1]
@@ -131,5 +231,4 @@ if __name__ == "__main__":
     start_date = datetime.strptime(sys.argv[5], "%Y-%m-%d")
     end_date = datetime.strptime(sys.argv[6], "%Y-%m-%d")
 
-    #print(f"Absolute GeoJSON path: {geojson_path}")
     main(bucket_name, days_folder, countries_folder, geojson_path, start_date, end_date)
@@ -1,94 +1,272 @@
 import os
 import sys
 import h5py
-import pandas as pd
-from google.cloud import storage
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from io import BytesIO
+from sub.blob_store import open_store
+from sub.day_format import compact_columns, write_compact
+from sub.grid import GridStats, write_grid
 
-def process_nc_files_to_parquet(local_folder, bucket, gcs_output_path):
+DATASETS_TO_EXTRACT = [
+    "PRODUCT/latitude",
+    "PRODUCT/longitude",
+    "PRODUCT/nitrogendioxide_tropospheric_column",
+    "PRODUCT/qa_value"
+]
+
+# Default number of worker processes decoding orbits
+DECODE_WORKERS = os.cpu_count() or 1
+
+def decode_orbit(name, source):
     """
-    Processes .nc files in the local folder, filters data, and uploads the Parquet file directly to GCS.
+    Reads the product datasets of one orbit file and keeps the pixels with qa_value > 75.
+
+    The QA mask is applied to the flattened numpy arrays, so only the kept
+    pixels are ever copied. Runs in a worker process.
 
     Args:
-        local_folder (str): Directory containing .nc files.
-        bucket: GCS bucket object.
-        gcs_output_path (str): Full path in GCS to save the Parquet file.
+        name (str): File name, used in log messages.
+        source: Path of the .nc file, or its contents as bytes.
+
+    Returns:
+        dict or None: Column name -> filtered numpy array, or None if the file
+        is missing a dataset.
+    """
+    print(f"Processing file: {name}")
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+
+    with h5py.File(source, "r") as f:
+        data = {}
+        for dataset_name in DATASETS_TO_EXTRACT:
+            if dataset_name not in f:
+                print(f"Dataset {dataset_name} not found in {name}. Skipping.")
+                return None
+            data[dataset_name.split("/")[-1]] = f[dataset_name][:].ravel()
+
+    # Filter rows based on qa_value > 75
+    mask = data["qa_value"] > 75
+    return {column: values[mask] for column, values in data.items()}
+
+def decode_orbit_with_grid(name, source):
+    """
+    Decodes one orbit file and aggregates its pixels onto the 0.1° grid.
+
+    Runs in a worker process, so the aggregation is spread across the pool.
 
     Returns:
-        None
+        tuple: (pixel arrays as from `decode_orbit`, GridStats), or (None, None).
+    """
+    data = decode_orbit(name, source)
+    if data is None:
+        return None, None
+    grid = GridStats.from_pixels(data["latitude"], data["longitude"], data["nitrogendioxide_tropospheric_column"])
+    return data, grid
+
+def write_orbits(sources, open_sink, workers=DECODE_WORKERS, executor=None, compact=False, open_grid_sink=None):
     """
-    datasets_to_extract = [
-        "PRODUCT/latitude",
-        "PRODUCT/longitude",
-        "PRODUCT/nitrogendioxide_tropospheric_column",
-        "PRODUCT/qa_value"
+    Decodes orbit files in a process pool and streams them into one Parquet file.
+
+    Each orbit becomes one row group as soon as it is decoded, so memory holds
+    at most a few orbits rather than the whole day. Orbits are written in the
+    order they finish.
+
+    With `compact`, the day is written in the compact schema (see
+    `day_format`), which must be sorted as a whole: the kept pixels are held in
+    compact form (13 bytes each) until every orbit is decoded.
+
+    Args:
+        sources: Iterable of (name, source) pairs, where source is a path or
+            the file contents as bytes. Consumed lazily.
+        open_sink (callable): Returns the writable binary file object for the
+            Parquet file. Called only once the first non-empty orbit is ready,
+            so nothing is written for a day without valid data.
+        workers (int): Size of the process pool, created when `executor` is
+            None; with a shared `executor`, the size of that pool.
+        executor (Executor): Shared process pool to submit orbits to.
+        compact (bool): Write the compact, sorted schema.
+        open_grid_sink (callable): If given, also aggregate the kept pixels
+            into the gridded day product (see `grid`) and write it to the file
+            object this returns.
+
+    Returns:
+        int: Number of rows written.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    max_pending = workers + 1
+
+    sink = None
+    writer = None
+    rows = 0
+    compact_parts = []
+    grid_parts = []
+    decode = decode_orbit if open_grid_sink is None else decode_orbit_with_grid
+    pending = {}
+    sources = iter(sources)
+    exhausted = False
+    try:
+        while pending or not exhausted:
+            # Keep the pool busy without reading more orbits than it can take
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    name, source = next(sources)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(decode, name, source)] = name
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print(f"Error processing file {name}: {e}")
+                    continue
+                if open_grid_sink is not None:
+                    data, grid = data
+                    if grid is not None:
+                        grid_parts.append(grid)
+                if data is None or len(data["qa_value"]) == 0:
+                    continue
+                if compact:
+                    compact_parts.append(compact_columns(data))
+                    continue
+
+                table = pa.table(data)
+                if writer is None:
+                    sink = open_sink()
+                    writer = pq.ParquetWriter(sink, table.schema)
+                writer.write_table(table.cast(writer.schema))
+                rows += table.num_rows
+    except BaseException:
+        if sink is not None:
+            sink.__exit__(*sys.exc_info())
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+
+    if compact_parts:
+        with open_sink() as sink:
+            rows = write_compact(compact_parts, sink)
+    if writer is not None:
+        writer.close()
+        sink.close()
+    if rows and open_grid_sink is not None:
+        with open_grid_sink() as grid_sink:
+            write_grid(GridStats.merge_all(grid_parts), grid_sink)
+    return rows
+
+def _grid_sink(store, grid_key):
+    if grid_key is None:
+        return None
+    return lambda: store.open_write(grid_key)
+
+def folder_sources(local_folder):
+    """Returns the (name, path) pairs of the .nc files in a local folder."""
+    return [
+        (file, os.path.join(local_folder, file))
+        for file in sorted(os.listdir(local_folder))
+        if file.endswith(".nc")
     ]
 
-    all_data = []
-
-    # Process all .nc files
-    for file in os.listdir(local_folder):
-        if file.endswith(".nc"):
-            file_path = os.path.join(local_folder, file)
-            print(f"Processing file: {file_path}")
-
-            try:
-                with h5py.File(file_path, "r") as f:
-                    data = {}
-                    for dataset_name in datasets_to_extract:
-                        if dataset_name in f:
-                            dataset = f[dataset_name][:]
-                            data[dataset_name.split("/")[-1]] = dataset.flatten()
-                        else:
-                            print(f"Dataset {dataset_name} not found in {file}. Skipping.")
-
-                    if data:
-                        df = pd.DataFrame(data)
-                        # Filter rows based on qa_value > 75
-                        df = df[df["qa_value"] > 75]
-                        all_data.append(df)
-            except Exception as e:
-                print(f"Error processing file {file}: {e}")
-
-    # Combine and save directly to GCS as Parquet
-    if all_data:
-        combined_df = pd.concat(all_data, ignore_index=True)
-        try:
-            # Save the DataFrame to a Parquet file in memory
-            parquet_buffer = BytesIO()
-            combined_df.to_parquet(parquet_buffer, index=False)
-            parquet_buffer.seek(0)
-
-            # Upload the Parquet file to GCS
-            blob = bucket.blob(gcs_output_path)
-            blob.upload_from_file(parquet_buffer, content_type="application/octet-stream")
-            print(f"Parquet file uploaded directly to GCS: gs://{bucket.name}/{gcs_output_path}")
-        except Exception as e:
-            print(f"Error saving Parquet file: {e}")
+def process_nc_files_to_parquet(local_folder, store, output_key, workers=DECODE_WORKERS, compact=False,
+                                grid_key=None):
+    """
+    Processes .nc files in the local folder, filters data, and uploads the Parquet file directly to the store.
+
+    The file is uploaded while it is being written.
+
+    Args:
+        local_folder (str): Directory containing .nc files.
+        store (BlobStore): Destination store.
+        output_key (str): Full key in the store to save the Parquet file.
+        workers (int): Number of worker processes decoding orbits.
+        compact (bool): Write the compact, sorted schema (see `day_format`).
+        grid_key (str): If given, also write the gridded day product to this key.
+
+    Returns:
+        int: Number of rows written.
+    """
+    rows = write_orbits(folder_sources(local_folder), lambda: store.open_write(output_key), workers,
+                        compact=compact, open_grid_sink=_grid_sink(store, grid_key))
+    if rows:
+        print(f"Parquet file uploaded directly to {store.uri(output_key)}")
     else:
         print("No valid data found to save.")
+    return rows
 
-def main(bucket_name, local_input_folder, gcs_output_folder, output_filename):
-    # Initialize Google Cloud Storage client
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+def process_nc_members_to_parquet(members, store, output_key, workers=DECODE_WORKERS, compact=False,
+                                  grid_key=None):
+    """
+    Processes .nc payloads streamed out of a tar and uploads the Parquet file to the store.
 
-    # Validate bucket existence
-    if not bucket.exists():
-        print(f"Error: Bucket {bucket_name} does not exist.")
-        sys.exit(1)
+    Args:
+        members: Iterable of (name, bytes) pairs, e.g. from `extract_data.iter_nc_members`.
+        store (BlobStore): Destination store.
+        output_key (str): Full key in the store to save the Parquet file.
+        workers (int): Number of worker processes decoding orbits.
+        compact (bool): Write the compact, sorted schema (see `day_format`).
+        grid_key (str): If given, also write the gridded day product to this key.
+
+    Returns:
+        int: Number of rows written.
+    """
+    rows = write_orbits(members, lambda: store.open_write(output_key), workers, compact=compact,
+                        open_grid_sink=_grid_sink(store, grid_key))
+    if rows:
+        print(f"Parquet file uploaded directly to {store.uri(output_key)}")
+    else:
+        print("No valid data found to save.")
+    return rows
+
+def convert_to_file(sources, output_path, executor=None, workers=DECODE_WORKERS, compact=False,
+                    grid_path=None):
+    """
+    Processes .nc files or payloads and writes the Parquet file to local disk.
+
+    Used by the pipelined ingest, where a separate worker uploads the file.
+
+    Args:
+        sources: Iterable of (name, path or bytes) pairs.
+        output_path (str): Local path of the Parquet file to write.
+        executor (Executor): Shared process pool to decode orbits in.
+        workers (int): Size of the process pool, created when `executor` is
+            None; with a shared `executor`, the size of that pool.
+        compact (bool): Write the compact, sorted schema (see `day_format`).
+        grid_path (str): If given, also write the gridded day product to this local path.
+
+    Returns:
+        int: Number of rows written, 0 if no valid data was found (no file is written).
+    """
+    open_grid_sink = (lambda: open(grid_path, "wb")) if grid_path else None
+    rows = write_orbits(sources, lambda: open(output_path, "wb"), workers, executor, compact, open_grid_sink)
+    if not rows:
+        print("No valid data found to save.")
+    return rows
+
+def main(store_location, local_input_folder, gcs_output_folder, output_filename):
+    # Open the destination store (GCS bucket name, gs:// URI or local directory)
+    store = open_store(store_location)
 
-    # Construct the GCS output path
-    gcs_output_path = os.path.join(gcs_output_folder, output_filename)
+    # Construct the output key
+    output_key = f"{gcs_output_folder}/{output_filename}"
     print(f"Starting processing of .nc files in {local_input_folder}")
-    print(f"Output will be saved to: gs://{bucket_name}/{gcs_output_path}")
+    print(f"Output will be saved to: {store.uri(output_key)}")
 
-    # Process files and upload to GCS
-    process_nc_files_to_parquet(local_input_folder, bucket, gcs_output_path)
+    # Process files and upload to the store
+    process_nc_files_to_parquet(local_input_folder, store, output_key)
 
 if __name__ == "__main__":
     if len(sys.argv) != 5:
-        print("Usage: python3 make_parquet.py <BUCKET_NAME> <LOCAL_INPUT_FOLDER> <GCS_OUTPUT_FOLDER> <OUTPUT_FILENAME>")
+        print("Usage: python3 -m sub.make_parquet <BUCKET_NAME|STORE_DIR> <LOCAL_INPUT_FOLDER> <GCS_OUTPUT_FOLDER> <OUTPUT_FILENAME>")
         sys.exit(1)
 
     bucket_name = sys.argv[1]
@@ -0,0 +1,327 @@
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Stage metrics as JSON lines, one per span (a stage run, usually for one day):
+#
+#   {"span": "make_parquet", "date": "2024-01-01", "wall_s": 41.2, "cpu_s": 3.1, "child_cpu_s": 220.4,
+#    "peak_rss_mb": 910.0, "child_peak_rss_mb": 1480.2, "rows_out": 5120334, "bytes_written": 70123456, ...}
+#
+# Spans go to stdout by default, where Cloud Run and Cloud Batch turn them into
+# structured log entries, or are appended to the file named by NO2_METRICS
+# ("off" disables them). Worker processes and Batch tasks inherit the
+# settings through the environment, and every span carries the run id.
+METRICS_ENV = "NO2_METRICS"
+# Directory receiving a cProfile report per stage span, when set
+PROFILE_ENV = "NO2_PROFILE"
+# Run id shared by every process of a run; set by the scheduler for sharded jobs
+RUN_ENV = "NO2_RUN_ID"
+
+# Functions listed in the text report of a profile
+PROFILE_LINES = 40
+
+_local = threading.local()
+_lock = threading.Lock()
+_open_spans = 0
+_profiling = False
+
+
+def configure(metrics=None, profile=None):
+    """Sets the span destination and profile directory for this process and its children."""
+    if metrics:
+        os.environ[METRICS_ENV] = metrics
+    if profile:
+        os.makedirs(profile, exist_ok=True)
+        os.environ[PROFILE_ENV] = os.path.abspath(profile)
+
+
+def add_arguments(parser):
+    """Adds the --metrics and --profile options read by `configure`."""
+    parser.add_argument("--metrics", help="Append the stage spans to this file instead of stdout ('off' to disable)")
+    parser.add_argument("--profile", metavar="DIR", help="Write a cProfile report per stage to this directory")
+
+
+def run_id():
+    if RUN_ENV not in os.environ:
+        os.environ[RUN_ENV] = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{socket.gethostname()}-{os.getpid()}"
+    return os.environ[RUN_ENV]
+
+
+def _peak_rss_mb():
+    """Returns the peak RSS of this process since the last reset, in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS to the current RSS, where the kernel allows it (Linux)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _children_usage():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+
+class Span:
+    """
+    Measurements of one stage run.
+
+    Wall and CPU times cover the span; CPU time is the whole process's, and
+    `child_cpu_s` adds worker processes that exited during the span. The peak
+    RSS is the span's own when no span runs concurrently in another thread,
+    otherwise the process peak since the last reset. `child_peak_rss_mb` is
+    the largest exited worker so far.
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counts = {}
+        self.peak_rss_mb = 0.0
+
+    def add(self, **counts):
+        """Adds to counters such as rows_in, rows_out, bytes_read and bytes_written."""
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + (value or 0)
+
+    def set(self, **attrs):
+        """Adds attributes to the span's record."""
+        self.attrs.update(attrs)
+
+
+def _emit(record):
+    destination = os.getenv(METRICS_ENV, "-")
+    if destination == "off":
+        return
+    line = json.dumps(record, default=str)
+    with _lock:
+        if destination == "-":
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        else:
+            # One write per line in append mode, so processes sharing the file do not interleave
+            with open(destination, "a") as f:
+                f.write(line + "\n")
+
+
+def _start_profile():
+    global _profiling
+    with _lock:
+        # One profiler at a time per process; concurrent stages in other threads go unprofiled
+        if _profiling:
+            return None
+        _profiling = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profile(profiler, span):
+    global _profiling
+    profiler.disable()
+    with _lock:
+        _profiling = False
+    label = "-".join([span.name] + [str(value) for value in span.attrs.values()])
+    label = "".join(c if c.isalnum() or c in "-_." else "_" for c in label)
+    path = os.path.join(os.environ[PROFILE_ENV], f"{run_id()}-{label}-{os.getpid()}")
+    profiler.dump_stats(f"{path}.prof")
+    with open(f"{path}.txt", "w") as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    return f"{path}.prof"
+
+
+@contextmanager
+def span(name, profile=True, **attrs):
+    """
+    Measures a stage and emits its record when it ends, also on failure.
+
+    Usage:
+        with span("make_parquet", date="2024-01-01") as s:
+            rows = ...
+            s.add(rows_out=rows)
+
+    Args:
+        name (str): Stage name.
+        profile (bool): Profile the span when profiling is enabled and no
+            enclosing span is profiled already; wrappers around stage spans
+            pass False so the stages are profiled one by one.
+        **attrs: Attributes recorded with the span, e.g. the date.
+
+    Yields:
+        Span: Collects counters and attributes.
+    """
+    global _open_spans
+    stack = _local.__dict__.setdefault("stack", [])
+    current = Span(name, attrs)
+    with _lock:
+        exclusive = _open_spans == len(stack)
+        _open_spans += 1
+    if stack:
+        stack[-1].peak_rss_mb = max(stack[-1].peak_rss_mb, _peak_rss_mb())
+    reset = exclusive and _reset_peak_rss()
+    stack.append(current)
+
+    profiler = _start_profile() if profile and os.getenv(PROFILE_ENV) else None
+    started = datetime.now()
+    wall, cpu = time.perf_counter(), time.process_time()
+    child_cpu, _ = _children_usage()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        child_cpu_end, child_peak = _children_usage()
+        current.peak_rss_mb = max(current.peak_rss_mb, _peak_rss_mb())
+        stack.pop()
+        if stack:
+            stack[-1].peak_rss_mb = max(stack[-1].peak_rss_mb, current.peak_rss_mb)
+        with _lock:
+            _open_spans -= 1
+
+        record = {
+            "span": name,
+            **current.attrs,
+            "run": run_id(),
+            "task": os.getenv("BATCH_TASK_INDEX"),
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "parent": stack[-1].name if stack else None,
+            "start": started.isoformat(timespec="seconds"),
+            "wall_s": round(wall, 3),
+            "cpu_s": round(cpu, 3),
+            "child_cpu_s": round(child_cpu_end - child_cpu, 3),
+            "peak_rss_mb": round(current.peak_rss_mb, 1),
+            "peak_rss_scope": "span" if reset else "process",
+            "child_peak_rss_mb": round(child_peak, 1),
+            **current.counts,
+            "status": "ok" if error is None else "error",
+        }
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        if profiler is not None:
+            record["profile"] = _stop_profile(profiler, current)
+        _emit(record)
+
+
+# ──── Summary ────
+
+def load_spans(paths):
+    """
+    Reads span records from JSON-lines files, skipping lines that are not spans.
+
+    Files holding a JSON array of log entries, as written by
+    `gcloud logging read --format=json`, are read from their jsonPayload.
+
+    Returns:
+        list: Span records.
+    """
+    records = []
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+        if text.lstrip().startswith("["):
+            entries = [entry.get("jsonPayload", entry) for entry in json.loads(text)]
+        else:
+            entries = []
+            for line in text.splitlines():
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        records.extend(entry for entry in entries if isinstance(entry, dict) and "span" in entry)
+    return records
+
+
+def _percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def summarize(records, by=("span",)):
+    """
+    Aggregates span records, e.g. across every day and task of a backfill.
+
+    Args:
+        records (list): Span records (see `load_spans`).
+        by (tuple): Record fields grouped on.
+
+    Returns:
+        list: One dict per group, sorted by total wall time, largest first.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record.get(field) for field in by), []).append(record)
+
+    rows = []
+    for key, group in groups.items():
+        walls = [record["wall_s"] for record in group]
+        total = {counter: sum(record.get(counter, 0) for record in group)
+                 for counter in ("rows_in", "rows_out", "bytes_read", "bytes_written")}
+        wall = sum(walls)
+        cpu = sum(record["cpu_s"] + record["child_cpu_s"] for record in group)
+        rows.append({
+            **dict(zip(by, key)),
+            "count": len(group),
+            "errors": sum(record["status"] != "ok" for record in group),
+            "wall_s": round(wall, 1),
+            "p50_s": round(_percentile(walls, 0.5), 2),
+            "p95_s": round(_percentile(walls, 0.95), 2),
+            "max_s": round(max(walls), 2),
+            # CPU seconds per wall second: about the number of cores the stage keeps busy
+            "cores": round(cpu / wall, 2) if wall else None,
+            "peak_rss_mb": max(record["peak_rss_mb"] for record in group),
+            "child_peak_rss_mb": max(record["child_peak_rss_mb"] for record in group),
+            **total,
+            "read_mb_per_s": round(total["bytes_read"] / 1e6 / wall, 1) if wall else None,
+        })
+    return sorted(rows, key=lambda row: -row["wall_s"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize stage spans across runs.")
+    parser.add_argument("files", nargs="+", help="JSON-lines span files or logs, or exported log entries")
+    parser.add_argument("--by", default="span", help="Comma-separated fields to group on, e.g. span,task")
+    parser.add_argument("--run", help="Only spans of this run id")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+
+    records = [record for record in load_spans(args.files) if args.run is None or record.get("run") == args.run]
+    if not records:
+        print("No spans found.")
+        sys.exit(1)
+    summary = summarize(records, tuple(args.by.split(",")))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        sys.exit(0)
+
+    columns = list(summary[0])
+    widths = {column: max(len(column), *(len(str(row[column])) for row in summary)) for column in columns}
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in summary:
+        print("  ".join(str(row[column]).rjust(widths[column]) for column in columns))
@@ -0,0 +1,355 @@
+import json
+import os
+import sys
+from datetime import datetime
+import numpy as np
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog
+from sub.grid import NLAT, NLON, RESOLUTION, load_day_grid
+
+# The panel holds the daily mean NO2 of every grid cell, stored cell-major:
+#   <root>/b<block>/t<tile_row>_<tile_col>.npy
+# Each file is a float32 .npy (TILE * TILE, BLOCK_DAYS) array: one row per cell of
+# a TILE x TILE tile, one column per day of a BLOCK_DAYS block. A cell's
+# history is one contiguous row per block, so reading it touches one small
+# range in each block file. Days without data are NaN.
+TILE = 100
+BLOCK_DAYS = 32
+TILE_ROWS = -(-NLAT // TILE)
+TILE_COLS = -(-NLON // TILE)
+
+# Day 0 of block 0; the archive starts in May 2018
+ORIGIN = datetime(2018, 4, 30)
+
+PANEL_VERSION = 1
+PANEL_DIR = os.getenv("PANEL_DIR", "./panel")
+
+# Days transposed together per pass over a block's files
+UPDATE_BATCH = 8
+
+
+def _cell_index(latitude, longitude):
+    """Returns the grid row and column of a coordinate, as in `grid.cell_ids`."""
+    row = int(np.clip(round(latitude / RESOLUTION) + (NLAT - 1) // 2, 0, NLAT - 1))
+    col = int(np.clip(round(longitude / RESOLUTION) + (NLON - 1) // 2, 0, NLON - 1))
+    return row, col
+
+
+class Panel:
+    """
+    Cell-major store of daily per-cell NO2 means, kept on local disk.
+
+    Files are opened as memory maps, so histories are read without loading
+    whole blocks and updates only write the pages they change.
+    """
+
+    def __init__(self, root=PANEL_DIR):
+        self.root = root
+        self.meta_path = os.path.join(root, "meta.json")
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+            if self.meta["version"] != PANEL_VERSION or self.meta["tile"] != TILE \
+                    or self.meta["block_days"] != BLOCK_DAYS:
+                raise ValueError(f"Panel at {root} has an incompatible layout: {self.meta}")
+        else:
+            self.meta = {
+                "version": PANEL_VERSION,
+                "origin": ORIGIN.strftime("%Y-%m-%d"),
+                "tile": TILE,
+                "block_days": BLOCK_DAYS,
+                "dates": [],
+                "md5s": {},
+            }
+
+    @property
+    def dates(self):
+        """Dates already in the panel, as "YYYY-MM-DD" strings."""
+        return set(self.meta["dates"])
+
+    @property
+    def md5s(self):
+        """Catalog md5 of the day file each date was built from, "YYYY-MM-DD" -> md5."""
+        return self.meta.get("md5s", {})
+
+    def _day_index(self, date):
+        index = (date - ORIGIN).days
+        if index < 0:
+            raise ValueError(f"{date:%Y-%m-%d} is before the panel origin {ORIGIN:%Y-%m-%d}")
+        return index
+
+    def _path(self, block, tile_row, tile_col):
+        return os.path.join(self.root, f"b{block:04d}", f"t{tile_row:02d}_{tile_col:02d}.npy")
+
+    def _open(self, block, tile_row, tile_col, mode="r"):
+        """Opens one block file as a memory map; None if reading a file that does not exist."""
+        path = self._path(block, tile_row, tile_col)
+        if not os.path.exists(path):
+            if mode == "r":
+                return None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            values = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(TILE * TILE, BLOCK_DAYS))
+            values[:] = np.nan
+            return values
+        return np.load(path, mmap_mode=mode)
+
+    def _save_meta(self):
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    # ── Updates ──
+
+    def update(self, store, dates, catalog=None):
+        """
+        Adds days to the panel from their gridded day products.
+
+        Days are grouped by block and transposed a few at a time, so each
+        block file is written once per batch rather than once per day.
+        Days already in the panel are rewritten. With a catalog, the md5 of
+        each day file is recorded, so `update_panel` can tell replaced days.
+
+        Args:
+            store (BlobStore): Store holding the day and grid files.
+            dates (iterable): Datetimes to add.
+            catalog (DayCatalog): Day catalog giving the keys, if available.
+
+        Returns:
+            int: Number of days added.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        by_block = {}
+        for date in sorted(dates):
+            block, column = divmod(self._day_index(date), BLOCK_DAYS)
+            by_block.setdefault(block, []).append((date, column))
+
+        added = 0
+        for block, days in sorted(by_block.items()):
+            for start in range(0, len(days), UPDATE_BATCH):
+                batch = []
+                for date, column in days[start:start + UPDATE_BATCH]:
+                    stats = load_day_grid(store, date, catalog)
+                    if stats is None:
+                        print(f"No data for {date:%Y-%m-%d}, skipping")
+                        continue
+                    batch.append((date, column, self._tiles(stats)))
+                if not batch:
+                    continue
+
+                columns = [column for _, column, _ in batch]
+                stacked = np.stack([tiles for _, _, tiles in batch], axis=-1)
+                for tile_row in range(TILE_ROWS):
+                    for tile_col in range(TILE_COLS):
+                        values = self._open(block, tile_row, tile_col, mode="r+")
+                        values[:, columns] = stacked[tile_row, tile_col]
+                        values.flush()
+                        del values
+
+                self.record_dates((date for date, _, _ in batch), catalog)
+                added += len(batch)
+                print(f"Panel block {block}: added {', '.join(f'{d:%Y-%m-%d}' for d, _, _ in batch)}")
+        return added
+
+    def record_dates(self, dates, catalog=None):
+        """Adds datetimes to the dates held by the panel, with their catalog md5s, and saves its metadata."""
+        os.makedirs(self.root, exist_ok=True)
+        dates = {date.strftime("%Y-%m-%d") for date in dates}
+        self.meta["dates"] = sorted(self.dates | dates)
+        if catalog is not None and catalog.exists:
+            self.meta["md5s"] = dict(self.md5s, **{date: (catalog.get(date) or {}).get("md5") for date in dates})
+        self._save_meta()
+
+    def write_tile(self, tile_row, tile_col, start, values):
+        """
+        Writes the daily values of every cell of one tile, from `start` on.
+
+        Args:
+            tile_row (int): Tile row.
+            tile_col (int): Tile column.
+            start (datetime): Date of the first column of `values`.
+            values (ndarray): (TILE * TILE, days) values.
+        """
+        first = self._day_index(start)
+        last = first + values.shape[1] - 1
+        for block in range(first // BLOCK_DAYS, last // BLOCK_DAYS + 1):
+            lo = max(first, block * BLOCK_DAYS)
+            hi = min(last, (block + 1) * BLOCK_DAYS - 1)
+            block_values = self._open(block, tile_row, tile_col, mode="r+")
+            block_values[:, lo - block * BLOCK_DAYS:hi - block * BLOCK_DAYS + 1] = values[:, lo - first:hi - first + 1]
+            block_values.flush()
+            del block_values
+
+    @staticmethod
+    def _tiles(stats):
+        """Returns a day's means as (TILE_ROWS, TILE_COLS, TILE * TILE) float32."""
+        padded = np.full((TILE_ROWS * TILE, TILE_COLS * TILE), np.nan, dtype=np.float32)
+        padded[:NLAT, :NLON] = stats.dense()
+        return (
+            padded.reshape(TILE_ROWS, TILE, TILE_COLS, TILE)
+            .transpose(0, 2, 1, 3)
+            .reshape(TILE_ROWS, TILE_COLS, TILE * TILE)
+        )
+
+    # ── Queries ──
+
+    def _date_span(self, start, end):
+        if not self.meta["dates"] and (start is None or end is None):
+            raise ValueError(f"Panel at {self.root} is empty; pass explicit dates")
+        start = start or datetime.strptime(min(self.meta["dates"]), "%Y-%m-%d")
+        end = end or datetime.strptime(max(self.meta["dates"]), "%Y-%m-%d")
+        return self._day_index(start), self._day_index(end)
+
+    def _dates(self, first, last):
+        return np.arange(
+            np.datetime64(ORIGIN, "D") + first, np.datetime64(ORIGIN, "D") + last + 1, dtype="datetime64[D]"
+        )
+
+    def history(self, latitude, longitude, start=None, end=None):
+        """
+        Returns the daily series of the grid cell containing a point.
+
+        Args:
+            latitude (float): Latitude in degrees.
+            longitude (float): Longitude in degrees.
+            start (datetime): First date, defaults to the first date in the panel.
+            end (datetime): Last date, defaults to the last date in the panel.
+
+        Returns:
+            tuple: (datetime64[D] dates, float32 values), NaN where there is no data.
+        """
+        if not self.meta["dates"]:
+            return np.empty(0, "datetime64[D]"), np.empty(0, np.float32)
+        first, last = self._date_span(start, end)
+        row, col = _cell_index(latitude, longitude)
+        tile_row, tile_col = row // TILE, col // TILE
+        cell = (row % TILE) * TILE + col % TILE
+
+        values = np.full(last - first + 1, np.nan, dtype=np.float32)
+        for block in range(first // BLOCK_DAYS, last // BLOCK_DAYS + 1):
+            block_values = self._open(block, tile_row, tile_col)
+            if block_values is None:
+                continue
+            lo = max(first, block * BLOCK_DAYS)
+            hi = min(last, (block + 1) * BLOCK_DAYS - 1)
+            values[lo - first:hi - first + 1] = block_values[cell, lo - block * BLOCK_DAYS:hi - block * BLOCK_DAYS + 1]
+        return self._dates(first, last), values
+
+    def tile(self, tile_row, tile_col, start=None, end=None):
+        """
+        Returns the daily values of every cell of one tile.
+
+        Args:
+            tile_row (int): Tile row; its cells are grid rows tile_row * TILE onwards.
+            tile_col (int): Tile column.
+            start (datetime): First date, defaults to the first date in the panel.
+            end (datetime): Last date, defaults to the last date in the panel.
+
+        Returns:
+            tuple: (datetime64[D] dates, float32 values of shape (TILE * TILE, dates)),
+            cells in row-major order within the tile.
+        """
+        first, last = self._date_span(start, end)
+        values = np.full((TILE * TILE, last - first + 1), np.nan, dtype=np.float32)
+        for block in range(first // BLOCK_DAYS, last // BLOCK_DAYS + 1):
+            block_values = self._open(block, tile_row, tile_col)
+            if block_values is None:
+                continue
+            lo = max(first, block * BLOCK_DAYS)
+            hi = min(last, (block + 1) * BLOCK_DAYS - 1)
+            values[:, lo - first:hi - first + 1] = block_values[:, lo - block * BLOCK_DAYS:hi - block * BLOCK_DAYS + 1]
+        return self._dates(first, last), values
+
+    def region(self, min_lat, min_lon, max_lat, max_lon, start=None, end=None):
+        """
+        Returns the daily values of every grid cell in a box.
+
+        Args:
+            min_lat, min_lon, max_lat, max_lon (float): Box corners in degrees.
+            start (datetime): First date, defaults to the first date in the panel.
+            end (datetime): Last date, defaults to the last date in the panel.
+
+        Returns:
+            tuple: (datetime64[D] dates, latitudes, longitudes, float32 values
+            of shape (dates, latitudes, longitudes)).
+        """
+        first, last = self._date_span(start, end)
+        row0, col0 = _cell_index(min_lat, min_lon)
+        row1, col1 = _cell_index(max_lat, max_lon)
+        values = np.full((last - first + 1, row1 - row0 + 1, col1 - col0 + 1), np.nan, dtype=np.float32)
+
+        for block in range(first // BLOCK_DAYS, last // BLOCK_DAYS + 1):
+            lo = max(first, block * BLOCK_DAYS)
+            hi = min(last, (block + 1) * BLOCK_DAYS - 1)
+            days = slice(lo - block * BLOCK_DAYS, hi - block * BLOCK_DAYS + 1)
+            for tile_row in range(row0 // TILE, row1 // TILE + 1):
+                for tile_col in range(col0 // TILE, col1 // TILE + 1):
+                    block_values = self._open(block, tile_row, tile_col)
+                    if block_values is None:
+                        continue
+                    # Part of the box inside this tile, in grid and in tile coordinates
+                    r0, r1 = max(row0, tile_row * TILE), min(row1, tile_row * TILE + TILE - 1)
+                    c0, c1 = max(col0, tile_col * TILE), min(col1, tile_col * TILE + TILE - 1)
+                    tile = block_values.reshape(TILE, TILE, BLOCK_DAYS)
+                    window = tile[r0 - tile_row * TILE:r1 - tile_row * TILE + 1,
+                                  c0 - tile_col * TILE:c1 - tile_col * TILE + 1, days]
+                    values[lo - first:hi - first + 1, r0 - row0:r1 - row0 + 1, c0 - col0:c1 - col0 + 1] = \
+                        np.moveaxis(window, -1, 0)
+
+        latitudes = np.round((np.arange(row0, row1 + 1) - (NLAT - 1) // 2) * RESOLUTION, 1)
+        longitudes = np.round((np.arange(col0, col1 + 1) - (NLON - 1) // 2) * RESOLUTION, 1)
+        return self._dates(first, last), latitudes, longitudes, values
+
+
+def update_panel(store, panel, start_date=None, end_date=None):
+    """
+    Adds the catalogued days missing from the panel, and rewrites replaced ones.
+
+    A day is replaced when its catalog md5 differs from the one it was added
+    with, e.g. an NRT day swapped for the final product. Days added before
+    md5s were recorded are rewritten once.
+
+    Args:
+        store (BlobStore): Store holding the day catalog and grid files.
+        panel (Panel): Panel to update.
+        start_date (datetime): Only consider days from this date.
+        end_date (datetime): Only consider days up to this date.
+
+    Returns:
+        int: Number of days added or rewritten.
+    """
+    catalog = DayCatalog.load(store)
+    have = panel.md5s
+    dates = [
+        datetime.strptime(date, "%Y-%m-%d")
+        for date, entry in sorted(catalog.entries.items())
+        if have.get(date) != entry.get("md5")
+        and (start_date is None or date >= start_date.strftime("%Y-%m-%d"))
+        and (end_date is None or date <= end_date.strftime("%Y-%m-%d"))
+        and date >= ORIGIN.strftime("%Y-%m-%d")
+    ]
+    replaced = sum(date.strftime("%Y-%m-%d") in panel.dates for date in dates)
+    print(f"Adding {len(dates) - replaced} days to the panel at {panel.root}, rewriting {replaced}")
+    return panel.update(store, dates, catalog)
+
+
+if __name__ == "__main__":
+    usage = ("Usage: python3 -m sub.panel <BUCKET_NAME|STORE_DIR> <PANEL_DIR> update [START_DATE END_DATE]\n"
+             "       python3 -m sub.panel <BUCKET_NAME|STORE_DIR> <PANEL_DIR> history <LAT> <LON>")
+    if len(sys.argv) < 4 or sys.argv[3] not in ("update", "history"):
+        print(usage)
+        sys.exit(1)
+
+    panel = Panel(sys.argv[2])
+    if sys.argv[3] == "update":
+        dates = [datetime.strptime(value, "%Y-%m-%d") for value in sys.argv[4:6]]
+        if len(dates) == 1:
+            print(usage)
+            sys.exit(1)
+        update_panel(open_store(sys.argv[1]), panel, *dates)
+    else:
+        if len(sys.argv) != 6:
+            print(usage)
+            sys.exit(1)
+        for date, value in zip(*panel.history(float(sys.argv[4]), float(sys.argv[5]))):
+            print(f"{date}: {value}")
@@ -0,0 +1,546 @@
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import pytz
+
+from sub.catalog import describe_day, record_days
+from sub.disk_cache import default_cache
+from sub.download_data import DownloadError, SourceUnavailable, download_file, open_url_stream, resolve_url
+from sub.extract_data import extract_tar_file, iter_nc_members
+from sub.make_countries import CountryDaysFailed, load_raster, make_countries
+from sub.metrics import span
+from sub.pyramid import process_pyramids
+from sub.tiled_days import process_tiled
+from sub.make_parquet import (
+    convert_to_file,
+    folder_sources,
+    process_nc_files_to_parquet,
+    process_nc_members_to_parquet,
+)
+
+# Configure timezone to EST
+est = pytz.timezone("US/Eastern")
+
+# Temporary local directories
+DOWNLOAD_DIRECTORY = "./downloads"  # Local folder within the container
+
+# Directory in the store for processed data
+DATA_DIRECTORY = "data"
+
+# Bundled country polygons used by the country stage
+GEOJSON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "geojson", "ne_110m_admin_0_countries.geojson")
+
+# Source of the daily TROPOMI tars (overridable to point at a local HTTP server)
+SOURCE_URL = os.getenv("TROPOMI_SOURCE_URL", "https://d1qb6yzwaaq4he.cloudfront.net/tropomi/no2")
+
+# Default stage sizes for the pipelined ingest, sized for an n2-standard-8
+DOWNLOAD_WORKERS = 3
+DECODE_DAYS = 2
+DECODE_WORKERS = 6
+UPLOAD_WORKERS = 2
+QUEUE_DEPTH = 2
+
+# Days aggregated to countries in parallel processes
+COUNTRY_WORKERS = 4
+
+# Queue sentinel telling a stage worker to exit
+_DONE = object()
+
+
+def day_urls(current_date):
+    """
+    Returns the candidate tar URLs for a date, final product first.
+
+    The final product replaces the near-real-time ("_nrt") one after a few
+    days; probing both with HEAD picks the best available without a failed GET.
+
+    Args:
+        current_date (datetime): Date to fetch.
+
+    Returns:
+        list: URLs in order of preference.
+    """
+    year = current_date.strftime("%Y")
+    month = current_date.strftime("%m")
+    day = current_date.strftime("%d")
+    return [
+        f"{SOURCE_URL}/{year}/{month}/tropomi_no2_{year}{month}{day}{extension}.tar"
+        for extension in ("", "_nrt")
+    ]
+
+
+def resolve_day(current_date):
+    """
+    Finds the tar to download for a date.
+
+    Raises:
+        DownloadError: If neither the final nor the NRT product is available.
+        SourceUnavailable: If the server could not answer.
+    """
+    remote = resolve_url(day_urls(current_date))
+    if remote is None:
+        raise DownloadError(f"No data available for {current_date.strftime('%Y-%m-%d')}")
+    return remote
+
+
+def day_key(current_date):
+    """Returns the store key of a date's day Parquet file."""
+    return f"{DATA_DIRECTORY}/days/d{current_date.strftime('%Y%m%d')}.parquet"
+
+
+def grid_key(current_date):
+    """Returns the store key of a date's gridded day product (see `grid`)."""
+    return f"{DATA_DIRECTORY}/grid/g{current_date.strftime('%Y%m%d')}.parquet"
+
+
+def is_nrt(url):
+    """Returns True if a tar URL is the near-real-time product."""
+    return url.endswith("_nrt.tar")
+
+
+def catalog_day(store, current_date, remote):
+    """
+    Records a day just written to the store in the day catalog (see `catalog`).
+
+    The tar's URL and ETag are kept as the day's source, so the planner can
+    tell when the upstream product changes (see `planner`).
+
+    Args:
+        store (BlobStore): Store holding the day file.
+        current_date (datetime): Date of the day.
+        remote (RemoteFile): The tar the day was built from.
+
+    Returns:
+        dict: The catalog entry.
+    """
+    source = {"url": remote.url, "etag": remote.etag}
+    entry = describe_day(store, day_key(current_date), current_date, is_nrt(remote.url), grid_key(current_date),
+                         source)
+    record_days(store, [entry])
+    return entry
+
+
+def stream_day(store, current_date, output_key, compact=False):
+    """
+    Converts one day straight from the HTTP response, with no local files.
+
+    The .nc members are read from the tar stream one at a time and handed to
+    h5py in memory.
+
+    Args:
+        store (BlobStore): Destination store for the day Parquet file.
+        current_date (datetime): Date to convert.
+        output_key (str): Key of the day Parquet file.
+        compact (bool): Write the compact day schema (see `day_format`).
+
+    Returns:
+        int: Number of rows written.
+
+    Raises:
+        DownloadError: If the tar is not available.
+    """
+    with span("stream_day", date=current_date.strftime("%Y-%m-%d")) as s:
+        remote = resolve_day(current_date)
+        with open_url_stream(remote.url) as stream:
+            rows = process_nc_members_to_parquet(iter_nc_members(stream), store, output_key, compact=compact,
+                                                 grid_key=grid_key(current_date))
+        s.add(bytes_read=remote.size, rows_out=rows)
+        if rows:
+            s.add(bytes_written=catalog_day(store, current_date, remote)["bytes"])
+    return rows
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def process_dates(store, start_date, end_date, download_directory=DOWNLOAD_DIRECTORY, stream=False,
+                  compact=False):
+    """
+    Downloads, extracts and converts every day in the range, all in this process.
+
+    Days whose tar cannot be downloaded are skipped. An extraction or
+    conversion failure stops the run, as the remaining days would likely fail
+    the same way. Each day written is recorded in the day catalog.
+
+    Raises:
+        SourceUnavailable: After the other days, if the server could not
+            answer for some, so the run fails and is retried.
+
+    Args:
+        store (BlobStore): Destination store for the day Parquet files.
+        start_date (datetime): First date to process (EST-localized).
+        end_date (datetime): Last date to process (EST-localized).
+        download_directory (str): Scratch directory for tars and extracted files.
+        stream (bool): Read the .nc members straight from the HTTP response
+            instead of downloading and extracting the tar to disk.
+        compact (bool): Write the compact day schema (see `day_format`).
+    """
+    extracted_directory = os.path.join(download_directory, "extracted")
+    unavailable = []
+    current_date = start_date
+    while current_date <= end_date:
+        output_key = day_key(current_date)
+
+        if stream:
+            try:
+                stream_day(store, current_date, output_key, compact)
+            except SourceUnavailable as e:
+                print(f"Source unavailable for {current_date.strftime('%Y-%m-%d')}: {e}")
+                unavailable.append(current_date.strftime("%Y-%m-%d"))
+            except DownloadError as e:
+                print(f"Error downloading data for {current_date.strftime('%Y-%m-%d')}: {e}")
+            except Exception as e:
+                print(f"Error streaming data for {current_date.strftime('%Y-%m-%d')}: {e}")
+                break
+            current_date += timedelta(days=1)
+            continue
+
+        os.makedirs(download_directory, exist_ok=True)
+
+        # Step 1: Download the file, skipping days that are not available.
+        # An interrupted download leaves a .part file that the next run resumes.
+        formatted_date = current_date.strftime("%Y-%m-%d")
+        try:
+            with span("download", date=formatted_date) as s:
+                cache = default_cache()
+                before = cache.thread_counts()
+                remote = resolve_day(current_date)
+                tar_file_path = download_file(remote.url, download_directory, remote=remote, cache=cache)
+                s.add(bytes_read=os.path.getsize(tar_file_path), **cache.counts_since(before))
+            print(f"Successfully downloaded data for {current_date.strftime('%Y-%m-%d')}.")
+        except (DownloadError, OSError) as e:
+            if isinstance(e, SourceUnavailable):
+                unavailable.append(formatted_date)
+            print(f"Error downloading data for {current_date.strftime('%Y-%m-%d')}: {e}")
+            current_date += timedelta(days=1)
+            if current_date <= end_date:
+                print(f"Moving to the next date: {current_date.strftime('%Y-%m-%d')}")
+            continue
+
+        # Step 2: Extract the .tar file
+        try:
+            with span("extract", date=formatted_date) as s:
+                extract_tar_file(tar_file_path, extracted_directory)
+                s.add(bytes_read=os.path.getsize(tar_file_path), bytes_written=_directory_size(extracted_directory))
+        except Exception as e:
+            print(f"Error extracting files: {e}")
+            break
+
+        # Step 3: Convert .nc files to Parquet and record the day in the catalog
+        try:
+            with span("make_parquet", date=formatted_date) as s:
+                rows = process_nc_files_to_parquet(extracted_directory, store, output_key, compact=compact,
+                                                   grid_key=grid_key(current_date))
+                s.add(bytes_read=_directory_size(extracted_directory), rows_out=rows)
+                if rows:
+                    s.add(bytes_written=catalog_day(store, current_date, remote)["bytes"])
+        except Exception as e:
+            print(f"Error creating Parquet file: {e}")
+            break
+
+        # Cleanup after processing the day's data, keeping other days' partial downloads
+        print(f"Cleaning up after {current_date.strftime('%Y-%m-%d')}...")
+        try:
+            shutil.rmtree(extracted_directory)
+            os.remove(tar_file_path)
+            print(f"Temporary files for {current_date.strftime('%Y-%m-%d')} deleted successfully.")
+        except Exception as e:
+            print(f"Error cleaning up temporary files for {current_date.strftime('%Y-%m-%d')}: {e}")
+
+        current_date += timedelta(days=1)
+
+    if unavailable:
+        raise SourceUnavailable(f"Source server unavailable for {unavailable}")
+
+
+def process_countries(store, start_date, end_date, geojson_path=GEOJSON_PATH, workers=COUNTRY_WORKERS,
+                      compact=True):
+    """
+    Updates the country-level Parquet files for the date range.
+
+    The country raster is loaded once per process and shared across runs.
+
+    Args:
+        store (BlobStore): Store holding the day and country Parquet files.
+        start_date (datetime): First date to process.
+        end_date (datetime): Last date to process.
+        geojson_path (str): Path to the countries GeoJSON file.
+        workers (int): Number of days aggregated in parallel processes.
+        compact (bool): Compact the country parts afterwards (see `make_countries`).
+
+    Returns:
+        list: Dates (naive datetimes) whose country rows could not be
+        updated; empty on success.
+    """
+    raster = load_raster(os.path.abspath(geojson_path))
+    try:
+        with span("make_countries", start=f"{start_date:%Y-%m-%d}", end=f"{end_date:%Y-%m-%d}") as s:
+            rows = make_countries(
+                store,
+                f"{DATA_DIRECTORY}/days",  # Folder with day Parquets
+                f"{DATA_DIRECTORY}/countries",  # Folder for country Parquets
+                raster,
+                # Day files are named by calendar date, so compare without timezone
+                start_date.replace(tzinfo=None),
+                end_date.replace(tzinfo=None),
+                workers=workers,
+                compact=compact,
+            )
+            s.add(rows_out=len(rows))
+        print("Country processing completed successfully.")
+        return []
+    except CountryDaysFailed as e:
+        print(f"Error processing countries: {e}")
+        return e.dates
+    except Exception as e:
+        print(f"Error processing countries: {e}")
+        dates, current_date = [], start_date.replace(tzinfo=None)
+        while current_date <= end_date.replace(tzinfo=None):
+            dates.append(current_date)
+            current_date += timedelta(days=1)
+        return dates
+
+
+def process_day_pyramids(store, start_date, end_date):
+    """
+    Builds the map pyramids of the date range from the gridded day products.
+
+    Args:
+        store (BlobStore): Store holding the grid files; receives the tiles.
+        start_date (datetime): First date to process.
+        end_date (datetime): Last date to process.
+    """
+    try:
+        with span("pyramids", start=f"{start_date:%Y-%m-%d}", end=f"{end_date:%Y-%m-%d}"):
+            process_pyramids(store, "day", start_date.replace(tzinfo=None), end_date.replace(tzinfo=None))
+        print("Pyramid processing completed successfully.")
+    except Exception as e:
+        print(f"Error building pyramids: {e}")
+
+
+def process_tiled_days(store, start_date, end_date):
+    """
+    Writes the date/tile-partitioned copy of the date range's day files (see `tiled_days`).
+
+    Args:
+        store (BlobStore): Store holding the day files; receives the tiles.
+        start_date (datetime): First date to process.
+        end_date (datetime): Last date to process.
+
+    Returns:
+        bool: True if every day was written.
+    """
+    try:
+        process_tiled(store, start_date.replace(tzinfo=None), end_date.replace(tzinfo=None))
+        print("Tiled day layout completed successfully.")
+        return True
+    except Exception as e:
+        print(f"Error writing the tiled day layout: {e}")
+        return False
+
+
+def decode_day(tar_file_path, work_directory, formatted_date, orbit_pool, stream=False, compact=False,
+               workers=DECODE_WORKERS):
+    """
+    Converts one day's tar to a local Parquet file.
+
+    Runs in a decode thread of the pipelined ingest; the orbits themselves are
+    decoded in the shared process pool. The tar and any extracted files are
+    removed as soon as they have been consumed.
+
+    Args:
+        tar_file_path (str): Local path of the downloaded tar.
+        work_directory (str): Scratch directory for this day.
+        formatted_date (str): Date as YYYYMMDD, used for the output file name.
+        orbit_pool (Executor): Process pool decoding orbit files.
+        stream (bool): Read the .nc members out of the tar in memory instead
+            of extracting them to disk first.
+        compact (bool): Write the compact day schema (see `day_format`).
+        workers (int): Size of `orbit_pool`.
+
+    Returns:
+        tuple or None: Paths of the day Parquet file and of the gridded day
+        product, or None if the day had no valid data.
+    """
+    output_path = os.path.join(work_directory, f"d{formatted_date}.parquet")
+    grid_path = os.path.join(work_directory, f"g{formatted_date}.parquet")
+    if stream:
+        rows = convert_to_file(iter_nc_members(tar_file_path), output_path, executor=orbit_pool,
+                               workers=workers, compact=compact, grid_path=grid_path)
+    else:
+        extracted_directory = os.path.join(work_directory, "extracted")
+        extract_tar_file(tar_file_path, extracted_directory)
+        rows = convert_to_file(folder_sources(extracted_directory), output_path, executor=orbit_pool,
+                               workers=workers, compact=compact, grid_path=grid_path)
+        shutil.rmtree(extracted_directory, ignore_errors=True)
+    os.remove(tar_file_path)
+    return (output_path, grid_path) if rows else None
+
+
+def process_dates_pipelined(store, start_date, end_date,
+                            download_workers=DOWNLOAD_WORKERS,
+                            decode_days=DECODE_DAYS,
+                            decode_workers=DECODE_WORKERS,
+                            upload_workers=UPLOAD_WORKERS,
+                            queue_depth=QUEUE_DEPTH,
+                            download_directory=DOWNLOAD_DIRECTORY,
+                            stream=False,
+                            compact=False):
+    """
+    Ingests a date range with the download, decode and upload stages overlapping.
+
+    Downloads for the following days run while earlier days are decoded in a
+    process pool and uploaded. The queues between stages are bounded, so at
+    most `download_workers + queue_depth + decode_days` tars and
+    `queue_depth + upload_workers` Parquet files are on local disk at once.
+    Unlike `process_dates`, a failed day does not stop the run. Each day is
+    recorded in the day catalog once uploaded.
+
+    Args:
+        store (BlobStore): Destination store for the day Parquet files.
+        start_date (datetime): First date to process (EST-localized).
+        end_date (datetime): Last date to process (EST-localized).
+        download_workers (int): Concurrent tar downloads.
+        decode_days (int): Days being decoded at the same time.
+        decode_workers (int): Worker processes decoding orbits, shared by all days.
+        upload_workers (int): Concurrent uploads to the store.
+        queue_depth (int): Days allowed to wait between two stages.
+        download_directory (str): Scratch directory, one subdirectory per day.
+        stream (bool): Decode the .nc members straight from the downloaded tar
+            instead of extracting them to disk.
+        compact (bool): Write the compact day schema (see `day_format`).
+
+    Returns:
+        dict: Status per date ("ok", "missing", "unavailable", "empty" or "failed").
+
+    Raises:
+        SourceUnavailable: After the other days, if the server could not
+            answer for some, so the run fails and is retried.
+    """
+    date_queue = queue.Queue()
+    current_date = start_date
+    while current_date <= end_date:
+        date_queue.put(current_date)
+        current_date += timedelta(days=1)
+
+    decode_queue = queue.Queue(maxsize=queue_depth)
+    upload_queue = queue.Queue(maxsize=queue_depth)
+    results = {}
+    results_lock = threading.Lock()
+
+    def record(day, status):
+        with results_lock:
+            results[day.strftime("%Y-%m-%d")] = status
+
+    def download_worker():
+        while True:
+            try:
+                day = date_queue.get_nowait()
+            except queue.Empty:
+                return
+            work_directory = os.path.join(download_directory, day.strftime("%Y%m%d"))
+            os.makedirs(work_directory, exist_ok=True)
+            try:
+                with span("download", date=day.strftime("%Y-%m-%d")) as s:
+                    cache = default_cache()
+                    before = cache.thread_counts()
+                    remote = resolve_day(day)
+                    tar_file_path = download_file(remote.url, work_directory, remote=remote, cache=cache)
+                    s.add(bytes_read=os.path.getsize(tar_file_path), **cache.counts_since(before))
+            except (DownloadError, OSError) as e:
+                # The work directory keeps any partial download for the next run
+                print(f"Error downloading data for {day.strftime('%Y-%m-%d')}: {e}")
+                record(day, "unavailable" if isinstance(e, SourceUnavailable) else "missing")
+                continue
+            # Blocks while the decoders are behind, capping the tars on disk
+            decode_queue.put((day, work_directory, tar_file_path, remote))
+
+    def decode_worker(orbit_pool):
+        while True:
+            item = decode_queue.get()
+            if item is _DONE:
+                return
+            day, work_directory, tar_file_path, remote = item
+            try:
+                with span("decode", date=day.strftime("%Y-%m-%d")) as s:
+                    s.add(bytes_read=os.path.getsize(tar_file_path))
+                    paths = decode_day(
+                        tar_file_path, work_directory, day.strftime("%Y%m%d"), orbit_pool, stream, compact,
+                        decode_workers,
+                    )
+                    if paths is not None:
+                        s.add(bytes_written=sum(os.path.getsize(path) for path in paths))
+            except Exception as e:
+                print(f"Error decoding {day.strftime('%Y-%m-%d')}: {e}")
+                shutil.rmtree(work_directory, ignore_errors=True)
+                record(day, "failed")
+                continue
+            if paths is None:
+                shutil.rmtree(work_directory, ignore_errors=True)
+                record(day, "empty")
+                continue
+            upload_queue.put((day, work_directory, paths, remote))
+
+    def upload_worker():
+        while True:
+            item = upload_queue.get()
+            if item is _DONE:
+                return
+            day, work_directory, (parquet_path, grid_path), remote = item
+            try:
+                with span("upload", date=day.strftime("%Y-%m-%d")) as s:
+                    for path, output_key in ((grid_path, grid_key(day)), (parquet_path, day_key(day))):
+                        with open(path, "rb") as f:
+                            store.put(output_key, f)
+                        s.add(bytes_written=os.path.getsize(path))
+                        print(f"Parquet file uploaded to {store.uri(output_key)}")
+                    catalog_day(store, day, remote)
+                record(day, "ok")
+            except Exception as e:
+                print(f"Error uploading data for {day.strftime('%Y-%m-%d')}: {e}")
+                record(day, "failed")
+            finally:
+                shutil.rmtree(work_directory, ignore_errors=True)
+
+    def start(target, count, *args):
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    with ProcessPoolExecutor(max_workers=decode_workers) as orbit_pool:
+        downloaders = start(download_worker, download_workers)
+        decoders = start(decode_worker, decode_days, orbit_pool)
+        uploaders = start(upload_worker, upload_workers)
+
+        # Shut the stages down in order once each upstream stage has drained
+        for thread in downloaders:
+            thread.join()
+        for _ in decoders:
+            decode_queue.put(_DONE)
+        for thread in decoders:
+            thread.join()
+        for _ in uploaders:
+            upload_queue.put(_DONE)
+        for thread in uploaders:
+            thread.join()
+
+    for day, status in sorted(results.items()):
+        print(f"{day}: {status}")
+    unavailable = sorted(day for day, status in results.items() if status == "unavailable")
+    if unavailable:
+        raise SourceUnavailable(f"Source server unavailable for {unavailable}")
+    return results
+
+
+def run(store, start_date, end_date):
+    """Runs the full ingest (days, then countries and map pyramids) for a date range."""
+    process_dates(store, start_date, end_date)
+    process_countries(store, start_date, end_date)
+    process_day_pyramids(store, start_date, end_date)
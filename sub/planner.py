@@ -0,0 +1,295 @@
+import argparse
+import hashlib
+import os
+from datetime import datetime, timedelta
+from sub import pipeline
+from sub.anomaly import RA_PREFIX, process_anomalies
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog, update_catalog
+from sub.download_data import SourceUnavailable, resolve_url
+from sub.scheduler import MAX_RUNNING_TASKS, make_backend, ra_job
+
+# Lineage of the derived outputs: for each date and stage, a fingerprint of
+# the inputs the output was last built from. Same document format as the day
+# catalog, so it is updated with the same conditional writes. The lineage of
+# the day files themselves (raw tar -> day file) is the `source` of their
+# catalog entries.
+#
+#   raw tar (URL, ETag) -> day file (md5) -> country rows     (the day's md5)
+#                                         -> tiled day        (the day's md5)
+#                                         -> RA day T         (md5s of days T-6..T)
+#                                            -> anomaly day T (md5 of RA file T)
+LINEAGE_KEY = "data/lineage.json"
+STAGES = ("ingest", "countries", "tiled", "ra", "anomaly")
+
+# Days of the rolling-average window, as in `sub.ra.incremental`
+RA_WINDOW_DAYS = 7
+
+# Days checked for new or replaced source tars by the daily run; the final
+# product replaces the NRT one within about a week
+LOOKBACK_DAYS = 14
+
+
+def _dates(start, end):
+    dates = []
+    while start <= end:
+        dates.append(start)
+        start += timedelta(days=1)
+    return dates
+
+
+def _runs(dates):
+    """Groups dates into (first, last) runs of consecutive days."""
+    runs = []
+    for date in sorted(dates):
+        if runs and date - runs[-1][1] == timedelta(days=1):
+            runs[-1][1] = date
+        else:
+            runs.append([date, date])
+    return [tuple(run) for run in runs]
+
+
+def _run_anomalies(store, first, last):
+    """Scores the anomalies of a run of dates; returns True if it succeeded."""
+    try:
+        process_anomalies(store, first, last)
+        return True
+    except Exception as e:
+        print(f"Error scoring anomalies for {first:%Y-%m-%d}..{last:%Y-%m-%d}: {e}")
+        return False
+
+
+def _run_ra_job(first, last, backend, parallelism=None):
+    """Runs the rolling-average job for a run of dates and waits for it; returns True if every task succeeded."""
+    runner = make_backend(backend, parallelism or MAX_RUNNING_TASKS)
+    if backend == "local":
+        return not any(runner.submit(ra_job(first, last)).values())
+    result = runner.submit(ra_job(first, last), wait=True)
+    return result is not None and runner.state(result) == "SUCCEEDED"
+
+
+class Planner:
+    """
+    Finds the outputs whose inputs changed since they were built, and rebuilds only those.
+
+    Fingerprints are compared stage by stage: a day re-ingested with the same
+    content keeps its md5, so nothing downstream of it is rebuilt.
+
+    Args:
+        store (BlobStore): Store holding the data, the catalog and the lineage.
+        start_date (datetime): First date whose sources are checked.
+        end_date (datetime): Last date whose sources are checked. Rolling
+            averages and anomalies are checked up to RA_WINDOW_DAYS - 1 days
+            later, as the days in range feed their windows.
+    """
+
+    def __init__(self, store, start_date, end_date):
+        self.store = store
+        self.start_date = start_date
+        self.end_date = end_date
+        self.reload()
+
+    def reload(self):
+        self.catalog = DayCatalog.load(self.store)
+        self.lineage = DayCatalog.load(self.store, LINEAGE_KEY).entries
+
+    def _dates_for(self, stage):
+        if stage in ("ingest", "countries", "tiled"):
+            return _dates(self.start_date, self.end_date)
+        return _dates(self.start_date, self.end_date + timedelta(days=RA_WINDOW_DAYS - 1))
+
+    # ── Fingerprints ──
+
+    def fingerprint(self, stage, date):
+        """Returns the current fingerprint of an output's inputs, or None if it cannot be built."""
+        entry = self.catalog.get(date)
+        if stage in ("countries", "tiled"):
+            return entry["md5"] if entry else None
+        if stage == "ra":
+            if entry is None:
+                return None
+            window = _dates(date - timedelta(days=RA_WINDOW_DAYS - 1), date)
+            parts = [f"{day:%Y-%m-%d}:{(self.catalog.get(day) or {}).get('md5', '-')}" for day in window]
+            return hashlib.sha1("|".join(parts).encode()).hexdigest()[:16]
+        if stage == "anomaly":
+            info = self.store.stat(f"{RA_PREFIX}ra_{date.strftime('%Y%m%d')}.parquet")
+            return info.md5 if info else None
+        raise ValueError(f"Stage {stage!r} has no fingerprint")
+
+    def stale_sources(self):
+        """
+        Returns the dates whose source tar is new or was replaced, probing each with HEAD.
+
+        Days ingested before sources were recorded count as current while
+        their product type (NRT or final) is unchanged.
+
+        Returns:
+            dict: "YYYY-MM-DD" -> RemoteFile to ingest.
+        """
+        stale = {}
+        for date in self._dates_for("ingest"):
+            remote = resolve_url(pipeline.day_urls(date))
+            if remote is None:
+                continue
+            entry = self.catalog.get(date)
+            if entry is None:
+                stale[date.strftime("%Y-%m-%d")] = remote
+            elif "source" in entry:
+                if (entry["source"]["url"], entry["source"]["etag"]) != (remote.url, remote.etag):
+                    stale[date.strftime("%Y-%m-%d")] = remote
+            elif entry["nrt"] != pipeline.is_nrt(remote.url):
+                stale[date.strftime("%Y-%m-%d")] = remote
+        return stale
+
+    def stale(self, stage):
+        """Returns the dates of a derived stage whose recorded fingerprint is not the current one."""
+        dates = []
+        for date in self._dates_for(stage):
+            current = self.fingerprint(stage, date)
+            if current is not None and self.lineage.get(date.strftime("%Y-%m-%d"), {}).get(stage) != current:
+                dates.append(date)
+        return dates
+
+    def plan(self, sources=None):
+        """
+        Returns the outputs to rebuild, predicting what the ingest will invalidate.
+
+        A day being re-ingested invalidates its country rows, its tiled copy, the rolling
+        averages of that day and the RA_WINDOW_DAYS - 1 days after it, and
+        their anomalies. The execution re-checks every stage against the
+        actual fingerprints, so the prediction is an upper bound.
+
+        Args:
+            sources (dict): Result of `stale_sources`, probed if None.
+
+        Returns:
+            dict: Stage -> sorted list of datetimes.
+        """
+        sources = self.stale_sources() if sources is None else sources
+        ingest = {datetime.strptime(date, "%Y-%m-%d") for date in sources}
+        countries = set(self.stale("countries")) | ingest
+        tiled = set(self.stale("tiled")) | ingest
+        available = {date for date in self._dates_for("ra")
+                     if self.catalog.get(date) is not None or date in ingest}
+        ra = set(self.stale("ra")) | {
+            date + timedelta(days=offset)
+            for date in ingest for offset in range(RA_WINDOW_DAYS)
+            if date + timedelta(days=offset) in available
+        }
+        anomaly = set(self.stale("anomaly")) | ra
+        return {"ingest": sorted(ingest), "countries": sorted(countries), "tiled": sorted(tiled),
+                "ra": sorted(ra), "anomaly": sorted(anomaly)}
+
+    def record(self, stage, dates):
+        """Records the current fingerprints of freshly built outputs."""
+        values = {date.strftime("%Y-%m-%d"): self.fingerprint(stage, date) for date in dates}
+
+        def update(entries):
+            for date, value in values.items():
+                entries.setdefault(date, {"date": date})[stage] = value
+
+        self.lineage = update_catalog(self.store, update, LINEAGE_KEY).entries
+
+    # ── Execution ──
+
+    def execute(self, stages=STAGES, backend="batch", parallelism=None):
+        """
+        Rebuilds the stale outputs of the given stages, in pipeline order.
+
+        Each stage is planned from the fingerprints left by the stages before
+        it, and its lineage is recorded only once it succeeded, so a failed
+        stage is retried by the next run.
+
+        Args:
+            stages (tuple): Stages to run, a subset of STAGES.
+            backend (str): "batch" or "local", for the rolling-average job.
+            parallelism (int): Rolling-average tasks running at a time.
+
+        Returns:
+            dict: Stage -> dates rebuilt.
+
+        Raises:
+            SourceUnavailable: Once the other stages ran, if the source server
+                could not answer for some days, so the run is retried.
+        """
+        done = {}
+        unavailable = None
+        if "ingest" in stages:
+            sources = self.stale_sources()
+            done["ingest"] = [datetime.strptime(date, "%Y-%m-%d") for date in sorted(sources)]
+            for first, last in _runs(done["ingest"]):
+                first, last = pipeline.est.localize(first), pipeline.est.localize(last)
+                try:
+                    pipeline.process_dates(self.store, first, last)
+                except SourceUnavailable as e:
+                    unavailable = e
+                pipeline.process_day_pyramids(self.store, first, last)
+            self.reload()
+
+        if "countries" in stages:
+            failed = set()
+            stale = self.stale("countries")
+            for first, last in _runs(stale):
+                failed.update(pipeline.process_countries(self.store, pipeline.est.localize(first),
+                                                         pipeline.est.localize(last)))
+            # Days that failed keep their old fingerprint, so the next run retries them
+            done["countries"] = [date for date in stale if date not in failed]
+            if done["countries"]:
+                self.record("countries", done["countries"])
+
+        if "tiled" in stages:
+            done["tiled"] = self.stale("tiled")
+            succeeded = [
+                pipeline.process_tiled_days(self.store, pipeline.est.localize(first), pipeline.est.localize(last))
+                for first, last in _runs(done["tiled"])
+            ]
+            if done["tiled"] and all(succeeded):
+                self.record("tiled", done["tiled"])
+
+        if "ra" in stages:
+            done["ra"] = self.stale("ra")
+            succeeded = [_run_ra_job(first, last, backend, parallelism) for first, last in _runs(done["ra"])]
+            if done["ra"] and all(succeeded):
+                self.record("ra", done["ra"])
+
+        if "anomaly" in stages:
+            done["anomaly"] = self.stale("anomaly")
+            succeeded = [_run_anomalies(self.store, first, last) for first, last in _runs(done["anomaly"])]
+            if done["anomaly"] and all(succeeded):
+                self.record("anomaly", done["anomaly"])
+
+        for stage, dates in done.items():
+            print(f"🧾 {stage}: rebuilt {len(dates)} dates"
+                  + (f" ({', '.join(f'{d:%Y-%m-%d}' for d in dates)})" if dates else ""))
+        if unavailable is not None:
+            raise unavailable
+        return done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan and run the minimal recompute after inputs change.")
+    parser.add_argument("command", choices=["plan", "run"])
+    parser.add_argument("start_date", nargs="?", help="YYYY-MM-DD, defaults to LOOKBACK_DAYS before the end")
+    parser.add_argument("end_date", nargs="?", help="YYYY-MM-DD, defaults to yesterday")
+    parser.add_argument("--store", default=os.getenv("STORE_LOCATION", os.getenv("BUCKET_NAME", "no2-app-data")),
+                        help="GCS bucket name, gs:// URI or local directory")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma-separated subset of {STAGES}")
+    parser.add_argument("--backend", choices=["batch", "local"], default="batch",
+                        help="Where the rolling-average job runs")
+    parser.add_argument("--parallelism", type=int, help="Rolling-average tasks running at a time")
+    args = parser.parse_args()
+
+    end = (datetime.strptime(args.end_date, "%Y-%m-%d") if args.end_date
+           else datetime.now(pipeline.est).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+           - timedelta(days=1))
+    start = datetime.strptime(args.start_date, "%Y-%m-%d") if args.start_date else end - timedelta(days=LOOKBACK_DAYS)
+    stages = tuple(stage for stage in STAGES if stage in args.stages.split(","))
+
+    planner = Planner(open_store(args.store), start, end)
+    if args.command == "plan":
+        plan = planner.plan() if "ingest" in stages else planner.plan(sources={})
+        for stage in stages:
+            print(f"{stage}: {len(plan[stage])} dates"
+                  + (f" ({', '.join(f'{d:%Y-%m-%d}' for d in plan[stage])})" if plan[stage] else ""))
+    else:
+        planner.execute(stages, args.backend, args.parallelism)
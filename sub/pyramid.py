@@ -0,0 +1,197 @@
+import io
+import sys
+from datetime import datetime, timedelta
+import numpy as np
+import pyarrow.parquet as pq
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog
+from sub.grid import NLAT, NLON, cell_ids, load_day_grid
+
+# Map pyramid: per-cell NO2 sums and counts aggregated to coarser grids, cut
+# into fixed-size tiles:
+#   data/pyramid/<source>/<YYYYMMDD>/<z>/<x>/<y>.npz
+# Zoom 0 is the coarsest level. Rows run from north to south and columns from
+# -180° eastwards; tile x is the column block and tile y the row block. Each
+# tile holds `sum` (float64) and `count` (uint32) arrays of TILE x TILE cells,
+# so tiles from several days or sources merge by adding them.
+PYRAMID_PREFIX = "data/pyramid/"
+SOURCES = ("day", "ra")
+
+# Resolutions in degrees, from zoom 0 up. The finest level is the native
+# 0.1° grid, whose cells are the grid nodes.
+LEVELS = (5.0, 2.5, 1.0, 0.5, 0.25, 0.1)
+TILE = 256
+
+# Cell boundaries are computed on a 0.05° lattice, where every level's
+# resolution and every grid node are whole numbers, so the floor mapping is exact
+_UNIT = 0.05
+_NATIVE_SPAN = 2
+
+
+def level_shape(zoom):
+    """Returns the (rows, columns) of a pyramid level."""
+    span = round(LEVELS[zoom] / _UNIT)
+    if span == _NATIVE_SPAN:
+        return NLAT, NLON
+    return 180 * 20 // span, 360 * 20 // span
+
+
+def tile_grid(zoom):
+    """Returns the number of (x, y) tiles of a pyramid level."""
+    rows, columns = level_shape(zoom)
+    return -(-columns // TILE), -(-rows // TILE)
+
+
+def build_levels(cells, count, no2_sum):
+    """
+    Aggregates per-cell sums and counts to every pyramid level.
+
+    The offsets of the cells from the north-west corner are computed once;
+    each level is then one floor division and one bincount over the cells
+    that have data.
+
+    Args:
+        cells (ndarray): Grid cell ids (see `grid.cell_ids`), unique.
+        count (ndarray): Observations in each cell.
+        no2_sum (ndarray): Sum of the observations in each cell.
+
+    Returns:
+        list: One (count, sum) pair of dense (rows, columns) arrays per zoom level.
+    """
+    lat_index, lon_index = np.divmod(np.asarray(cells, dtype=np.int64), NLON)
+    north = (NLAT - 1 - lat_index) * _NATIVE_SPAN
+    west = lon_index * _NATIVE_SPAN
+    count = np.asarray(count, dtype=np.float64)
+    no2_sum = np.asarray(no2_sum, dtype=np.float64)
+
+    levels = []
+    for zoom, resolution in enumerate(LEVELS):
+        span = round(resolution / _UNIT)
+        rows, columns = level_shape(zoom)
+        # The south pole row and the 180° meridian fold into the last cell of coarse levels
+        index = np.minimum(north // span, rows - 1) * columns + np.minimum(west // span, columns - 1)
+        levels.append((
+            np.bincount(index, weights=count, minlength=rows * columns).astype(np.uint32).reshape(rows, columns),
+            np.bincount(index, weights=no2_sum, minlength=rows * columns).reshape(rows, columns),
+        ))
+    return levels
+
+
+def cut_tiles(levels):
+    """
+    Cuts pyramid levels into TILE x TILE tiles, skipping tiles without data.
+
+    Edge tiles are padded with empty cells, so every tile has the same shape.
+
+    Returns:
+        dict: (z, x, y) -> (count, sum) arrays.
+    """
+    tiles = {}
+    for zoom, (count, no2_sum) in enumerate(levels):
+        tiles_x, tiles_y = tile_grid(zoom)
+        padded_count = np.zeros((tiles_y * TILE, tiles_x * TILE), np.uint32)
+        padded_sum = np.zeros((tiles_y * TILE, tiles_x * TILE))
+        padded_count[:count.shape[0], :count.shape[1]] = count
+        padded_sum[:no2_sum.shape[0], :no2_sum.shape[1]] = no2_sum
+        for y in range(tiles_y):
+            for x in range(tiles_x):
+                window = np.s_[y * TILE:(y + 1) * TILE, x * TILE:(x + 1) * TILE]
+                if padded_count[window].any():
+                    tiles[(zoom, x, y)] = (padded_count[window], padded_sum[window])
+    return tiles
+
+
+def tile_key(source, date, zoom, x, y):
+    return f"{PYRAMID_PREFIX}{source}/{date.strftime('%Y%m%d')}/{zoom}/{x}/{y}.npz"
+
+
+def tile_to_bytes(count, no2_sum):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, count=count, sum=no2_sum)
+    return buffer.getvalue()
+
+
+def tile_from_bytes(data):
+    """Returns the (count, sum) arrays of a stored tile."""
+    saved = np.load(io.BytesIO(data), allow_pickle=False)
+    return saved["count"], saved["sum"]
+
+
+def tile_bounds(zoom, x, y):
+    """Returns the (north, west) corner of a tile and its cell size, in degrees."""
+    resolution = LEVELS[zoom]
+    if round(resolution / _UNIT) == _NATIVE_SPAN:
+        # Native cells are centred on the grid nodes
+        return 90.0 + resolution / 2 - y * TILE * resolution, -180.0 - resolution / 2 + x * TILE * resolution, resolution
+    return 90.0 - y * TILE * resolution, -180.0 + x * TILE * resolution, resolution
+
+
+def write_pyramid(store, source, date, cells, count, no2_sum):
+    """
+    Builds one day's pyramid and writes its tiles.
+
+    Args:
+        store (BlobStore): Store receiving the tiles.
+        source (str): "day" for daily means, "ra" for rolling averages.
+        date (datetime): Day of the data.
+        cells, count, no2_sum (ndarray): Per-cell aggregates (see `build_levels`).
+
+    Returns:
+        int: Number of tiles written.
+    """
+    tiles = cut_tiles(build_levels(cells, count, no2_sum))
+    store.put_many({
+        tile_key(source, date, *address): tile_to_bytes(*arrays) for address, arrays in tiles.items()
+    })
+    print(f"Pyramid {source} {date:%Y-%m-%d}: {len(tiles)} tiles")
+    return len(tiles)
+
+
+def write_ra_pyramid(store, date, lat_bin, lon_bin, no2_ra):
+    """Writes the pyramid of one day of rolling averages, each cell weighing one."""
+    return write_pyramid(store, "ra", date, cell_ids(lat_bin, lon_bin), np.ones(len(no2_ra), np.uint32), no2_ra)
+
+
+def process_pyramids(store, source, start_date, end_date):
+    """
+    Builds the pyramids of a date range from the stored day or rolling-average files.
+
+    Day pyramids weigh each cell by its pixel count, as the daily means do;
+    rolling-average pyramids weigh each cell once.
+
+    Args:
+        store (BlobStore): Store holding the inputs; receives the tiles.
+        source (str): "day" or "ra".
+        start_date (datetime): First date.
+        end_date (datetime): Last date.
+    """
+    if source not in SOURCES:
+        raise ValueError(f"Unknown pyramid source {source!r}, expected one of {SOURCES}")
+    catalog = DayCatalog.load(store) if source == "day" else None
+    date = start_date
+    while date <= end_date:
+        if source == "day":
+            stats = load_day_grid(store, date, catalog)
+            if stats is None:
+                print(f"No data for {date:%Y-%m-%d}, skipping")
+            else:
+                write_pyramid(store, "day", date, stats.cells, stats.count, stats.no2_sum)
+        else:
+            key = f"data/rolling_avgs/ra_{date.strftime('%Y%m%d')}.parquet"
+            if not store.exists(key):
+                print(f"No rolling averages for {date:%Y-%m-%d}, skipping")
+            else:
+                with store.open(key) as source_file:
+                    table = pq.read_table(source_file, columns=["lat_bin", "lon_bin", "no2_ra"])
+                write_ra_pyramid(store, date, table.column("lat_bin").to_numpy(),
+                                 table.column("lon_bin").to_numpy(), table.column("no2_ra").to_numpy())
+        date += timedelta(days=1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5) or sys.argv[2] not in SOURCES:
+        print("Usage: python3 -m sub.pyramid <BUCKET_NAME|STORE_DIR> <day|ra> <START_DATE> [END_DATE]")
+        sys.exit(1)
+    start = datetime.strptime(sys.argv[3], "%Y-%m-%d")
+    end = datetime.strptime(sys.argv[4], "%Y-%m-%d") if len(sys.argv) == 5 else start
+    process_pyramids(open_store(sys.argv[1]), sys.argv[2], start, end)
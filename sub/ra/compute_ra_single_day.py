@@ -1,31 +1,76 @@
 import os
 import polars as pl
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog
+from sub.day_format import read_day
+from sub.disk_cache import cached_store_bytes, default_cache, store_key
+from sub.grid import cell_bins, cell_ids
+from sub.metrics import add_arguments, configure, span
+from sub.pyramid import write_ra_pyramid
+from sub.ra.incremental import compute_incremental, iter_range
+from sub.scheduler import parse_shard, shard_range
+from sub.tiled_days import read_region
 
 # ──────────────── Config ────────────────
 BUCKET_NAME = "no2-app-data"
 PREFIX = "data/days/"
 OUTPUT_BUCKET = "no2-app-data"
 OUTPUT_PREFIX = "data/rolling_avgs/"
+# Rolling averages of an area of interest, one folder per box
+AOI_PREFIX = "data/rolling_avgs/aoi/"
+# Either store may be pointed at a local directory for benchmarking
+INPUT_STORE = os.getenv("RA_INPUT_STORE", BUCKET_NAME)
+OUTPUT_STORE = os.getenv("RA_OUTPUT_STORE", OUTPUT_BUCKET)
+# Rolling-average files uploaded together in range mode
+OUTPUT_BATCH = 16
+READ_COLUMNS = ["latitude", "longitude", "nitrogendioxide_tropospheric_column", "qa_value"]
+# Version of the binned day frames kept in the local cache; bump it when bin_pixels changes
+BINNED_VERSION = 2
 
 # ──────────────── Helpers ────────────────
 
-def bin_coord(expr, step=0.1):
-    return (expr / step).round() * step
-
-def load_daily_parquet(blob):
-    print(f"📅 Downloading {blob.name}")
-    content = blob.download_as_bytes()
-    df = pl.read_parquet(BytesIO(content))
-
+def load_daily_parquet(store, key, version=None):
+    """
+    Reads a day file and bins its valid pixels, through the local cache when it is enabled.
+
+    Overlapping 7-day windows read each day up to seven times; the binned
+    frame is cached under the day file's version (generation or MD5, looked
+    up if not given), and so is the day file itself.
+    """
+    cache = default_cache()
+    if cache.enabled:
+        version = version or store.stat(key).generation
+        frame_key = f"frame:ra_binned/v{BINNED_VERSION}:{store_key(store, key, version)}"
+        frame = cache.get(frame_key)
+        if frame is not None:
+            print(f"📅 Reading {key} (cached)")
+            return pl.read_parquet(BytesIO(frame))
+
+    print(f"📅 Reading {key}")
+    # Uncached, pyarrow reads through the ranged file object, so only these columns are fetched;
+    # read_day accepts both the legacy and the compact day schema
+    with (BytesIO(cached_store_bytes(store, key, version, cache)) if cache.enabled else store.open(key)) as source:
+        df = pl.from_arrow(read_day(source, columns=READ_COLUMNS))
+    df = bin_pixels(df.with_columns(pl.lit(datetime.strptime(key.split("/")[-1][1:9], "%Y%m%d")).alias("date")))
+    if cache.enabled:
+        buffer = BytesIO()
+        df.write_parquet(buffer, compression="lz4")
+        cache.put(frame_key, buffer.getvalue())
+    return df
+
+def bin_pixels(df):
+    """
+    Keeps the valid pixels of a frame with a date column and bins them to the 0.1° grid.
+
+    Cells come from `cell_ids`, like the gridded day products, so the full
+    recompute and the range and incremental modes bin every pixel alike.
+    """
     df = df.filter(pl.col("qa_value") > 0.5)
-    df = df.with_columns([
-        bin_coord(pl.col("latitude"), 0.1).alias("lat_bin"),
-        bin_coord(pl.col("longitude"), 0.1).alias("lon_bin"),
-        pl.lit(datetime.strptime(blob.name.split("/")[-1][1:9], "%Y%m%d")).alias("date"),
-    ])
+    lat_bin, lon_bin = cell_bins(cell_ids(df["latitude"].to_numpy(), df["longitude"].to_numpy()))
+    df = df.with_columns([pl.Series("lat_bin", lat_bin), pl.Series("lon_bin", lon_bin)])
     return df.select(["lat_bin", "lon_bin", "date", "nitrogendioxide_tropospheric_column"]).rename({
         "nitrogendioxide_tropospheric_column": "no2"
     })
@@ -48,47 +93,147 @@ def save_to_gcs(df, output_blob_name):
     buffer = BytesIO()
     df.write_parquet(buffer)
     buffer.seek(0)
-    storage.Client().bucket(OUTPUT_BUCKET).blob(output_blob_name).upload_from_file(
-        buffer, content_type='application/octet-stream'
-    )
+    open_store(OUTPUT_STORE).put(output_blob_name, buffer)
     print(f"✅ Saved {output_blob_name}")
+    return buffer.getbuffer().nbytes
+
+def save_pyramid(store, target, daily):
+    """Writes the map tiles of one day of rolling averages next to the file."""
+    write_ra_pyramid(store, target, daily["lat_bin"].to_numpy(), daily["lon_bin"].to_numpy(),
+                     daily["no2_ra"].to_numpy())
 
 # ──────────────── Main Process ────────────────
 
 def process_single_day_output(target_date: str):
-    client = storage.Client()
-    blobs = list(client.list_blobs(BUCKET_NAME, prefix=PREFIX))
-
-    filtered_blobs = [
-        b for b in sorted(blobs, key=lambda b: b.name)
-        if b.name.endswith(".parquet") and (
-            datetime.strptime(target_date, "%Y%m%d") >= datetime.strptime(b.name.split("/")[-1][1:9], "%Y%m%d") >=
-            datetime.strptime(target_date, "%Y%m%d") - timedelta(days=6)
-        )
-    ]
-
-    if len(filtered_blobs) < 7:
-        raise ValueError(f"❌ Only found {len(filtered_blobs)} days of data, need 7 for rolling average.")
-
-    all_data = [load_daily_parquet(b) for b in filtered_blobs]
-    full_df = pl.concat(all_data, how="vertical")
-    rolling_df = compute_7day_rolling(full_df)
+    store = open_store(INPUT_STORE)
+    target = datetime.strptime(target_date, "%Y%m%d")
 
-    # Save only the row for target date
+    # The day catalog gives the 7 inputs directly; list the prefix only if there is none yet
+    catalog = DayCatalog.load(store)
+    versions = {}
+    if catalog.exists:
+        entries = catalog.range(target - timedelta(days=6), target)
+        filtered_keys = [entry["key"] for entry in entries]
+        versions = {entry["key"]: entry.get("md5") for entry in entries}
+    else:
+        keys = store.list(PREFIX)
+        filtered_keys = [
+            k for k in keys
+            if k.endswith(".parquet") and (
+                target >= datetime.strptime(k.split("/")[-1][1:9], "%Y%m%d") >= target - timedelta(days=6)
+            )
+        ]
+
+    if len(filtered_keys) < 7:
+        raise ValueError(f"❌ Only found {len(filtered_keys)} days of data, need 7 for rolling average.")
+
+    with span("ra_day", date=target.strftime("%Y-%m-%d"), mode="full") as s:
+        # Read the 7 days concurrently over the store's shared connection pool
+        cache = default_cache()
+
+        def load(key):
+            before = cache.thread_counts()
+            return load_daily_parquet(store, key, versions.get(key)), cache.counts_since(before)
+
+        with ThreadPoolExecutor(max_workers=len(filtered_keys)) as executor:
+            results = list(executor.map(load, filtered_keys))
+        all_data = [df for df, _ in results]
+        for _, counts in results:
+            s.add(**counts)
+        full_df = pl.concat(all_data, how="vertical")
+        rolling_df = compute_7day_rolling(full_df)
+
+        # Save only the row for target date
+        daily = rolling_df.filter(pl.col("date") == target)
+        out_name = f"{OUTPUT_PREFIX}ra_{target.strftime('%Y%m%d')}.parquet"
+        s.add(rows_in=full_df.height, rows_out=daily.height, bytes_written=save_to_gcs(daily, out_name))
+        save_pyramid(open_store(OUTPUT_STORE), target, daily)
+
+def process_region_output(target_date: str, bbox):
+    """Rolling average of one date over a box, read from the tiled day layout (see `sub.tiled_days`)."""
+    store = open_store(INPUT_STORE)
+    target = datetime.strptime(target_date, "%Y%m%d")
+    with span("ra_day", date=target.strftime("%Y-%m-%d"), mode="region") as s:
+        stats = {}
+        pixels = read_region(store, target - timedelta(days=6), target, bbox, READ_COLUMNS, stats)
+        if stats["days"] < 7:
+            raise ValueError(f"❌ Only found {stats['days']} tiled days of data, need 7 for rolling average.")
+        print(f"📦 Read {stats['tiles']} of {stats['tiles_total']} tiles, "
+              f"{stats['row_groups_read']} of {stats['row_groups']} row groups ({stats['bytes_read'] / 1e6:.1f} MB)")
+        full_df = bin_pixels(pl.from_arrow(pixels))
+        daily = compute_7day_rolling(full_df).filter(pl.col("date") == target)
+        label = "_".join(f"{value:g}" for value in bbox)
+        out_name = f"{AOI_PREFIX}{label}/ra_{target.strftime('%Y%m%d')}.parquet"
+        s.add(rows_in=full_df.height, rows_out=daily.height, bytes_read=stats["bytes_read"],
+              bytes_written=save_to_gcs(daily, out_name))
+
+def process_single_day_incremental(target_date: str):
     target = datetime.strptime(target_date, "%Y%m%d")
-    daily = rolling_df.filter(pl.col("date") == target)
-    out_name = f"{OUTPUT_PREFIX}ra_{target.strftime('%Y%m%d')}.parquet"
-    save_to_gcs(daily, out_name)
+    with span("ra_day", date=target.strftime("%Y-%m-%d"), mode="incremental") as s:
+        daily = compute_incremental(open_store(INPUT_STORE), open_store(OUTPUT_STORE), target)
+        out_name = f"{OUTPUT_PREFIX}ra_{target.strftime('%Y%m%d')}.parquet"
+        s.add(rows_out=daily.height, bytes_written=save_to_gcs(daily, out_name))
+        save_pyramid(open_store(OUTPUT_STORE), target, daily)
+
+def process_range_output(start_date: str, end_date: str, shards=1, shard_index=0):
+    start = datetime.strptime(start_date, "%Y%m%d")
+    end = datetime.strptime(end_date, "%Y%m%d")
+    shard = shard_range(start, end, shards, shard_index)
+    if shard is None:
+        print(f"🈳 Shard {shard_index} of {shards} has no dates")
+        return
+    print(f"📆 Computing rolling averages for {shard[0]:%Y-%m-%d} .. {shard[1]:%Y-%m-%d}")
+
+    output_store = open_store(OUTPUT_STORE)
+    pending = {}
+    # The window is advanced inside iter_range, so its time counts in the
+    # range span; the day spans cover encoding, tiles and uploads
+    with span("ra_range", start=f"{shard[0]:%Y-%m-%d}", end=f"{shard[1]:%Y-%m-%d}", profile=False) as total:
+        for target, daily in iter_range(open_store(INPUT_STORE), *shard):
+            with span("ra_day", date=target.strftime("%Y-%m-%d"), mode="range") as s:
+                buffer = BytesIO()
+                daily.write_parquet(buffer)
+                pending[f"{OUTPUT_PREFIX}ra_{target.strftime('%Y%m%d')}.parquet"] = buffer.getvalue()
+                s.add(rows_out=daily.height, bytes_written=len(buffer.getvalue()))
+                save_pyramid(output_store, target, daily)
+                if len(pending) >= OUTPUT_BATCH:
+                    output_store.put_many(pending)
+                    print(f"✅ Saved {len(pending)} rolling-average files up to {target.strftime('%Y%m%d')}")
+                    pending = {}
+            total.add(rows_out=daily.height, bytes_written=s.counts["bytes_written"])
+        if pending:
+            output_store.put_many(pending)
+            print(f"✅ Saved {len(pending)} rolling-average files")
 
 if __name__ == "__main__":
-    import sys
+    import argparse
     import traceback
-    from datetime import timedelta
 
-    if len(sys.argv) != 2:
-        raise ValueError("Usage: python compute_ra_single_day.py YYYYMMDD")
+    parser = argparse.ArgumentParser(description="Compute 7-day rolling averages for one date or a range.")
+    parser.add_argument("target_date", help="YYYYMMDD; the first date in range mode")
+    parser.add_argument("end_date", nargs="?", help="YYYYMMDD; the last date, enables range mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Single date from the persisted window state")
+    parser.add_argument("--bbox", help="min_lat,min_lon,max_lat,max_lon: single date over this box only, "
+                        f"from the tiled day layout, written under {AOI_PREFIX}")
+    parser.add_argument("--shard", default="0/1",
+                        help="INDEX/COUNT: compute only this share of the range; "
+                             "'batch' takes it from the Cloud Batch task index")
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(args.metrics, args.profile)
 
     try:
-        process_single_day_output(sys.argv[1])
+        if args.end_date:
+            shard_index, shards = parse_shard(args.shard)
+            process_range_output(args.target_date, args.end_date, shards, shard_index)
+        elif args.bbox:
+            process_region_output(args.target_date, tuple(float(value) for value in args.bbox.split(",")))
+        elif args.incremental:
+            process_single_day_incremental(args.target_date)
+        else:
+            process_single_day_output(args.target_date)
     except Exception:
         traceback.print_exc()
+        # A failed task must fail, so Batch retries it and the scheduler reports it
+        raise SystemExit(1)
@@ -0,0 +1,286 @@
+import io
+from collections import OrderedDict
+from datetime import timedelta
+import numpy as np
+import polars as pl
+from sub.blob_store import PreconditionFailed
+from sub.catalog import DayCatalog
+from sub.grid import NCELLS, cell_bins, load_day_grid
+
+# ──────────────── Config ────────────────
+WINDOW_DAYS = 7
+STATE_KEY = "data/ra_state/state.npz"
+# Rebuild the window from its day slices this often, so float rounding from
+# adding and subtracting days never accumulates
+REBUILD_EVERY = 28
+
+# ──────────────── Window state ────────────────
+
+class WindowState:
+    """
+    Running per-cell sums of daily means over the last WINDOW_DAYS days.
+
+    The day slices themselves are the gridded day products (data/grid), so
+    the state only holds the sums, the number of days with data per cell and
+    the dates currently in the window, with the catalog md5 each date had when
+    it was added. A day replaced since (an NRT day swapped for the final
+    product) no longer matches its md5, so the window is rebuilt instead of
+    subtracting values it never added.
+    """
+
+    def __init__(self, end_date, dates, no2_sum, count, updates=0, md5s=None):
+        self.end_date = end_date
+        self.dates = dates
+        self.no2_sum = no2_sum
+        self.count = count
+        self.updates = updates
+        self.md5s = md5s if md5s is not None else {}
+
+    @classmethod
+    def empty(cls, end_date):
+        return cls(end_date, [], np.zeros(NCELLS), np.zeros(NCELLS, np.uint8))
+
+    def add(self, date, stats, md5=""):
+        self.no2_sum[stats.cells] += stats.mean
+        self.count[stats.cells] += 1
+        self.dates = sorted(set(self.dates) | {date})
+        self.md5s[date] = md5
+
+    def remove(self, date, stats):
+        self.no2_sum[stats.cells] -= stats.mean
+        self.count[stats.cells] -= 1
+        # Cells leaving the window entirely restart from an exact zero
+        self.no2_sum[self.count == 0] = 0.0
+        self.dates = [d for d in self.dates if d != date]
+        self.md5s.pop(date, None)
+
+    def stale_dates(self, catalog):
+        """Returns the window dates whose catalog md5 differs from the one they were added with."""
+        return [d for d in self.dates if self.md5s.get(d) != day_md5(catalog, d)]
+
+    def rolling_mean(self, cells):
+        return (self.no2_sum[cells] / self.count[cells]).astype(np.float32)
+
+    def to_bytes(self):
+        # Stored sparsely: only cells with data somewhere in the window
+        cells = np.flatnonzero(self.count).astype(np.int32)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            end_date=np.array(self.end_date),
+            dates=np.array(self.dates),
+            md5s=np.array([self.md5s.get(d, "") for d in self.dates]),
+            updates=np.array(self.updates),
+            cells=cells,
+            no2_sum=self.no2_sum[cells],
+            count=self.count[cells],
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        saved = np.load(io.BytesIO(data), allow_pickle=False)
+        state = cls.empty(str(saved["end_date"]))
+        state.dates = [str(d) for d in saved["dates"]]
+        # States saved before md5s were kept match no catalog entry, so they get rebuilt
+        md5s = [str(m) for m in saved["md5s"]] if "md5s" in saved.files else [None] * len(state.dates)
+        state.md5s = dict(zip(state.dates, md5s))
+        state.updates = int(saved["updates"])
+        state.no2_sum[saved["cells"]] = saved["no2_sum"]
+        state.count[saved["cells"]] = saved["count"]
+        return state
+
+def day_md5(catalog, date):
+    """Returns the catalog md5 of a day, or "" without a catalog entry."""
+    entry = catalog.get(date) if catalog is not None and catalog.exists else None
+    return (entry or {}).get("md5") or ""
+
+# ──────────────── Day slices ────────────────
+
+class DayCache:
+    """
+    Least-recently-used cache of day slices, sized for one sliding window.
+
+    Sliding through consecutive dates, every day is read once: it enters the
+    cache as the window's newest day and is released as it leaves. Missing
+    days are cached too, as None.
+    """
+
+    def __init__(self, store, catalog=None, capacity=WINDOW_DAYS + 1):
+        self.store = store
+        self.catalog = catalog
+        self.capacity = capacity
+        self.slices = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, date):
+        key = date.strftime("%Y-%m-%d")
+        if key in self.slices:
+            self.hits += 1
+            self.slices.move_to_end(key)
+            return self.slices[key]
+        self.misses += 1
+        stats = load_day_grid(self.store, date, self.catalog)
+        self.slices[key] = stats
+        if len(self.slices) > self.capacity:
+            self.slices.popitem(last=False)
+        return stats
+
+    def release(self, date):
+        """Returns a day's slice and drops it from the cache, as it will not be needed again."""
+        stats = self.get(date)
+        self.slices.pop(date.strftime("%Y-%m-%d"), None)
+        return stats
+
+# ──────────────── Engine ────────────────
+
+def load_state(store, key=STATE_KEY):
+    """Returns (WindowState or None, generation) from the store."""
+    data, generation = store.get_versioned(key)
+    if data is None:
+        return None, None
+    return WindowState.from_bytes(data), generation
+
+def bootstrap(store, target, catalog=None):
+    """Builds the window ending at `target` from its day slices."""
+    print(f"🧱 Building window state for {target.strftime('%Y-%m-%d')}")
+    state = WindowState.empty(target.strftime("%Y-%m-%d"))
+    missing = []
+    for offset in range(WINDOW_DAYS - 1, -1, -1):
+        day = target - timedelta(days=offset)
+        stats = load_day_grid(store, day, catalog)
+        if stats is None:
+            missing.append(day.strftime("%Y-%m-%d"))
+        else:
+            state.add(day.strftime("%Y-%m-%d"), stats, day_md5(catalog, day))
+    if missing:
+        raise ValueError(f"❌ Missing {len(missing)} of {WINDOW_DAYS} days for rolling average: {missing}")
+    return state
+
+def advance(state, store, target, target_stats, catalog=None):
+    """
+    Moves the window to end at `target`.
+
+    Adds the target day and subtracts the day leaving the window when the
+    state ends the day before; otherwise (no state, a gap, a backfill of an
+    older date, a periodic rebuild, or a window day replaced since it was
+    added) the window is rebuilt from its slices.
+    """
+    previous = (target - timedelta(days=1)).strftime("%Y-%m-%d")
+    if state is None or state.end_date != previous or state.updates + 1 >= REBUILD_EVERY:
+        return bootstrap(store, target, catalog)
+    stale = state.stale_dates(catalog)
+    if stale:
+        print(f"🔁 Days replaced since they entered the window: {stale}")
+        return bootstrap(store, target, catalog)
+
+    leaving = target - timedelta(days=WINDOW_DAYS)
+    if leaving.strftime("%Y-%m-%d") in state.dates:
+        leaving_stats = load_day_grid(store, leaving, catalog)
+        # A slice with cells the window never counted was not the one added
+        if leaving_stats is None or not state.count[leaving_stats.cells].all():
+            return bootstrap(store, target, catalog)
+        state.remove(leaving.strftime("%Y-%m-%d"), leaving_stats)
+    state.add(target.strftime("%Y-%m-%d"), target_stats, day_md5(catalog, target))
+    state.end_date = target.strftime("%Y-%m-%d")
+    state.updates += 1
+    return state
+
+def ra_frame(state, target, target_stats):
+    """Returns the rolling averages of the cells observed on `target`, in the batch job's output schema."""
+    cells = target_stats.cells
+    lat_bin, lon_bin = cell_bins(cells)
+    return pl.DataFrame({
+        "lat_bin": lat_bin,
+        "lon_bin": lon_bin,
+        "date": np.full(len(cells), np.datetime64(target, "us")),
+        "no2": target_stats.mean,
+        "no2_ra": state.rolling_mean(cells),
+    }).sort(["lat_bin", "lon_bin"])
+
+def compute_incremental(input_store, output_store, target, state_key=STATE_KEY):
+    """
+    Computes the rolling average for one date from the persisted window state.
+
+    Reads the target day's slice plus, at most, the slice leaving the window,
+    instead of all seven day files. The state is only moved forward, and with
+    a conditional write, so a backfill of older dates or a concurrent run
+    never rewinds it.
+
+    Args:
+        input_store (BlobStore): Store holding the day and grid files.
+        output_store (BlobStore): Store for the rolling averages and the state.
+        target (datetime): Date to compute.
+        state_key (str): Key of the window state in `output_store`.
+
+    Returns:
+        polars.DataFrame: lat_bin, lon_bin, date, no2 and no2_ra of the cells
+        observed on `target`.
+    """
+    catalog = DayCatalog.load(input_store)
+    target_stats = load_day_grid(input_store, target, catalog)
+    if target_stats is None:
+        raise ValueError(f"❌ No data for {target.strftime('%Y-%m-%d')}")
+
+    state, generation = load_state(output_store, state_key)
+    newer_state = state is not None and state.end_date > target.strftime("%Y-%m-%d")
+    state = advance(None if newer_state else state, input_store, target, target_stats, catalog)
+    daily = ra_frame(state, target, target_stats)
+
+    if newer_state:
+        print("↩️ State already at a later date, leaving it untouched")
+    else:
+        try:
+            output_store.put_if_generation(state_key, state.to_bytes(), generation)
+            print(f"💾 Window state saved at {state.end_date}")
+        except PreconditionFailed:
+            print("⚠️ Window state changed by another run, not saved")
+    return daily
+
+# ──────────────── Range mode ────────────────
+
+def iter_range(input_store, start, end):
+    """
+    Slides the window through a date range, reading each day file once.
+
+    Dates whose window is missing a day are skipped, as the single-date job
+    would fail on them.
+
+    Args:
+        input_store (BlobStore): Store holding the day and grid files.
+        start (datetime): First target date.
+        end (datetime): Last target date.
+
+    Yields:
+        tuple: (target datetime, polars.DataFrame in the batch job's output schema).
+    """
+    catalog = DayCatalog.load(input_store)
+    cache = DayCache(input_store, catalog)
+    state = None
+    target = start
+    while target <= end:
+        if state is None or state.updates + 1 >= REBUILD_EVERY:
+            state = WindowState.empty(target.strftime("%Y-%m-%d"))
+            for offset in range(WINDOW_DAYS - 1, -1, -1):
+                day = target - timedelta(days=offset)
+                stats = cache.get(day)
+                if stats is not None:
+                    state.add(day.strftime("%Y-%m-%d"), stats, day_md5(catalog, day))
+        else:
+            leaving = target - timedelta(days=WINDOW_DAYS)
+            leaving_stats = cache.release(leaving)
+            if leaving_stats is not None:
+                state.remove(leaving.strftime("%Y-%m-%d"), leaving_stats)
+            target_stats = cache.get(target)
+            if target_stats is not None:
+                state.add(target.strftime("%Y-%m-%d"), target_stats, day_md5(catalog, target))
+            state.end_date = target.strftime("%Y-%m-%d")
+            state.updates += 1
+
+        if len(state.dates) < WINDOW_DAYS:
+            print(f"⏭️ Skipping {target.strftime('%Y-%m-%d')}: only {len(state.dates)} of {WINDOW_DAYS} days available")
+        else:
+            yield target, ra_frame(state, target, cache.get(target))
+        target += timedelta(days=1)
+    print(f"📦 Day cache: {cache.misses} reads, {cache.hits} hits")
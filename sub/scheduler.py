@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sub.metrics import RUN_ENV
+
+# Sharded jobs split a date range into contiguous shards, one per task. The
+# task command carries "--shard batch", which `parse_shard` resolves from the
+# BATCH_TASK_INDEX and BATCH_TASK_COUNT variables that Cloud Batch sets on each
+# task of an array job (and the local backend sets the same way), so one
+# command line serves every task. Tasks also get NO2_RUN_ID, so the metrics
+# spans of a job's tasks share its run id (see `sub.metrics`).
+PROJECT = "no2-app"
+REGION = "us-east1"
+
+# Tasks of one job running at the same time
+MAX_RUNNING_TASKS = 10
+# Seconds between state checks while waiting for a Batch job
+POLL_SECONDS = 30
+
+
+def shard_range(start, end, shards, index):
+    """
+    Returns the (first, last) dates of one shard of a date range.
+
+    Shards split the dates evenly into contiguous runs.
+
+    Returns:
+        tuple or None: The shard's date range, or None if it is empty.
+    """
+    total = (end - start).days + 1
+    size = -(-total // shards)
+    first = start + timedelta(days=index * size)
+    last = min(end, first + timedelta(days=size - 1))
+    return (first, last) if first <= last else None
+
+
+def job_name(job):
+    """
+    Returns a unique name for one submission of a job.
+
+    The timestamp keeps names sortable; the random suffix keeps two
+    submissions within the same second apart (Batch names are unique per region).
+    """
+    return f"{job.name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def parse_shard(value):
+    """
+    Parses a --shard argument.
+
+    Args:
+        value (str): "INDEX/COUNT", or "batch" to read the task's index and
+            count from BATCH_TASK_INDEX and BATCH_TASK_COUNT.
+
+    Returns:
+        tuple: (index, count).
+    """
+    if value == "batch":
+        return int(os.environ["BATCH_TASK_INDEX"]), int(os.environ.get("BATCH_TASK_COUNT", "1"))
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index {index} is outside 0..{count - 1}")
+    return index, count
+
+
+class ShardedJob:
+    """
+    A command run once per shard, with "--shard batch" appended.
+
+    `args` follow the interpreter, e.g. ["-m", "sub.ra.compute_ra_single_day",
+    "20240101", "20241231"]. The resources describe one Batch task.
+    """
+
+    def __init__(self, name, image, args, shards, cpu_milli=1000, memory_mib=8192,
+                 machine_type="e2-standard-4", max_run_seconds=3600, max_retries=1, python="python"):
+        self.name = name
+        self.image = image
+        self.args = args
+        self.shards = shards
+        self.cpu_milli = cpu_milli
+        self.memory_mib = memory_mib
+        self.machine_type = machine_type
+        self.max_run_seconds = max_run_seconds
+        self.max_retries = max_retries
+        self.python = python
+
+    def command(self, python=None):
+        return [python or self.python] + list(self.args) + ["--shard", "batch"]
+
+
+class BatchBackend:
+    """
+    Runs a sharded job as one Cloud Batch array job.
+
+    Each submission gets a unique job name, so nothing has to be deleted
+    first, and the number of running tasks is capped by the job's own
+    parallelism instead of by polling the region's job list.
+    """
+
+    def __init__(self, project=PROJECT, region=REGION, parallelism=MAX_RUNNING_TASKS):
+        self.project = project
+        self.region = region
+        self.parallelism = parallelism
+
+    def config(self, job, job_name):
+        return {
+            "priority": 0,
+            "taskGroups": [{
+                "taskSpec": {
+                    "runnables": [{"container": {"imageUri": job.image, "commands": job.command()}}],
+                    "environment": {"variables": {RUN_ENV: job_name}},
+                    "computeResource": {"cpuMilli": job.cpu_milli, "memoryMib": job.memory_mib},
+                    "maxRunDuration": f"{job.max_run_seconds}s",
+                    "maxRetryCount": job.max_retries,
+                },
+                "taskCount": job.shards,
+                "parallelism": min(self.parallelism, job.shards),
+            }],
+            "allocationPolicy": {"instances": [{"policy": {"machineType": job.machine_type}}]},
+            "labels": {"job-type": job.name},
+            "logsPolicy": {"destination": "CLOUD_LOGGING"},
+        }
+
+    def _gcloud(self, *args):
+        return subprocess.run(
+            ["gcloud", "batch", "jobs", *args, "--location", self.region, "--project", self.project],
+            capture_output=True, text=True,
+        )
+
+    def state(self, job_name):
+        """Returns the state of a Batch job, e.g. "RUNNING" or "SUCCEEDED", or None if unknown."""
+        result = self._gcloud("describe", job_name, "--format=json")
+        if result.returncode != 0:
+            return None
+        return json.loads(result.stdout).get("status", {}).get("state")
+
+    def submit(self, job, wait=False):
+        """
+        Submits the job with a single gcloud call.
+
+        Args:
+            job (ShardedJob): Job to run.
+            wait (bool): Poll the job until it finishes.
+
+        Returns:
+            str: The Batch job name, or None if the submission failed.
+        """
+        name = job_name(job)
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(self.config(job, name), f, indent=2)
+            config_path = f.name
+        try:
+            print(f"🔧 Submitting {name}: {job.shards} tasks, {min(self.parallelism, job.shards)} at a time")
+            result = self._gcloud("submit", name, "--config", config_path)
+        finally:
+            os.remove(config_path)
+        if result.returncode != 0:
+            print(f"❌ Failed to submit {name}")
+            print(result.stderr)
+            return None
+        print(f"✅ Submitted {name}")
+
+        while wait:
+            state = self.state(name)
+            print(f"⏳ {name}: {state}")
+            if state in ("SUCCEEDED", "FAILED", "DELETION_IN_PROGRESS"):
+                break
+            time.sleep(POLL_SECONDS)
+        return name
+
+
+class LocalBackend:
+    """
+    Runs the tasks of a sharded job as local processes.
+
+    Tasks get the same command and BATCH_TASK_* variables as on Cloud Batch,
+    with at most `parallelism` running at a time.
+    """
+
+    def __init__(self, parallelism=MAX_RUNNING_TASKS, cwd=None):
+        self.parallelism = parallelism
+        self.cwd = cwd
+
+    def run_task(self, job, index, job_name):
+        env = dict(os.environ, BATCH_TASK_INDEX=str(index), BATCH_TASK_COUNT=str(job.shards),
+                   **{RUN_ENV: job_name})
+        start = time.perf_counter()
+        result = subprocess.run(job.command(sys.executable), env=env, cwd=self.cwd)
+        print(f"{'✅' if result.returncode == 0 else '❌'} Task {index} of {job.name} "
+              f"finished in {time.perf_counter() - start:.1f}s")
+        return result.returncode
+
+    def submit(self, job):
+        """
+        Runs every task and waits for them; local jobs always run to completion.
+
+        Returns:
+            dict: Task index -> exit code.
+        """
+        name = job_name(job)
+        print(f"🔧 Running {job.name} locally: {job.shards} tasks, {min(self.parallelism, job.shards)} at a time")
+        with ThreadPoolExecutor(max_workers=min(self.parallelism, job.shards)) as executor:
+            codes = dict(zip(range(job.shards),
+                             executor.map(lambda i: self.run_task(job, i, name), range(job.shards))))
+        failed = sorted(index for index, code in codes.items() if code != 0)
+        print(f"🏁 {job.name}: {job.shards - len(failed)} of {job.shards} tasks succeeded"
+              + (f", failed: {failed}" if failed else ""))
+        return codes
+
+
+def make_backend(name, parallelism=MAX_RUNNING_TASKS):
+    if name == "batch":
+        return BatchBackend(parallelism=parallelism)
+    if name == "local":
+        return LocalBackend(parallelism=parallelism)
+    raise ValueError(f"Unknown backend {name!r}, expected 'batch' or 'local'")
+
+
+# ──── Jobs ────
+
+RA_IMAGE = f"{REGION}-docker.pkg.dev/{PROJECT}/fastapi-repo/compute-ra-single"
+INGEST_IMAGE = f"gcr.io/{PROJECT}/no2-app-service"
+
+# Dates per shard by default: rolling-average shards re-read the 6 days before
+# their first date, so short shards waste reads
+RA_DAYS_PER_SHARD = 30
+INGEST_DAYS_PER_SHARD = 7
+
+
+def default_shards(start, end, days_per_shard):
+    return max(1, -(-((end - start).days + 1) // days_per_shard))
+
+
+def ra_job(start, end, shards=None):
+    """Rolling averages for a date range (see `sub.ra.compute_ra_single_day`), dates as datetimes."""
+    shards = shards or default_shards(start, end, RA_DAYS_PER_SHARD)
+    return ShardedJob("compute-ra", RA_IMAGE,
+                      ["-m", "sub.ra.compute_ra_single_day", start.strftime("%Y%m%d"), end.strftime("%Y%m%d")],
+                      shards)
+
+
+def ingest_job(start, end, shards=None, extra_args=()):
+    """Ingest backfill for a date range (see `main.py`), dates as datetimes."""
+    shards = shards or default_shards(start, end, INGEST_DAYS_PER_SHARD)
+    return ShardedJob("no2-ingest", INGEST_IMAGE,
+                      ["main.py", start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"), *extra_args],
+                      shards, cpu_milli=8000, memory_mib=32768, machine_type="n2-standard-8",
+                      max_run_seconds=6 * 3600, python="python3")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a date range as a sharded job on Cloud Batch or locally.")
+    parser.add_argument("job", choices=["ra", "ingest"])
+    parser.add_argument("start_date", help="YYYY-MM-DD")
+    parser.add_argument("end_date", help="YYYY-MM-DD")
+    parser.add_argument("--backend", choices=["batch", "local"], default="batch")
+    parser.add_argument("--shards", type=int, help="Number of tasks; defaults to one per "
+                        f"{RA_DAYS_PER_SHARD} (ra) or {INGEST_DAYS_PER_SHARD} (ingest) days")
+    parser.add_argument("--parallelism", type=int, default=MAX_RUNNING_TASKS, help="Tasks running at a time")
+    parser.add_argument("--wait", action="store_true", help="Wait for a Batch job to finish")
+    args, extra = parser.parse_known_args()
+    if extra and args.job == "ra":
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+
+    start = datetime.strptime(args.start_date, "%Y-%m-%d")
+    end = datetime.strptime(args.end_date, "%Y-%m-%d")
+    job = ra_job(start, end, args.shards) if args.job == "ra" else ingest_job(start, end, args.shards, extra)
+    backend = make_backend(args.backend, args.parallelism)
+    result = backend.submit(job) if args.backend == "local" else backend.submit(job, wait=args.wait)
+    if not result or (args.backend == "local" and any(result.values())):
+        sys.exit(1)
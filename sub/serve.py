@@ -0,0 +1,483 @@
+# Query service over local replicas of the processed data.
+#
+# The replica directory mirrors the store's keys (data/countries,
+# data/rolling_avgs, data/anomalies, data/pyramid, data/trend) and holds the cell-major panel under
+# panel/ (see `panel`):
+#
+#   python3 -m sub.serve sync <BUCKET_NAME|STORE_DIR> <REPLICA_DIR>
+#   REPLICA_DIR=<REPLICA_DIR> gunicorn -w 4 "sub.serve:create_app()"
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+import pyarrow.parquet as pq
+from flask import Flask, abort, jsonify, request
+from sub import country_store
+from sub.blob_store import LocalStore, open_store
+from sub.catalog import DayCatalog
+from sub.grid import NLON, cell_ids
+from sub.panel import Panel, update_panel
+from sub.pyramid import LEVELS, PYRAMID_PREFIX, SOURCES, tile_bounds, tile_from_bytes, tile_key
+from sub.trend import MODEL_KEY, TrendModel
+
+REPLICA_DIR = os.getenv("REPLICA_DIR", "./replica")
+COUNTRIES_FOLDER = "data/countries"
+RA_PREFIX = "data/rolling_avgs/"
+ANOMALY_PREFIX = "data/anomalies/"
+
+# Memory for decoded day files and rendered responses
+CACHE_BYTES = int(os.getenv("QUERY_CACHE_BYTES", 1 << 30))
+# Largest box served, in grid cells, so one request cannot read the whole panel
+MAX_BBOX_CELLS = 250_000
+# Responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+CACHE_MAX_AGE = 300
+# Seconds the listing of the country parts is reused; a sync shows up after at most this long
+PARTS_TTL = 30
+
+# Days of rolling averages and anomalies mirrored by `sync`
+SYNC_DAYS = 30
+
+
+class ByteLRU:
+    """Thread-safe LRU cache evicting by total size in bytes rather than entry count."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """Returns the cached value of `key`, calling `load()` -> (value, nbytes) on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+        value, nbytes = load()
+        with self.lock:
+            if key not in self.entries and nbytes <= self.max_bytes:
+                self.entries[key] = (value, nbytes)
+                self.size += nbytes
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.size -= evicted
+        return value
+
+
+class DayTable:
+    """A decoded day file (rolling averages or anomalies), sorted by grid cell."""
+
+    def __init__(self, path, columns):
+        table = pq.read_table(path, columns=["lat_bin", "lon_bin"] + columns, memory_map=True)
+        cells = cell_ids(table.column("lat_bin").to_numpy(), table.column("lon_bin").to_numpy())
+        order = np.argsort(cells, kind="stable")
+        self.cells = cells[order]
+        self.columns = {name: table.column(name).to_numpy(zero_copy_only=False)[order] for name in columns}
+        self.lat = table.column("lat_bin").to_numpy()[order]
+        self.lon = table.column("lon_bin").to_numpy()[order]
+
+    @property
+    def nbytes(self):
+        return self.cells.nbytes + self.lat.nbytes + self.lon.nbytes + sum(v.nbytes for v in self.columns.values())
+
+    def select(self, bbox=None):
+        """Returns the row indices inside a (min_lat, min_lon, max_lat, max_lon) box, or all rows."""
+        if bbox is None:
+            return np.arange(len(self.cells))
+        # Rows are sorted by cell, so each latitude row of the box is one contiguous slice
+        min_lat, min_lon, max_lat, max_lon = bbox
+        first = cell_ids(np.array([min_lat, max_lat]), np.array([min_lon, max_lon]))
+        row0, col0 = divmod(int(first[0]), NLON)
+        row1, col1 = divmod(int(first[1]), NLON)
+        starts = np.arange(row0, row1 + 1) * NLON + col0
+        ends = np.arange(row0, row1 + 1) * NLON + col1
+        lo = np.searchsorted(self.cells, starts, side="left")
+        hi = np.searchsorted(self.cells, ends, side="right")
+        return np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)]) if len(lo) else np.empty(0, np.int64)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot serialize {type(value)}")
+
+
+def _floats(values):
+    """Converts an array to a list with NaN as None, which JSON can carry."""
+    values = np.asarray(values, dtype=np.float64)
+    return [None if np.isnan(v) else v for v in values.tolist()]
+
+
+def _coords(values):
+    """Grid coordinates rounded to the 0.1° grid, without float32 noise."""
+    return np.round(np.asarray(values, dtype=np.float64), 1).tolist()
+
+
+def _parse_date(value):
+    if value is None:
+        return None
+    for fmt in ("%Y-%m-%d", "%Y%m%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    abort(400, f"Invalid date {value!r}, use YYYY-MM-DD")
+
+
+def _parse_bbox(args, required=False):
+    names = ("min_lat", "min_lon", "max_lat", "max_lon")
+    if not any(name in args for name in names):
+        if required:
+            abort(400, "min_lat, min_lon, max_lat and max_lon are required")
+        return None
+    try:
+        min_lat, min_lon, max_lat, max_lon = (float(args[name]) for name in names)
+    except (KeyError, ValueError):
+        abort(400, "min_lat, min_lon, max_lat and max_lon must all be numbers")
+    if min_lat > max_lat or min_lon > max_lon:
+        abort(400, "Empty box")
+    cells = (round((max_lat - min_lat) * 10) + 1) * (round((max_lon - min_lon) * 10) + 1)
+    if cells > MAX_BBOX_CELLS:
+        abort(400, f"Box covers {cells} cells, the limit is {MAX_BBOX_CELLS}")
+    return min_lat, min_lon, max_lat, max_lon
+
+
+class QueryService:
+    """Answers queries from a replica directory, caching decoded files and responses."""
+
+    def __init__(self, replica_dir, cache_bytes=CACHE_BYTES):
+        self.replica_dir = replica_dir
+        self.store = LocalStore(replica_dir)
+        self.cache = ByteLRU(cache_bytes)
+        self._panel = None
+        self._panel_version = None
+        self._panel_lock = threading.Lock()
+
+    def panel(self):
+        """Returns the panel, reopened whenever a sync has changed its metadata."""
+        meta_path = os.path.join(self.replica_dir, "panel", "meta.json")
+        version = os.stat(meta_path).st_mtime_ns if os.path.exists(meta_path) else None
+        with self._panel_lock:
+            if self._panel is None or version != self._panel_version:
+                self._panel = Panel(os.path.join(self.replica_dir, "panel"))
+                self._panel_version = version
+            return self._panel
+
+    def version(self, key):
+        """Returns a token that changes whenever the replica file behind `key` does."""
+        path = self.store.uri(key)
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    def countries_version(self):
+        """
+        Returns a token that changes whenever the country parts do: their keys.
+
+        The listing is cached for PARTS_TTL seconds rather than made on every request.
+        """
+        def load():
+            parts = country_store.list_parts(self.store, COUNTRIES_FOLDER)
+            version = tuple(key for year in sorted(parts) for _, key in parts[year])
+            return version, sum(len(key) for key in version)
+
+        return self.cache.get(("country_parts", int(time.monotonic() // PARTS_TTL)), load)
+
+    def day_table(self, key, columns):
+        version = self.version(key)
+        if version is None:
+            abort(404, f"{key} is not available")
+
+        def load():
+            table = DayTable(self.store.uri(key), columns)
+            return table, table.nbytes
+
+        return self.cache.get(("day", key, version, tuple(columns)), load)
+
+    # ── Queries ──
+
+    def point(self, lat, lon, start, end):
+        dates, values = self.panel().history(lat, lon, start, end)
+        return {"lat": lat, "lon": lon, "dates": [str(d) for d in dates], "no2": _floats(values)}
+
+    def bbox(self, bbox, start, end):
+        dates, lats, lons, values = self.panel().region(*bbox, start, end)
+        flat = values.reshape(len(dates), -1)
+        counts = np.count_nonzero(~np.isnan(flat), axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.nansum(flat, axis=1) / counts
+        return {
+            "bbox": list(bbox),
+            "dates": [str(d) for d in dates],
+            "no2_mean": _floats(means),
+            "cells_with_data": counts.tolist(),
+        }
+
+    def country(self, name, start, end):
+        def load():
+            frame = country_store.read_countries(self.store, COUNTRIES_FOLDER)
+            return frame, int(frame.memory_usage(deep=True).sum())
+
+        frame = self.cache.get(("countries", self.countries_version()), load)
+        rows = frame[frame["Country"].str.lower() == name.lower()]
+        if rows.empty:
+            abort(404, f"No data for country {name!r}")
+        if start is not None:
+            rows = rows[rows["Date"] >= start.strftime("%Y-%m-%d")]
+        if end is not None:
+            rows = rows[rows["Date"] <= end.strftime("%Y-%m-%d")]
+        return {
+            "country": rows["Country"].iloc[0],
+            "dates": rows["Date"].tolist(),
+            "no2": _floats(rows["NO2"].to_numpy()),
+        }
+
+    def trend_model(self):
+        version = self.version(MODEL_KEY)
+        if version is None:
+            abort(404, "No trend model available")
+
+        def load():
+            model = TrendModel.from_bytes(self.store.get(MODEL_KEY))
+            return model, model.coefficients.nbytes + model.variance.nbytes + model.count.nbytes
+
+        return self.cache.get(("trend", version), load)
+
+    def trend(self, lat, lon, start, end):
+        model = self.trend_model()
+        cell = cell_ids(np.array([lat]), np.array([lon]))
+        if not model.fitted[cell[0]]:
+            abort(404, f"No trend fitted at {lat}, {lon}")
+        dates, values = self.panel().history(lat, lon, start, end)
+        coefficients = model.coefficients[cell[0]]
+        return {
+            "lat": lat,
+            "lon": lon,
+            "fit_start": model.start,
+            "fit_end": model.end,
+            "fit_days": int(model.count[cell[0]]),
+            "intercept": coefficients[0],
+            "slope_per_year": coefficients[1],
+            "seasonal": _floats(coefficients[2:]),
+            "residual_std": float(np.sqrt(model.variance[cell[0]])),
+            "dates": [str(d) for d in dates],
+            "no2": _floats(values),
+            "deseasonalized": _floats(values - model.seasonal(cell, dates)[:, 0]),
+            "fitted": _floats(model.predict(cell, dates)[:, 0]),
+        }
+
+    def latest_anomaly_key(self):
+        keys = [k for k in self.store.list(ANOMALY_PREFIX, refresh=True) if k.endswith(".parquet")]
+        if not keys:
+            abort(404, "No anomaly maps available")
+        return keys[-1]
+
+    def anomalies(self, bbox, flagged_only):
+        key = self.latest_anomaly_key()
+        table = self.day_table(key, ["z", "z_season", "anomaly"])
+        rows = table.select(bbox)
+        if flagged_only:
+            rows = rows[table.columns["anomaly"][rows]]
+        return {
+            "date": re.search(r"an_(\d{8})", key).group(1),
+            "lat": _coords(table.lat[rows]),
+            "lon": _coords(table.lon[rows]),
+            "z": _floats(table.columns["z"][rows]),
+            "z_season": _floats(table.columns["z_season"][rows]),
+            "anomaly": table.columns["anomaly"][rows].tolist(),
+        }
+
+    def rolling_average(self, date, bbox):
+        key = f"{RA_PREFIX}ra_{date.strftime('%Y%m%d')}.parquet"
+        table = self.day_table(key, ["no2", "no2_ra"])
+        rows = table.select(bbox)
+        return {
+            "date": date.strftime("%Y-%m-%d"),
+            "lat": _coords(table.lat[rows]),
+            "lon": _coords(table.lon[rows]),
+            "no2": _floats(table.columns["no2"][rows]),
+            "no2_ra": _floats(table.columns["no2_ra"][rows]),
+        }
+
+    def tile(self, source, date, zoom, x, y):
+        key = tile_key(source, date, zoom, x, y)
+        if self.version(key) is None:
+            abort(404, f"No {source} tile {zoom}/{x}/{y} for {date:%Y-%m-%d}")
+        count, no2_sum = tile_from_bytes(self.store.get(key))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = no2_sum / count
+        north, west, resolution = tile_bounds(zoom, x, y)
+        return {
+            "date": date.strftime("%Y-%m-%d"),
+            "z": zoom, "x": x, "y": y,
+            "north": north, "west": west, "resolution": resolution,
+            "mean": [_floats(row) for row in mean],
+            "count": count.tolist(),
+        }
+
+
+def create_app(replica_dir=None, cache_bytes=CACHE_BYTES):
+    """
+    Builds the Flask app serving a replica directory.
+
+    JSON responses carry an ETag (a hash of the body) and are gzipped when the
+    client accepts it. Rendered responses are cached, keyed by the request and
+    by the versions of the files they were built from.
+    """
+    service = QueryService(replica_dir or REPLICA_DIR, cache_bytes)
+    app = Flask(__name__)
+    app.config["service"] = service
+
+    def respond(key, build):
+        """Renders `build()` once per key, then serves it with ETag, gzip and 304 support."""
+        def load():
+            body = json.dumps(build(), default=_json_default, separators=(",", ":")).encode()
+            etag = hashlib.md5(body).hexdigest()
+            compressed = gzip.compress(body, compresslevel=5) if len(body) >= GZIP_MIN_BYTES else None
+            return (body, compressed, etag), len(body) + len(compressed or b"")
+
+        body, compressed, etag = service.cache.get(("response",) + key, load)
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        elif compressed is not None and "gzip" in request.accept_encodings:
+            response = app.response_class(compressed, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        response.cache_control.public = True
+        response.cache_control.max_age = CACHE_MAX_AGE
+        return response
+
+    def panel_version():
+        # The metadata is saved by every update, including rewrites of days already in the panel
+        return service.version("panel/meta.json")
+
+    @app.get("/health")
+    def health():
+        cache = service.cache
+        return jsonify(status="ok", cache_bytes=cache.size, cache_hits=cache.hits, cache_misses=cache.misses)
+
+    @app.get("/point")
+    def point():
+        try:
+            lat, lon = float(request.args["lat"]), float(request.args["lon"])
+        except (KeyError, ValueError):
+            abort(400, "lat and lon are required numbers")
+        start, end = _parse_date(request.args.get("start")), _parse_date(request.args.get("end"))
+        return respond(("point", lat, lon, start, end, panel_version()),
+                       lambda: service.point(lat, lon, start, end))
+
+    @app.get("/bbox")
+    def bbox():
+        box = _parse_bbox(request.args, required=True)
+        start, end = _parse_date(request.args.get("start")), _parse_date(request.args.get("end"))
+        return respond(("bbox", box, start, end, panel_version()), lambda: service.bbox(box, start, end))
+
+    @app.get("/trend")
+    def trend():
+        try:
+            lat, lon = float(request.args["lat"]), float(request.args["lon"])
+        except (KeyError, ValueError):
+            abort(400, "lat and lon are required numbers")
+        start, end = _parse_date(request.args.get("start")), _parse_date(request.args.get("end"))
+        return respond(("trend", lat, lon, start, end, panel_version(), service.version(MODEL_KEY)),
+                       lambda: service.trend(lat, lon, start, end))
+
+    @app.get("/country/<name>")
+    def country(name):
+        start, end = _parse_date(request.args.get("start")), _parse_date(request.args.get("end"))
+        return respond(("country", name.lower(), start, end, service.countries_version()),
+                       lambda: service.country(name, start, end))
+
+    @app.get("/anomaly/latest")
+    def anomaly_latest():
+        box = _parse_bbox(request.args)
+        flagged_only = request.args.get("all", "0") not in ("1", "true")
+        key = service.latest_anomaly_key()
+        return respond(("anomaly", key, service.version(key), box, flagged_only),
+                       lambda: service.anomalies(box, flagged_only))
+
+    @app.get("/ra/<date>")
+    def rolling_average(date):
+        day = _parse_date(date)
+        box = _parse_bbox(request.args)
+        key = f"{RA_PREFIX}ra_{day.strftime('%Y%m%d')}.parquet"
+        return respond(("ra", key, service.version(key), box), lambda: service.rolling_average(day, box))
+
+    @app.get("/tiles/<source>/<date>/<int:z>/<int:x>/<int:y>")
+    def tile(source, date, z, x, y):
+        if source not in SOURCES or z >= len(LEVELS):
+            abort(404, f"No tiles for {source}/{z}")
+        day = _parse_date(date)
+        key = tile_key(source, day, z, x, y)
+        return respond(("tile", key, service.version(key)), lambda: service.tile(source, day, z, x, y))
+
+    return app
+
+
+def sync_replica(store, replica_dir, days=SYNC_DAYS):
+    """
+    Mirrors what the service reads from the store into a replica directory.
+
+    Country parts are mirrored exactly (compaction removes parts); the latest
+    `days` rolling-average and anomaly files, the map tiles of those days and
+    the trend model are copied when missing or when their md5 differs from the
+    copy's. Dated files do change: replacing an NRT day with the final product
+    rewrites its tiles and the rolling averages and anomalies of the next
+    days. The panel is brought up to date with the catalogued days.
+
+    Args:
+        store (BlobStore): Source store.
+        replica_dir (str): Local replica directory.
+        days (int): Number of most recent daily files to mirror.
+    """
+    replica = LocalStore(replica_dir)
+    parts = set(store.list(f"{COUNTRIES_FOLDER}/year=", refresh=True))
+    local_parts = set(replica.list(f"{COUNTRIES_FOLDER}/year=", refresh=True))
+    wanted = sorted(parts - local_parts)
+    dated = []
+    for prefix in (RA_PREFIX, ANOMALY_PREFIX):
+        dated += [k for k in store.list(prefix, refresh=True) if k.endswith(".parquet")][-days:]
+    recent = {
+        "day": sorted(DayCatalog.load(store).entries)[-days:],
+        "ra": [k.split("ra_")[-1][:8] for k in store.list(RA_PREFIX, refresh=True) if k.endswith(".parquet")][-days:],
+    }
+    for source, dates in recent.items():
+        for date in dates:
+            prefix = f"{PYRAMID_PREFIX}{source}/{date.replace('-', '')}/"
+            dated += store.list(prefix, refresh=True)
+
+    # Rewritten files keep their key, so compare contents (the trend model is rewritten by every refit)
+    remote = store.stat_many(dated + [MODEL_KEY])
+    local = replica.stat_many(remote)
+    wanted += [k for k, info in remote.items()
+               if info is not None and (local[k] is None or local[k].md5 != info.md5)]
+
+    replica.put_many(store.get_many(wanted))
+    for key in local_parts - parts:
+        replica.delete(key)
+    print(f"Replica {replica_dir}: copied {len(wanted)} files, removed {len(local_parts - parts)}")
+    update_panel(store, Panel(os.path.join(replica_dir, "panel")))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "sync":
+        sync_replica(open_store(sys.argv[2]), sys.argv[3])
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "run":
+        create_app(sys.argv[2] if len(sys.argv) == 3 else None).run(port=int(os.getenv("PORT", 8080)))
+    else:
+        print("Usage: python3 -m sub.serve sync <BUCKET_NAME|STORE_DIR> <REPLICA_DIR>\n"
+              "       python3 -m sub.serve run [REPLICA_DIR]")
+        sys.exit(1)
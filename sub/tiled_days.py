@@ -0,0 +1,315 @@
+import argparse
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog
+from sub.day_format import (
+    COMPACT_NAMES,
+    COMPACT_SCHEMA,
+    COMPACT_VERSION,
+    COORD_SCALE,
+    LEGACY_COLUMNS,
+    compact_columns,
+    normalize,
+    read_day,
+)
+from sub.metrics import span
+
+# Day pixels partitioned by date and by TILE_DEGREES x TILE_DEGREES tile, in
+# Hive layout so pyarrow/DuckDB/BigQuery can read it as one dataset:
+#   data/days_tiled/date=YYYY-MM-DD/tile=rRRcCC/part.parquet
+#   data/days_tiled/date=YYYY-MM-DD/_manifest.json   (tiles of the day, written last)
+# Tile files use the compact day schema plus a Z-order key, and rows are
+# sorted on that key, so each small row group covers a compact patch of the
+# tile and its lat/lon statistics prune row groups for a bounding box.
+TILED_PREFIX = "data/days_tiled"
+MANIFEST_NAME = "_manifest.json"
+TILE_DEGREES = 10
+TILE_ROWS = 180 // TILE_DEGREES
+TILE_COLS = 360 // TILE_DEGREES
+
+# Rows per row group; tiles hold tens of thousands of pixels a day
+ROW_GROUP_SIZE = 16_384
+
+# Bits per coordinate in the Z-order key (~0.003° x 0.005° per step)
+ZORDER_BITS = 16
+
+TILED_SCHEMA = COMPACT_SCHEMA.append(pa.field("zkey", pa.uint32()))
+
+
+def zorder_key(latitude, longitude):
+    """
+    Returns the Z-order (Morton) key of coordinates.
+
+    Latitude and longitude are quantized to ZORDER_BITS bits each and their
+    bits interleaved, so nearby points get nearby keys.
+
+    Returns:
+        ndarray: uint32 keys.
+    """
+    top = (1 << ZORDER_BITS) - 1
+    y = np.clip((np.asarray(latitude, dtype=np.float64) + 90) / 180 * top, 0, top).astype(np.uint32)
+    x = np.clip((np.asarray(longitude, dtype=np.float64) + 180) / 360 * top, 0, top).astype(np.uint32)
+
+    def spread(v):
+        v = (v | (v << 8)) & 0x00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F
+        v = (v | (v << 2)) & 0x33333333
+        return (v | (v << 1)) & 0x55555555
+
+    return spread(x) | (spread(y) << 1)
+
+
+def tile_index(latitude, longitude):
+    """Returns the (row, col) tile of coordinates, row 0 at the south pole and col 0 at 180°W."""
+    rows = np.clip(np.floor((np.asarray(latitude) + 90) / TILE_DEGREES), 0, TILE_ROWS - 1).astype(np.int32)
+    cols = np.clip(np.floor((np.asarray(longitude) + 180) / TILE_DEGREES), 0, TILE_COLS - 1).astype(np.int32)
+    return rows, cols
+
+
+def tile_name(row, col):
+    return f"r{row:02d}c{col:02d}"
+
+
+def tiles_for_bbox(bbox):
+    """Returns the names of the tiles intersecting a (min_lat, min_lon, max_lat, max_lon) box."""
+    min_lat, min_lon, max_lat, max_lon = bbox
+    (first_row, last_row), (first_col, last_col) = tile_index([min_lat, max_lat], [min_lon, max_lon])
+    return {tile_name(row, col) for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)}
+
+
+def day_prefix(date, prefix=TILED_PREFIX):
+    return f"{prefix}/date={date.strftime('%Y-%m-%d')}/"
+
+
+def tile_key(date, tile, prefix=TILED_PREFIX):
+    return f"{day_prefix(date, prefix)}tile={tile}/part.parquet"
+
+
+# ──── Writing ────
+
+def tile_tables(table):
+    """
+    Splits a day's pixels into sorted tile tables.
+
+    Args:
+        table (pyarrow.Table): Day pixels with the legacy column names.
+
+    Returns:
+        dict: Tile name -> pyarrow.Table in TILED_SCHEMA, sorted by Z-order key.
+    """
+    data = {name: table.column(name).to_numpy(zero_copy_only=False) for name in LEGACY_COLUMNS}
+    columns = compact_columns(data)
+    columns["zkey"] = zorder_key(data["latitude"], data["longitude"])
+    rows, cols = tile_index(data["latitude"], data["longitude"])
+    tiles = rows * TILE_COLS + cols
+
+    order = np.lexsort((columns["zkey"], tiles))
+    tiles = tiles[order]
+    columns = {name: values[order] for name, values in columns.items()}
+    bounds = np.flatnonzero(np.diff(tiles)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(tiles)]])
+    return {
+        tile_name(*divmod(int(tiles[start]), TILE_COLS)): pa.table(
+            {name: values[start:end] for name, values in columns.items()}, schema=TILED_SCHEMA
+        )
+        for start, end in zip(starts, ends)
+    }
+
+
+def _to_bytes(table):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, row_group_size=ROW_GROUP_SIZE, compression="zstd",
+                   use_dictionary=["qa_value"], use_byte_stream_split=["no2"], write_statistics=True)
+    return buffer.getvalue()
+
+
+def write_tiled_day(store, date, table, prefix=TILED_PREFIX):
+    """
+    Writes one day in the tiled layout, then its manifest.
+
+    Tiles are written before the manifest, so readers never see a partial
+    day; tiles of an earlier version of the day that are no longer in the
+    manifest are ignored.
+
+    Args:
+        store (BlobStore): Destination store.
+        date (datetime): Day of the pixels.
+        table (pyarrow.Table): Day pixels with the legacy column names.
+
+    Returns:
+        dict: The manifest.
+    """
+    tables = tile_tables(table)
+    parts = {tile_key(date, tile, prefix): _to_bytes(tile_table) for tile, tile_table in tables.items()}
+    store.put_many(parts)
+    manifest = {
+        "date": date.strftime("%Y-%m-%d"),
+        "tile_degrees": TILE_DEGREES,
+        "tiles": {tile: {"rows": tile_table.num_rows, "bytes": len(parts[tile_key(date, tile, prefix)])}
+                  for tile, tile_table in tables.items()},
+    }
+    store.put(f"{day_prefix(date, prefix)}{MANIFEST_NAME}", json.dumps(manifest).encode(),
+              content_type="application/json")
+    return manifest
+
+
+def process_tiled(store, start_date, end_date, prefix=TILED_PREFIX):
+    """
+    Writes the tiled layout of every cataloged day in a range from its day file.
+
+    Returns:
+        int: Number of days written.
+    """
+    catalog = DayCatalog.load(store)
+    written = 0
+    date = start_date
+    while date <= end_date:
+        entry = catalog.get(date)
+        if entry is None:
+            print(f"⏭️ No day file for {date.strftime('%Y-%m-%d')}")
+        else:
+            with span("tile_day", date=date.strftime("%Y-%m-%d")) as s, store.open(entry["key"]) as source:
+                table = read_day(source)
+                manifest = write_tiled_day(store, date, table, prefix)
+                s.add(rows_in=table.num_rows, bytes_read=entry.get("bytes", 0),
+                      bytes_written=sum(tile["bytes"] for tile in manifest["tiles"].values()))
+            print(f"🧱 {date.strftime('%Y-%m-%d')}: {len(manifest['tiles'])} tiles")
+            written += 1
+        date += timedelta(days=1)
+    return written
+
+
+# ──── Reading ────
+
+def load_manifests(store, start_date, end_date, prefix=TILED_PREFIX):
+    """Returns date -> manifest for the days of a range written in the tiled layout."""
+    dates = []
+    date = start_date
+    while date <= end_date:
+        dates.append(date)
+        date += timedelta(days=1)
+    keys = {f"{day_prefix(date, prefix)}{MANIFEST_NAME}": date for date in dates}
+    present = [key for key, exists in store.exists_many(keys).items() if exists]
+    return {keys[key]: json.loads(data) for key, data in store.get_many(present).items()}
+
+
+def _overlaps(metadata, row_group, bbox):
+    """True if the lat/lon statistics of a row group may hold points of the box."""
+    if bbox is None:
+        return True
+    min_lat, min_lon, max_lat, max_lon = (round(value * COORD_SCALE) for value in bbox)
+    group = metadata.row_group(row_group)
+    for index in range(group.num_columns):
+        column = group.column(index)
+        stats = column.statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if column.path_in_schema == "lat" and (stats.max < min_lat or stats.min > max_lat):
+            return False
+        if column.path_in_schema == "lon" and (stats.max < min_lon or stats.min > max_lon):
+            return False
+    return True
+
+
+def _read_tile(store, key, date, bbox, physical, stats, lock):
+    with store.open(key) as source:
+        parquet_file = pq.ParquetFile(source)
+        metadata = parquet_file.metadata
+        groups = [group for group in range(metadata.num_row_groups) if _overlaps(metadata, group, bbox)]
+        read_columns = sorted(set(physical) | ({"lat", "lon"} if bbox is not None else set()))
+        table = parquet_file.read_row_groups(groups, columns=read_columns) if groups else None
+
+    # Bytes of the footer and of the column chunks fetched
+    fetched = metadata.serialized_size + sum(
+        metadata.row_group(group).column(index).total_compressed_size
+        for group in groups
+        for index in range(metadata.num_columns)
+        if metadata.row_group(group).column(index).path_in_schema in read_columns
+    )
+    with lock:
+        stats["row_groups"] += metadata.num_row_groups
+        stats["row_groups_read"] += len(groups)
+        stats["bytes_read"] += fetched
+    if table is None:
+        return None
+    if bbox is not None:
+        min_lat, min_lon, max_lat, max_lon = (round(value * COORD_SCALE) for value in bbox)
+        lat, lon = table.column("lat").to_numpy(), table.column("lon").to_numpy()
+        table = table.filter((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon))
+    table = normalize(table.select(physical), COMPACT_VERSION)
+    return table.append_column("date", pa.array(np.full(table.num_rows, np.datetime64(date, "us"))))
+
+
+def read_region(store, start_date, end_date, bbox=None, columns=None, stats=None, prefix=TILED_PREFIX):
+    """
+    Reads the pixels of a box and date range from the tiled layout.
+
+    Only the manifests of the range, the tiles intersecting the box and,
+    within them, the row groups whose lat/lon statistics overlap it are read.
+
+    Args:
+        store (BlobStore): Store holding the tiled layout.
+        start_date (datetime): First date.
+        end_date (datetime): Last date.
+        bbox (tuple): (min_lat, min_lon, max_lat, max_lon), None for the whole globe.
+        columns (list): Legacy column names to read, defaults to all.
+        stats (dict): If given, receives the days, tiles, row groups and bytes read.
+
+    Returns:
+        pyarrow.Table: The pixels with the legacy column names plus "date".
+    """
+    columns = list(columns or LEGACY_COLUMNS)
+    physical = [COMPACT_NAMES[column] for column in columns]
+    stats = stats if stats is not None else {}
+    for counter in ("days", "tiles", "tiles_total", "row_groups", "row_groups_read", "bytes_read"):
+        stats.setdefault(counter, 0)
+
+    wanted = tiles_for_bbox(bbox) if bbox is not None else None
+    tasks = []
+    for date, manifest in sorted(load_manifests(store, start_date, end_date, prefix).items()):
+        stats["days"] += 1
+        stats["tiles_total"] += len(manifest["tiles"])
+        tasks += [(tile_key(date, tile, prefix), date) for tile in sorted(manifest["tiles"])
+                  if wanted is None or tile in wanted]
+    stats["tiles"] += len(tasks)
+
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=store.max_workers) as executor:
+        tables = list(executor.map(lambda task: _read_tile(store, *task, bbox, physical, stats, lock), tasks))
+    tables = [table for table in tables if table is not None and table.num_rows]
+    if not tables:
+        empty = normalize(TILED_SCHEMA.empty_table().select(physical), COMPACT_VERSION)
+        return empty.append_column("date", pa.array([], pa.timestamp("us")))
+    return pa.concat_tables(tables)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write or query the date/tile-partitioned day layout.")
+    parser.add_argument("command", choices=["build", "read"])
+    parser.add_argument("store", help="GCS bucket name, gs:// URI or local directory")
+    parser.add_argument("start_date", help="YYYY-MM-DD")
+    parser.add_argument("end_date", help="YYYY-MM-DD")
+    parser.add_argument("--bbox", help="min_lat,min_lon,max_lat,max_lon for read")
+    args = parser.parse_args()
+
+    store = open_store(args.store)
+    start = datetime.strptime(args.start_date, "%Y-%m-%d")
+    end = datetime.strptime(args.end_date, "%Y-%m-%d")
+    if args.command == "build":
+        process_tiled(store, start, end)
+    else:
+        bbox = tuple(float(value) for value in args.bbox.split(",")) if args.bbox else None
+        stats = {}
+        table = read_region(store, start, end, bbox, stats=stats)
+        print(f"{table.num_rows} pixels from {stats['days']} days")
+        print(f"Tiles read: {stats['tiles']} of {stats['tiles_total']}; "
+              f"row groups read: {stats['row_groups_read']} of {stats['row_groups']}; "
+              f"{stats['bytes_read'] / 1e6:.2f} MB read")
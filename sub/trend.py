@@ -0,0 +1,287 @@
+import argparse
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import numpy as np
+from sub.blob_store import open_store
+from sub.grid import NCELLS, NLAT, NLON
+from sub.metrics import add_arguments, configure, span
+from sub.panel import ORIGIN, TILE, TILE_COLS, TILE_ROWS, Panel
+
+# Per-cell trend and seasonality model, fitted on the panel (see `panel`):
+#
+#   no2(t) = b0 + b1 * years + sum_k (a_k * cos(2 pi k years) + c_k * sin(2 pi k years))
+#
+# with `years` counted from the panel origin. Every cell shares the design
+# matrix, so one tile of cells is fitted at once: the masked normal equations
+# X'WX and X'Wy of all its cells are two matrix products, then solved as a
+# batch of small systems. Tiles are fitted in parallel by worker processes,
+# each reading its tile's history from the memory-mapped panel files, so the
+# panel never has to fit in memory.
+MODEL_KEY = "data/trend/model.npz"
+
+# Annual harmonics; 2 captures the asymmetric winter peak of NO2
+HARMONICS = 2
+# Cells with fewer valid days are not fitted
+MIN_DAYS = 90
+# Cells whose normal equations are worse conditioned are not fitted, e.g.
+# polar cells seen only in summer, whose seasonal cycle is undetermined
+MAX_CONDITION = 1e6
+# Cells fitted per matrix product, bounding the float64 copies of a tile
+CELL_CHUNK = 2500
+FIT_WORKERS = int(os.getenv("TREND_WORKERS", os.cpu_count() or 1))
+
+YEAR_DAYS = 365.25
+
+
+def design_matrix(days, harmonics=HARMONICS):
+    """
+    Returns the regressors of the model.
+
+    Args:
+        days (ndarray): Days since the panel origin.
+        harmonics (int): Annual harmonics.
+
+    Returns:
+        ndarray: float64 (days, 2 + 2 * harmonics): intercept, years, then a
+        cosine and a sine per harmonic.
+    """
+    years = np.asarray(days, dtype=np.float64) / YEAR_DAYS
+    columns = [np.ones_like(years), years]
+    for k in range(1, harmonics + 1):
+        columns += [np.cos(2 * np.pi * k * years), np.sin(2 * np.pi * k * years)]
+    return np.stack(columns, axis=1)
+
+
+def fit_cells(values, design, min_days=MIN_DAYS):
+    """
+    Least-squares fits of the model to many cells sharing one design matrix.
+
+    Missing days (NaN) are masked out of each cell's normal equations.
+
+    Args:
+        values (ndarray): (cells, days) daily values, NaN where missing.
+        design (ndarray): (days, terms) design matrix (see `design_matrix`).
+        min_days (int): Cells with fewer valid days are not fitted.
+
+    Returns:
+        tuple: (coefficients (cells, terms), residual variance (cells,),
+        valid days (cells,)); NaN coefficients and variance for cells not fitted.
+    """
+    terms = design.shape[1]
+    outer = (design[:, :, None] * design[:, None, :]).reshape(len(design), terms * terms)
+    coefficients = np.full((len(values), terms), np.nan)
+    variance = np.full(len(values), np.nan)
+    count = np.zeros(len(values), dtype=np.int64)
+
+    for start in range(0, len(values), CELL_CHUNK):
+        chunk = values[start:start + CELL_CHUNK]
+        mask = np.isfinite(chunk)
+        y = np.where(mask, chunk, 0).astype(np.float64)
+        n = mask.sum(axis=1)
+        count[start:start + len(chunk)] = n
+
+        fitted = np.flatnonzero(n >= min_days)
+        if not len(fitted):
+            continue
+        normal = (mask[fitted].astype(np.float64) @ outer).reshape(-1, terms, terms)
+        moments = y[fitted] @ design
+        well_posed = np.linalg.cond(normal) < MAX_CONDITION
+        fitted, normal, moments = fitted[well_posed], normal[well_posed], moments[well_posed]
+        if not len(fitted):
+            continue
+        beta = np.linalg.solve(normal, moments[:, :, None])[:, :, 0]
+
+        residuals = np.where(mask[fitted], y[fitted] - beta @ design.T, 0)
+        coefficients[start + fitted] = beta
+        variance[start + fitted] = (residuals ** 2).sum(axis=1) / np.maximum(n[fitted] - terms, 1)
+    return coefficients, variance, count
+
+
+def deseasonalize(values, coefficients, design):
+    """Returns `values` minus each cell's fitted seasonal cycle, keeping the trend; NaN for cells not fitted."""
+    series = np.empty(values.shape, dtype=np.float32)
+    for start in range(0, len(values), CELL_CHUNK):
+        seasonal = coefficients[start:start + CELL_CHUNK, 2:] @ design[:, 2:].T
+        series[start:start + CELL_CHUNK] = values[start:start + CELL_CHUNK] - seasonal
+    return series
+
+
+def tile_cells(tile_row, tile_col):
+    """
+    Returns the grid cells of a panel tile.
+
+    Returns:
+        tuple: (positions within the tile's TILE * TILE cells that lie on the
+        grid, their int32 cell ids).
+    """
+    rows = tile_row * TILE + np.arange(TILE)[:, None]
+    cols = tile_col * TILE + np.arange(TILE)[None, :]
+    on_grid = ((rows < NLAT) & (cols < NLON)).ravel()
+    ids = (rows * NLON + cols).ravel()
+    return np.flatnonzero(on_grid), ids[on_grid].astype(np.int32)
+
+
+class TrendModel:
+    """
+    Fitted trend and seasonality of every grid cell, as dense arrays.
+
+    Saved sparsely in float32, holding only the fitted cells. Times are days
+    since `origin`, the panel origin.
+    """
+
+    def __init__(self, coefficients, variance, count, harmonics=HARMONICS, start=None, end=None, origin=ORIGIN):
+        self.coefficients = coefficients
+        self.variance = variance
+        self.count = count
+        self.harmonics = harmonics
+        self.start = start
+        self.end = end
+        self.origin = origin
+
+    @classmethod
+    def empty(cls, harmonics=HARMONICS, start=None, end=None):
+        return cls(np.full((NCELLS, 2 + 2 * harmonics), np.nan, np.float32), np.full(NCELLS, np.nan, np.float32),
+                   np.zeros(NCELLS, np.uint16), harmonics, start, end)
+
+    @property
+    def fitted(self):
+        """Boolean mask of the fitted cells."""
+        return np.isfinite(self.variance)
+
+    def design(self, dates):
+        """Returns the design matrix of datetime64 or datetime dates."""
+        days = (np.asarray(dates, dtype="datetime64[D]") - np.datetime64(self.origin, "D")).astype(np.int64)
+        return design_matrix(days, self.harmonics)
+
+    def seasonal(self, cells, dates):
+        """Returns the fitted seasonal cycle of cells on dates, as (dates, cells)."""
+        return self.design(dates)[:, 2:] @ self.coefficients[cells, 2:].T.astype(np.float64)
+
+    def predict(self, cells, dates):
+        """Returns the fitted trend plus seasonal cycle of cells on dates, as (dates, cells)."""
+        return self.design(dates) @ self.coefficients[cells].T.astype(np.float64)
+
+    def to_bytes(self):
+        cells = np.flatnonzero(self.fitted).astype(np.int32)
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            harmonics=np.array(self.harmonics),
+            start=np.array(self.start or ""),
+            end=np.array(self.end or ""),
+            origin=np.array(self.origin.strftime("%Y-%m-%d")),
+            cells=cells,
+            coefficients=self.coefficients[cells],
+            variance=self.variance[cells],
+            count=self.count[cells],
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        saved = np.load(io.BytesIO(data), allow_pickle=False)
+        model = cls.empty(int(saved["harmonics"]), str(saved["start"]) or None, str(saved["end"]) or None)
+        model.origin = datetime.strptime(str(saved["origin"]), "%Y-%m-%d")
+        cells = saved["cells"]
+        model.coefficients[cells] = saved["coefficients"]
+        model.variance[cells] = saved["variance"]
+        model.count[cells] = saved["count"]
+        return model
+
+
+def load_model(store, key=MODEL_KEY):
+    """Returns the fitted model saved in a store, or None if there is none."""
+    return TrendModel.from_bytes(store.get(key)) if store.exists(key) else None
+
+
+def _fit_tile(panel_root, output_root, tile_row, tile_col, start, end, harmonics):
+    """Fits one tile in a worker process and writes its deseasonalized series; returns the fitted cells."""
+    dates, values = Panel(panel_root).tile(tile_row, tile_col, start, end)
+    positions, cells = tile_cells(tile_row, tile_col)
+    if len(positions) < len(values):
+        values = values[positions]
+    observations = int(np.count_nonzero(~np.isnan(values)))
+    if not observations:
+        return cells[:0], np.empty((0, 2 + 2 * harmonics)), np.empty(0), np.empty(0, np.int64), 0
+    design = design_matrix((dates - np.datetime64(ORIGIN, "D")).astype(np.int64), harmonics)
+    coefficients, variance, count = fit_cells(values, design)
+
+    fitted = np.isfinite(variance)
+    if output_root is not None and fitted.any():
+        series = np.full((TILE * TILE, len(dates)), np.nan, dtype=np.float32)
+        series[positions] = deseasonalize(values, coefficients, design)
+        Panel(output_root).write_tile(tile_row, tile_col, start, series)
+    return cells[fitted], coefficients[fitted], variance[fitted], count[fitted], observations
+
+
+def fit_panel(panel, start=None, end=None, output=None, harmonics=HARMONICS, workers=FIT_WORKERS):
+    """
+    Fits the model to every cell of the panel, one tile per task.
+
+    Args:
+        panel (Panel): Panel holding the daily means.
+        start (datetime): First date fitted, defaults to the panel's first date.
+        end (datetime): Last date fitted, defaults to the panel's last date.
+        output (Panel): Panel receiving the deseasonalized series (the
+            data minus each cell's seasonal cycle), if given.
+        harmonics (int): Annual harmonics.
+        workers (int): Worker processes.
+
+    Returns:
+        TrendModel: The fitted model.
+    """
+    start = start or datetime.strptime(min(panel.meta["dates"]), "%Y-%m-%d")
+    end = end or datetime.strptime(max(panel.meta["dates"]), "%Y-%m-%d")
+    model = TrendModel.empty(harmonics, start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+    tiles = [(row, col) for row in range(TILE_ROWS) for col in range(TILE_COLS)]
+    print(f"📈 Fitting {len(tiles)} tiles from {model.start} to {model.end} with {workers} workers")
+
+    with span("trend_fit", first_date=model.start, last_date=model.end, harmonics=harmonics) as s:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_fit_tile, panel.root, output.root if output else None, row, col, start, end, harmonics)
+                for row, col in tiles
+            ]
+            for done, future in enumerate(as_completed(futures), 1):
+                cells, coefficients, variance, count, observations = future.result()
+                model.coefficients[cells] = coefficients
+                model.variance[cells] = variance
+                model.count[cells] = np.minimum(count, np.iinfo(np.uint16).max)
+                s.add(rows_in=observations, rows_out=len(cells))
+                if done % 100 == 0:
+                    print(f"📈 {done} of {len(tiles)} tiles fitted")
+        if output is not None:
+            output.record_dates(datetime.strptime(date, "%Y-%m-%d") for date in panel.meta["dates"]
+                                if model.start <= date <= model.end)
+        print(f"✅ Fitted {int(model.fitted.sum())} cells")
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit per-cell trend and seasonality models on the panel.")
+    parser.add_argument("store", help="GCS bucket name, gs:// URI or local directory receiving the model")
+    parser.add_argument("panel_dir", help="Panel directory (see sub.panel)")
+    parser.add_argument("start_date", nargs="?", help="YYYY-MM-DD, defaults to the panel's first date")
+    parser.add_argument("end_date", nargs="?", help="YYYY-MM-DD, defaults to the panel's last date")
+    parser.add_argument("--harmonics", type=int, default=HARMONICS)
+    parser.add_argument("--workers", type=int, default=FIT_WORKERS)
+    parser.add_argument("--deseasonalized", help="Panel directory for the deseasonalized series, "
+                                                 "defaults to PANEL_DIR/deseasonalized ('none' to skip)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure(args.metrics, args.profile)
+
+    panel = Panel(args.panel_dir)
+    output_dir = args.deseasonalized or os.path.join(args.panel_dir, "deseasonalized")
+    model = fit_panel(
+        panel,
+        datetime.strptime(args.start_date, "%Y-%m-%d") if args.start_date else None,
+        datetime.strptime(args.end_date, "%Y-%m-%d") if args.end_date else None,
+        None if output_dir == "none" else Panel(output_dir),
+        args.harmonics,
+        args.workers,
+    )
+    open_store(args.store).put(MODEL_KEY, model.to_bytes())
+    print(f"💾 Saved {MODEL_KEY}")
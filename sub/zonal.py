@@ -0,0 +1,378 @@
+import argparse
+import hashlib
+import io
+import os
+from datetime import datetime, timedelta
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+from scipy import sparse
+from sub.anomaly import ANOMALY_PREFIX, RA_PREFIX
+from sub.blob_store import open_store
+from sub.catalog import DayCatalog
+from sub.country_store import _to_bytes, new_run_id, part_key
+from sub.disk_cache import CACHE_DIR
+from sub.grid import NCELLS, NLAT, NLON, RESOLUTION, cell_ids, load_day_grid
+
+# Zonal statistics: a sparse (region x grid cell) matrix holds the area of
+# each grid cell covered by each region, so the area-weighted means of every
+# region for a batch of days are one sparse matrix product. Grid cells are
+# the 0.1° cells around the grid nodes (see `sub.grid`); border cells count
+# with the share of their area inside the region. Weights are spherical
+# areas in km², so high-latitude cells weigh less.
+#
+# Results are stored like the country rows, one part per run and year:
+#   data/zonal/<region set>/<source>-<field>/year=YYYY/part-<run_id>.parquet
+ZONAL_PREFIX = "data/zonal"
+COLUMNS = ["Region", "Date", "Mean", "Coverage"]
+
+# Bumped when the weight layout changes, so stale caches are not reused
+WEIGHTS_VERSION = 1
+
+EARTH_RADIUS_KM = 6371.0
+# Grid rows whose cells are intersected with the regions at once
+BAND_ROWS = 30
+# Days multiplied by the weight matrix at once
+BATCH_DAYS = 32
+
+# Field averaged by default for each source
+DEFAULT_FIELDS = {"day": "no2_mean", "ra": "no2_ra", "anomaly": "deviation"}
+
+
+def cell_bounds(rows):
+    """
+    Returns the bounds of the grid cells of some grid rows.
+
+    Cells span half a step around their node and are clipped at the poles
+    and the antimeridian, as `cell_ids` clips coordinates.
+
+    Returns:
+        tuple: (west, south, east, north) arrays of shape (len(rows), NLON).
+    """
+    lat = (np.asarray(rows)[:, None] - (NLAT - 1) // 2) * RESOLUTION
+    lon = (np.arange(NLON)[None, :] - (NLON - 1) // 2) * RESOLUTION
+    south = np.broadcast_to(np.clip(lat - RESOLUTION / 2, -90, 90), (len(rows), NLON))
+    north = np.broadcast_to(np.clip(lat + RESOLUTION / 2, -90, 90), (len(rows), NLON))
+    west = np.broadcast_to(np.clip(lon - RESOLUTION / 2, -180, 180), (len(rows), NLON))
+    east = np.broadcast_to(np.clip(lon + RESOLUTION / 2, -180, 180), (len(rows), NLON))
+    return west, south, east, north
+
+
+def cell_areas_km2(west, south, east, north):
+    """Spherical area of latitude-longitude boxes in km²."""
+    return (EARTH_RADIUS_KM ** 2 * np.radians(east - west)
+            * (np.sin(np.radians(north)) - np.sin(np.radians(south))))
+
+
+def build_weights(geometries, region_codes, n_regions):
+    """
+    Builds the (region x cell) matrix of covered areas.
+
+    Works in bands of grid rows: cells fully inside a geometry get their
+    whole area, and only cells crossed by a boundary are intersected with it.
+
+    Args:
+        geometries (ndarray): Region geometries in lon/lat degrees.
+        region_codes (ndarray): Region index of each geometry; a region may
+            have several geometries.
+        n_regions (int): Number of regions.
+
+    Returns:
+        scipy.sparse.csr_matrix: float64 weights in km², shape (n_regions, NCELLS).
+    """
+    geometries = np.asarray(geometries)
+    shapely.prepare(geometries)
+    region_parts, cell_parts, weight_parts = [], [], []
+
+    for first in range(0, NLAT, BAND_ROWS):
+        rows = np.arange(first, min(first + BAND_ROWS, NLAT))
+        west, south, east, north = (bound.ravel() for bound in cell_bounds(rows))
+        keep = (east > west) & (north > south)
+        cells = (rows[:, None] * NLON + np.arange(NLON)[None, :]).ravel()[keep]
+        west, south, east, north = west[keep], south[keep], east[keep], north[keep]
+        boxes = shapely.box(west, south, east, north)
+        tree = shapely.STRtree(boxes)
+
+        # (geometry, box) pairs: boxes inside a geometry, and boxes touching it
+        inside_geometry, inside_box = tree.query(geometries, predicate="contains_properly")
+        touch_geometry, touch_box = tree.query(geometries, predicate="intersects")
+        border = ~np.isin(touch_geometry.astype(np.int64) * len(boxes) + touch_box,
+                          inside_geometry.astype(np.int64) * len(boxes) + inside_box)
+        border_geometry, border_box = touch_geometry[border], touch_box[border]
+
+        areas = cell_areas_km2(west, south, east, north)
+        share = (shapely.area(shapely.intersection(boxes[border_box], geometries[border_geometry]))
+                 / shapely.area(boxes[border_box])) if len(border_box) else np.zeros(0)
+
+        region_parts += [region_codes[inside_geometry], region_codes[border_geometry]]
+        cell_parts += [cells[inside_box], cells[border_box]]
+        weight_parts += [areas[inside_box], areas[border_box] * share]
+
+    regions = np.concatenate(region_parts)
+    cells = np.concatenate(cell_parts)
+    weights = np.concatenate(weight_parts)
+    positive = weights > 0
+    # Duplicate (region, cell) pairs, from regions made of several geometries, are summed
+    return sparse.csr_matrix((weights[positive], (regions[positive], cells[positive])),
+                             shape=(n_regions, NCELLS))
+
+
+class ZonalWeights:
+    """
+    Area weights of a region set on the grid, and the region means they give.
+
+    Attributes:
+        names (ndarray): Region names, one per matrix row.
+        matrix (scipy.sparse.csr_matrix): Covered area (km²) of each cell by each region.
+    """
+
+    def __init__(self, names, matrix):
+        self.names = names
+        self.matrix = matrix
+        self.areas = np.asarray(matrix.sum(axis=1)).ravel()
+
+    def means(self, columns):
+        """
+        Area-weighted region means of several sparse grids in one product.
+
+        Cells without a finite value do not count, so a region's mean is over
+        its observed area; `coverage` is the observed share of its area.
+
+        Args:
+            columns (list): (cells, values) pairs, e.g. one per day.
+
+        Returns:
+            tuple: (means, coverage) arrays of shape (regions, len(columns)),
+            means NaN where a region has no observed cell.
+        """
+        rows, cols, data = [], [], []
+        for index, (cells, values) in enumerate(columns):
+            values = np.asarray(values, dtype=np.float64)
+            valid = np.isfinite(values)
+            cells = np.asarray(cells)[valid]
+            rows += [cells, cells]
+            cols += [np.full(len(cells), 2 * index), np.full(len(cells), 2 * index + 1)]
+            data += [values[valid], np.ones(len(cells))]
+        grids = sparse.csc_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                  shape=(NCELLS, 2 * len(columns)))
+        product = (self.matrix @ grids).toarray()
+        sums, observed = product[:, 0::2], product[:, 1::2]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(observed > 0, sums / observed, np.nan)
+            coverage = observed / self.areas[:, None]
+        return means, coverage
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, names=self.names.astype(str), data=self.matrix.data,
+                            indices=self.matrix.indices, indptr=self.matrix.indptr)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_file(cls, path):
+        cached = np.load(path, allow_pickle=False)
+        matrix = sparse.csr_matrix((cached["data"], cached["indices"], cached["indptr"]),
+                                   shape=(len(cached["names"]), NCELLS))
+        return cls(cached["names"], matrix)
+
+
+def load_weights(names, geometries, cache_dir=CACHE_DIR):
+    """
+    Returns the weights of a region set, building them on first use.
+
+    The matrix is cached on disk under a digest of the region names and
+    geometries, so any edit to the regions invalidates it.
+
+    Args:
+        names (ndarray): Region name of each geometry; geometries sharing a
+            name form one region.
+        geometries (ndarray): Region geometries in lon/lat degrees.
+        cache_dir (str): Directory for cached matrices.
+
+    Returns:
+        ZonalWeights: Weights with one row per distinct name.
+    """
+    unique_names, region_codes = np.unique(np.asarray(names).astype(str), return_inverse=True)
+    digest = hashlib.sha256(f"v{WEIGHTS_VERSION}:{NLAT}x{NLON}:{RESOLUTION}".encode())
+    for name, wkb in zip(np.asarray(names).astype(str), shapely.to_wkb(geometries)):
+        digest.update(name.encode())
+        digest.update(wkb)
+    cache_path = os.path.join(cache_dir, f"zonal_weights_{digest.hexdigest()[:16]}.npz")
+    if os.path.exists(cache_path):
+        return ZonalWeights.from_file(cache_path)
+
+    print(f"Building zonal weights for {len(unique_names)} regions...")
+    weights = ZonalWeights(unique_names, build_weights(geometries, region_codes.astype(np.int32),
+                                                       len(unique_names)))
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(weights.to_bytes())
+    os.replace(tmp_path, cache_path)
+    print(f"Zonal weights cached at {cache_path} ({weights.matrix.nnz} cells)")
+    return weights
+
+
+# ──── Region sets ────
+
+def load_regions(path, name_field="NAME"):
+    """
+    Reads a polygon set from any vector file geopandas reads (GeoJSON, shapefile, GeoPackage...).
+
+    Returns:
+        tuple: (names, geometries) arrays.
+    """
+    regions = gpd.read_file(path)
+    if regions.crs is not None and not regions.crs.equals("EPSG:4326"):
+        regions = regions.to_crs("EPSG:4326")
+    return regions[name_field].astype(str).to_numpy(), regions.geometry.to_numpy()
+
+
+def buffer_regions(names, latitudes, longitudes, radius_km):
+    """
+    Builds circular regions around points, e.g. city buffers.
+
+    Circles are drawn in degrees, stretched east-west by 1 / cos(latitude),
+    which is accurate for radii up to a few hundred km.
+
+    Returns:
+        tuple: (names, geometries) arrays.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    radius = np.degrees(radius_km / EARTH_RADIUS_KM)
+    unit = shapely.buffer(shapely.points(0.0, 0.0), 1.0, quad_segs=16)
+    ring = shapely.get_coordinates(unit)
+    geometries = [
+        shapely.polygons(np.column_stack([lon + ring[:, 0] * radius / max(np.cos(np.radians(lat)), 1e-6),
+                                          np.clip(lat + ring[:, 1] * radius, -90, 90)]))
+        for lat, lon in zip(latitudes, longitudes)
+    ]
+    return np.asarray(names).astype(str), np.array(geometries, dtype=object)
+
+
+# ──── Sources ────
+
+def read_source(store, source, date, field=None, catalog=None):
+    """
+    Reads one day of a gridded product as (cells, values).
+
+    Args:
+        store (BlobStore): Store holding the products.
+        source (str): "day" (gridded day products), "ra" (rolling averages)
+            or "anomaly" (anomaly scores).
+        date (datetime): Day to read.
+        field (str): Column averaged, defaults to DEFAULT_FIELDS[source].
+        catalog (DayCatalog): Day catalog, for the day source.
+
+    Returns:
+        tuple or None: (cells, values), or None if the day was not computed.
+    """
+    field = field or DEFAULT_FIELDS[source]
+    if source == "day":
+        stats = load_day_grid(store, date, catalog)
+        if stats is None:
+            return None
+        return stats.cells, stats.mean if field == "no2_mean" else getattr(stats, field)
+
+    prefix, name = (RA_PREFIX, "ra") if source == "ra" else (ANOMALY_PREFIX, "an")
+    key = f"{prefix}{name}_{date.strftime('%Y%m%d')}.parquet"
+    if not store.exists(key):
+        return None
+    with store.open(key) as f:
+        table = pq.read_table(f, columns=["lat_bin", "lon_bin", field])
+    cells = cell_ids(table.column("lat_bin").to_numpy(), table.column("lon_bin").to_numpy())
+    return cells, table.column(field).to_numpy(zero_copy_only=False).astype(np.float64)
+
+
+def zonal_range(store, weights, source, start_date, end_date, field=None):
+    """
+    Computes the region means of a product for every day in a date range.
+
+    Days are read one at a time and multiplied by the weights in batches of
+    BATCH_DAYS.
+
+    Returns:
+        DataFrame: Region, Date ("YYYY-MM-DD"), Mean and Coverage, one row
+        per region with data and day.
+    """
+    catalog = DayCatalog.load(store) if source == "day" else None
+    frames = []
+    batch, dates = [], []
+
+    def flush():
+        means, coverage = weights.means(batch)
+        for index, date in enumerate(dates):
+            present = np.isfinite(means[:, index])
+            frames.append(pd.DataFrame({
+                "Region": weights.names[present],
+                "Date": date,
+                "Mean": means[present, index],
+                "Coverage": coverage[present, index],
+            }))
+        batch.clear()
+        dates.clear()
+
+    date = start_date
+    while date <= end_date:
+        column = read_source(store, source, date, field, catalog)
+        if column is None:
+            print(f"⏭️ No {source} data for {date.strftime('%Y-%m-%d')}")
+        else:
+            batch.append(column)
+            dates.append(date.strftime("%Y-%m-%d"))
+        if len(batch) >= BATCH_DAYS:
+            flush()
+        date += timedelta(days=1)
+    if batch:
+        flush()
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=COLUMNS)
+
+
+def write_zonal(store, region_set, source, field, rows):
+    """
+    Appends region means to the store, one new part per year.
+
+    Returns:
+        list: Keys of the parts written.
+    """
+    if rows.empty:
+        return []
+    folder = f"{ZONAL_PREFIX}/{region_set}/{source}-{field or DEFAULT_FIELDS[source]}"
+    run_id = new_run_id()
+    rows = rows[COLUMNS].sort_values(["Region", "Date"])
+    parts = {part_key(folder, year, run_id): _to_bytes(frame)
+             for year, frame in rows.groupby(rows["Date"].str[:4].astype(int))}
+    store.put_many(parts)
+    return list(parts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Area-weighted region means of the gridded products.")
+    parser.add_argument("store", help="GCS bucket name, gs:// URI or local directory")
+    parser.add_argument("regions", help="Vector file of polygons, or a CSV of name,latitude,longitude points")
+    parser.add_argument("start_date", help="YYYY-MM-DD")
+    parser.add_argument("end_date", help="YYYY-MM-DD")
+    parser.add_argument("--source", choices=sorted(DEFAULT_FIELDS), default="day")
+    parser.add_argument("--field", help="Column averaged; defaults to no2_mean, no2_ra or deviation by source")
+    parser.add_argument("--name-field", default="NAME", help="Column naming the polygons")
+    parser.add_argument("--radius-km", type=float, default=25.0, help="Buffer radius around CSV points")
+    parser.add_argument("--set-name", help="Name of the region set in the store, defaults to the file name")
+    args = parser.parse_args()
+
+    if args.regions.endswith(".csv"):
+        points = pd.read_csv(args.regions)
+        names, geometries = buffer_regions(points["name"], points["latitude"], points["longitude"], args.radius_km)
+    else:
+        names, geometries = load_regions(args.regions, args.name_field)
+    region_set = args.set_name or os.path.splitext(os.path.basename(args.regions))[0]
+
+    store = open_store(args.store)
+    weights = load_weights(names, geometries)
+    rows = zonal_range(store, weights, args.source, datetime.strptime(args.start_date, "%Y-%m-%d"),
+                       datetime.strptime(args.end_date, "%Y-%m-%d"), args.field)
+    for key in write_zonal(store, region_set, args.source, args.field, rows):
+        print(f"✅ Region means written to {store.uri(key)}")
+    print(f"{rows['Region'].nunique() if not rows.empty else 0} regions, {len(rows)} rows")
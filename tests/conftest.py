@@ -0,0 +1,33 @@
+import shutil
+from datetime import datetime
+import pytest
+from bench.synthetic import generate
+from sub.blob_store import LocalStore
+
+# Synthetic days shared by the tests: small, but every stage has real work
+START_DATE = datetime(2024, 1, 1)
+DAYS = 8
+SCALE = 0.02
+
+
+@pytest.fixture(scope="session")
+def synthetic_dir(tmp_path_factory):
+    """Tars and a store of synthetic days, generated once per session."""
+    root = tmp_path_factory.mktemp("synthetic")
+    generate(str(root), START_DATE, DAYS, SCALE, seed=0)
+    return root
+
+
+@pytest.fixture
+def synthetic_store(synthetic_dir, tmp_path):
+    """A writable copy of the synthetic store."""
+    shutil.copytree(synthetic_dir / "store", tmp_path / "store")
+    return LocalStore(str(tmp_path / "store"))
+
+
+@pytest.fixture(autouse=True)
+def quiet_environment(monkeypatch, tmp_path):
+    """Keeps metrics and the local blob cache out of the tests."""
+    monkeypatch.setenv("NO2_METRICS", "off")
+    monkeypatch.setattr("sub.disk_cache._default", None)
+    monkeypatch.setattr("sub.disk_cache.CACHE_BUDGET", 0)
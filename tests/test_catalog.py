@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from sub.blob_store import LocalStore, PreconditionFailed
+from sub.catalog import DayCatalog, record_days, update_catalog
+
+
+def test_put_if_generation_rejects_a_stale_generation(tmp_path):
+    store = LocalStore(str(tmp_path))
+    store.put_if_generation("doc.json", b"1", None)
+    _, generation = store.get_versioned("doc.json")
+
+    with pytest.raises(PreconditionFailed):
+        store.put_if_generation("doc.json", b"2", None)
+    store.put_if_generation("doc.json", b"2", generation)
+    with pytest.raises(PreconditionFailed):
+        store.put_if_generation("doc.json", b"3", generation)
+    assert store.get("doc.json") == b"2"
+
+
+def test_update_catalog_reapplies_after_a_concurrent_write(tmp_path):
+    store = LocalStore(str(tmp_path))
+    calls = []
+
+    def update(entries):
+        if not calls:
+            # Another writer gets in between this read and its write
+            record_days(store, [{"date": "2024-01-01"}])
+        calls.append(1)
+        entries["2024-01-02"] = {"date": "2024-01-02"}
+
+    update_catalog(store, update)
+    assert len(calls) == 2
+    assert set(DayCatalog.load(store).entries) == {"2024-01-01", "2024-01-02"}
+
+
+def test_concurrent_record_days_keep_every_entry(tmp_path):
+    store = LocalStore(str(tmp_path))
+    dates = [f"2024-01-{day:02d}" for day in range(1, 9)]
+    with ThreadPoolExecutor(max_workers=len(dates)) as executor:
+        list(executor.map(lambda date: record_days(store, [{"date": date}]), dates))
+    assert sorted(DayCatalog.load(store).entries) == dates
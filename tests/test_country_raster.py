@@ -0,0 +1,43 @@
+import os
+import geopandas as gpd
+import numpy as np
+import shapely
+from sub.country_raster import OUTSIDE, load_country_raster
+
+GEOJSON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "geojson", "ne_110m_admin_0_countries.geojson")
+
+
+def sample_points(world, seed=0):
+    """Uniform points, points on and just off the country boundaries, ocean points and grid edges."""
+    rng = np.random.default_rng(seed)
+    uniform = shapely.points(rng.uniform(-180, 180, 20000), rng.uniform(-90, 90, 20000))
+
+    boundaries = shapely.boundary(world.geometry.to_numpy())
+    lines = rng.integers(0, len(boundaries), 5000)
+    on_border = shapely.line_interpolate_point(boundaries[lines], rng.random(len(lines)), normalized=True)
+    x, y = shapely.get_coordinates(on_border).T
+    near_border = shapely.points(x + rng.normal(0, 1e-3, len(x)), y + rng.normal(0, 1e-3, len(y)))
+
+    fixed = shapely.points([-140, 0, 180, -180, 0, 2.35], [0, -90, 0, 45, 90, 48.85])
+    return np.concatenate([uniform, on_border, near_border, fixed])
+
+
+def test_raster_matches_sjoin(tmp_path):
+    world = gpd.read_file(GEOJSON_PATH)
+    # A coarse raster builds in a second and has far more border cells to get right
+    raster = load_country_raster(world, GEOJSON_PATH, resolution=1.0, cache_dir=str(tmp_path))
+    points = sample_points(world)
+
+    joined = gpd.sjoin(gpd.GeoDataFrame(geometry=points, crs=world.crs), world[["NAME", "geometry"]],
+                       how="left", predicate="within")
+    expected = joined[~joined.index.duplicated()]["NAME"].fillna("").to_numpy()
+
+    longitude, latitude = shapely.get_coordinates(points).T
+    ids = raster.assign(latitude, longitude)
+    actual = np.where(ids == OUTSIDE, "", raster.names[np.maximum(ids, 0)])
+
+    assert (expected == "").any() and (expected != "").any()
+    mismatched = np.flatnonzero(actual != expected)
+    assert not len(mismatched), list(zip(latitude[mismatched], longitude[mismatched], actual[mismatched],
+                                         expected[mismatched]))[:10]
@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import pandas as pd
+from sub import country_store
+from sub.blob_store import LocalStore
+
+FOLDER = "data/countries"
+
+
+def rows(dates, no2=1.0, countries=("France", "Chile")):
+    return pd.DataFrame([{"Country": country, "Date": date, "NO2": no2, "Count": 10}
+                         for country in countries for date in dates])
+
+
+def test_concurrent_exports_keep_every_date(tmp_path):
+    store = LocalStore(str(tmp_path))
+    shards = [[f"2024-01-{day:02d}"] for day in range(1, 9)]
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        list(executor.map(lambda dates: country_store.export_legacy(store, FOLDER, rows(dates)), shards))
+
+    france = pd.read_parquet(BytesIO(store.get(country_store.legacy_key(FOLDER, "France"))))
+    assert france["Date"].tolist() == [dates[0] for dates in shards]
+
+
+def test_later_runs_win_and_compaction_keeps_the_result(tmp_path):
+    store = LocalStore(str(tmp_path))
+    country_store.write_run(store, FOLDER, rows(["2023-12-31", "2024-01-01", "2024-01-02"], no2=1.0), run_id="r1")
+    country_store.write_run(store, FOLDER, rows(["2024-01-02", "2024-01-03"], no2=2.0), run_id="r2")
+    country_store.write_run(store, FOLDER, rows(["2024-01-01"], no2=3.0, countries=["France"]), run_id="r3")
+
+    before = country_store.read_countries(store, FOLDER)
+    france = before[before["Country"] == "France"].set_index("Date")["NO2"].to_dict()
+    assert france == {"2023-12-31": 1.0, "2024-01-01": 3.0, "2024-01-02": 2.0, "2024-01-03": 2.0}
+    chile = before[before["Country"] == "Chile"].set_index("Date")["NO2"].to_dict()
+    assert chile == {"2023-12-31": 1.0, "2024-01-01": 1.0, "2024-01-02": 2.0, "2024-01-03": 2.0}
+
+    merged = country_store.compact_year(store, FOLDER, 2024)
+    assert merged == country_store.part_key(FOLDER, 2024, "r3")
+    assert country_store.list_parts(store, FOLDER) == {2023: [("r1", country_store.part_key(FOLDER, 2023, "r1"))],
+                                                       2024: [("r3", merged)]}
+    pd.testing.assert_frame_equal(country_store.read_countries(store, FOLDER), before)
+
+    # A run after compaction still wins over the merged part
+    country_store.write_run(store, FOLDER, rows(["2024-01-03"], no2=4.0, countries=["Chile"]), run_id="r4")
+    after = country_store.read_countries(store, FOLDER)
+    assert after.set_index(["Country", "Date"]).loc[("Chile", "2024-01-03"), "NO2"] == 4.0
+    assert after.set_index(["Country", "Date"]).loc[("France", "2024-01-03"), "NO2"] == 2.0
+
+
+def test_compact_skips_years_under_the_threshold(tmp_path):
+    store = LocalStore(str(tmp_path))
+    for run in range(3):
+        country_store.write_run(store, FOLDER, rows([f"2024-01-0{run + 1}"]), run_id=f"r{run}")
+    country_store.compact(store, FOLDER, threshold=3)
+    assert len(country_store.list_parts(store, FOLDER)[2024]) == 3
+    country_store.compact(store, FOLDER, threshold=2)
+    assert len(country_store.list_parts(store, FOLDER)[2024]) == 1
+    assert len(country_store.read_countries(store, FOLDER)) == 6
@@ -0,0 +1,32 @@
+import os
+from sub.disk_cache import DiskCache
+
+
+def test_forgotten_blob_leaves_the_budget(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"), budget=1024)
+    cache.put("a", b"x" * 100)
+    os.remove(cache._lookup("a"))
+
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_put_rewrites_a_blob_evicted_before_it_is_indexed(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"), budget=1024)
+    other = DiskCache(cache.root, budget=1024)
+    other.put("a", b"x" * 100)
+
+    write_blob = cache._write_blob
+    calls = []
+
+    def evict_after_first_write(digest, write):
+        write_blob(digest, write)
+        if not calls:
+            # Another process evicts the same content between the write and the index update
+            other.evict(0)
+        calls.append(digest)
+
+    cache._write_blob = evict_after_first_write
+    cache.put("b", b"x" * 100)
+    assert cache.get("b") == b"x" * 100
+    assert cache.stats()["bytes"] == 100
@@ -0,0 +1,78 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from bench.http_server import serve
+from sub import download_data
+from sub.download_data import SourceUnavailable, download_file, get_session, probe
+from tests.conftest import START_DATE
+
+TAR = f"{START_DATE:%Y}/{START_DATE:%m}/tropomi_no2_{START_DATE:%Y%m%d}.tar"
+
+
+@pytest.fixture
+def server(synthetic_dir):
+    """The synthetic tars behind the stand-in source server."""
+    server, url = serve(str(synthetic_dir / "tars"))
+    yield url
+    server.shutdown()
+
+
+@pytest.fixture
+def expected(synthetic_dir):
+    return (synthetic_dir / "tars" / TAR).read_bytes()
+
+
+def test_stream_download(server, expected, tmp_path):
+    path = download_file(f"{server}/{TAR}", str(tmp_path), session=get_session(), parts=1)
+    assert open(path, "rb").read() == expected
+
+
+def test_range_download(server, expected, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_data, "PART_SIZE", 64 * 1024)
+    path = download_file(f"{server}/{TAR}", str(tmp_path), session=get_session(), parts=4)
+    assert open(path, "rb").read() == expected
+
+
+def test_stream_resumes_a_partial_file(server, expected, tmp_path):
+    url = f"{server}/{TAR}"
+    remote = probe(url, get_session())
+    part_path = tmp_path / f"{TAR.rsplit('/', 1)[-1]}.part"
+    part_path.write_bytes(expected[:len(expected) // 2])
+    (tmp_path / f"{part_path.name}.json").write_text(json.dumps({"etag": remote.etag, "size": remote.size}))
+
+    path = download_file(url, str(tmp_path), session=get_session(), parts=1)
+    assert open(path, "rb").read() == expected
+
+
+def test_stream_restarts_a_partial_file_of_another_version(server, expected, tmp_path):
+    url = f"{server}/{TAR}"
+    part_path = tmp_path / f"{TAR.rsplit('/', 1)[-1]}.part"
+    part_path.write_bytes(b"x" * (len(expected) // 2))
+    (tmp_path / f"{part_path.name}.json").write_text(json.dumps({"etag": '"stale"', "size": len(expected)}))
+
+    path = download_file(url, str(tmp_path), session=get_session(), parts=1)
+    assert open(path, "rb").read() == expected
+
+
+class FailingHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_probe_tells_missing_files_from_server_errors(server):
+    assert probe(f"{server}/missing.tar", requests.Session()) is None
+
+    failing = ThreadingHTTPServer(("127.0.0.1", 0), FailingHandler)
+    threading.Thread(target=failing.serve_forever, daemon=True).start()
+    try:
+        with pytest.raises(SourceUnavailable):
+            probe(f"http://127.0.0.1:{failing.server_address[1]}/day.tar", requests.Session())
+    finally:
+        failing.shutdown()
@@ -0,0 +1,22 @@
+from datetime import timedelta
+import numpy as np
+from bench.synthetic import write_day_store
+from sub.catalog import DayCatalog
+from sub.grid import cell_bins, load_day_grid
+from sub.panel import Panel, update_panel
+from tests.conftest import SCALE, START_DATE
+
+
+def test_update_panel_rewrites_replaced_days(synthetic_store, tmp_path):
+    panel = Panel(str(tmp_path / "panel"))
+    update_panel(synthetic_store, panel)
+
+    replaced = START_DATE + timedelta(days=3)
+    write_day_store(synthetic_store, replaced, SCALE, seed=1)
+    assert update_panel(synthetic_store, panel) == 1
+
+    stats = load_day_grid(synthetic_store, replaced, DayCatalog.load(synthetic_store))
+    busiest = np.argmax(stats.count)
+    latitude, longitude = cell_bins(stats.cells[busiest])
+    _, values = Panel(panel.root).history(float(latitude), float(longitude), replaced, replaced)
+    np.testing.assert_allclose(values[0], stats.mean[busiest], rtol=1e-6)
@@ -0,0 +1,16 @@
+from datetime import timedelta
+from sub.planner import Planner
+from tests.conftest import DAYS, START_DATE
+
+END_DATE = START_DATE + timedelta(days=DAYS - 1)
+
+
+def test_failed_country_days_are_retried(synthetic_store):
+    broken = START_DATE + timedelta(days=2)
+    synthetic_store.put(f"data/days/d{broken:%Y%m%d}.parquet", b"not parquet")
+
+    planner = Planner(synthetic_store, START_DATE, END_DATE)
+    done = planner.execute(stages=("countries",))
+    assert broken not in done["countries"]
+    assert len(done["countries"]) == DAYS - 1
+    assert planner.stale("countries") == [broken]
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+# Packages of the main image that the RA image (sub/ra/requirements.txt) does not install
+MAIN_ONLY = ("flask", "gunicorn", "pandas", "geopandas", "h5py", "pyproj", "fiona", "shapely", "scipy", "pytz")
+
+SCRIPT = f"""
+import importlib.abc
+import sys
+
+class Block(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path, target=None):
+        if name.split(".")[0] in {MAIN_ONLY!r}:
+            raise ModuleNotFoundError(f"No module named {{name!r}}")
+
+sys.meta_path.insert(0, Block())
+import sub.ra.compute_ra_single_day
+import sub.ra.incremental
+"""
+
+
+def test_ra_job_imports_with_the_ra_requirements():
+    """The RA Batch image only installs sub/ra/requirements.txt."""
+    result = subprocess.run([sys.executable, "-c", SCRIPT], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,53 @@
+from datetime import timedelta
+import numpy as np
+import polars as pl
+import pytest
+from bench.synthetic import write_day_store
+from sub.blob_store import LocalStore
+from sub.ra.compute_ra_single_day import compute_7day_rolling, load_daily_parquet
+from sub.ra.incremental import WINDOW_DAYS, compute_incremental, iter_range
+from tests.conftest import DAYS, SCALE, START_DATE
+
+TARGET = START_DATE + timedelta(days=DAYS - 1)
+
+
+def full_recompute(store, target):
+    keys = [f"data/days/d{target - timedelta(days=offset):%Y%m%d}.parquet" for offset in range(6, -1, -1)]
+    frame = compute_7day_rolling(pl.concat([load_daily_parquet(store, key) for key in keys]))
+    return frame.filter(pl.col("date") == target)
+
+
+def assert_same(actual, expected):
+    actual = actual.sort(["lat_bin", "lon_bin"])
+    expected = expected.sort(["lat_bin", "lon_bin"])
+    assert actual.height == expected.height
+    for column in ("lat_bin", "lon_bin"):
+        assert np.array_equal(actual[column].to_numpy(), expected[column].to_numpy())
+    for column in ("no2", "no2_ra"):
+        np.testing.assert_allclose(actual[column].to_numpy(), expected[column].to_numpy(), rtol=1e-5)
+
+
+def test_range_and_incremental_match_full_recompute(synthetic_store, tmp_path):
+    """All three modes bin pixels alike, so they give the same cells and values."""
+    expected = full_recompute(synthetic_store, TARGET)
+    assert expected.height > 0
+
+    ranged = dict(iter_range(synthetic_store, TARGET - timedelta(days=1), TARGET))
+    assert_same(ranged[TARGET].select(expected.columns), expected)
+
+    output = LocalStore(str(tmp_path / "output"))
+    compute_incremental(synthetic_store, output, TARGET - timedelta(days=1))
+    incremental = compute_incremental(synthetic_store, output, TARGET)
+    assert_same(incremental.select(expected.columns), expected)
+
+
+@pytest.mark.parametrize("age", [WINDOW_DAYS, 3])
+def test_incremental_rebuilds_after_a_window_day_is_replaced(synthetic_store, tmp_path, age):
+    """A day replaced after entering the window (NRT swapped for the final product) is not subtracted stale."""
+    output = LocalStore(str(tmp_path / "output"))
+    compute_incremental(synthetic_store, output, TARGET - timedelta(days=1))
+
+    write_day_store(synthetic_store, TARGET - timedelta(days=age), SCALE, seed=1)
+    incremental = compute_incremental(synthetic_store, output, TARGET)
+    assert_same(incremental.select(["lat_bin", "lon_bin", "date", "no2", "no2_ra"]),
+                full_recompute(synthetic_store, TARGET))
@@ -0,0 +1,13 @@
+from sub.blob_store import LocalStore
+from sub.serve import RA_PREFIX, sync_replica
+
+
+def test_sync_replaces_rewritten_dated_files(synthetic_store, tmp_path):
+    key = f"{RA_PREFIX}ra_20240107.parquet"
+    synthetic_store.put(key, b"nrt")
+    sync_replica(synthetic_store, str(tmp_path / "replica"))
+
+    # The final product replaced the NRT day: the planner rewrites the RA file under the same key
+    synthetic_store.put(key, b"final")
+    sync_replica(synthetic_store, str(tmp_path / "replica"))
+    assert LocalStore(str(tmp_path / "replica")).get(key) == b"final"